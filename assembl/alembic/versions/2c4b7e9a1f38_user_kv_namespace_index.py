@@ -0,0 +1,33 @@
+"""user_kv_namespace_index
+
+Revision ID: 2c4b7e9a1f38
+Revises: 8d2a6f4b3c11
+Create Date: 2016-12-07 10:14:38.512907
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2c4b7e9a1f38'
+down_revision = '8d2a6f4b3c11'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_index(
+            'ix_discussion_peruser_namespaced_key_value_user_namespace',
+            'discussion_peruser_namespaced_key_value',
+            ['discussion_id', 'user_id', 'namespace'])
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_index(
+            'ix_discussion_peruser_namespaced_key_value_user_namespace',
+            'discussion_peruser_namespaced_key_value')
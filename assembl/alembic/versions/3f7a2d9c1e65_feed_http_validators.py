@@ -0,0 +1,32 @@
+"""feed_http_validators
+
+Revision ID: 3f7a2d9c1e65
+Revises: c4d9e0a1b2f3
+Create Date: 2016-12-02 10:14:37.520914
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3f7a2d9c1e65'
+down_revision = 'c4d9e0a1b2f3'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.add_column('feed_posts_source', sa.Column(
+            'http_etag', sa.String(512)))
+        op.add_column('feed_posts_source', sa.Column(
+            'http_last_modified', sa.String(64)))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_column('feed_posts_source', 'http_last_modified')
+        op.drop_column('feed_posts_source', 'http_etag')
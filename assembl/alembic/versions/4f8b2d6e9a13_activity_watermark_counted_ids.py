@@ -0,0 +1,43 @@
+"""activity_watermark_counted_ids
+
+Revision ID: 4f8b2d6e9a13
+Revises: 6e3d1a8c4b27
+Create Date: 2016-12-09 11:27:45.618230
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4f8b2d6e9a13'
+down_revision = '6e3d1a8c4b27'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.add_column('discussion_activity_watermark', sa.Column(
+            'counted_posts', sa.Binary))
+        op.add_column('discussion_activity_watermark', sa.Column(
+            'counted_views', sa.Binary))
+        op.add_column('discussion_activity_watermark', sa.Column(
+            'checkpoint_post_id', sa.Integer, nullable=False,
+            server_default='0'))
+        op.add_column('discussion_activity_watermark', sa.Column(
+            'checkpoint_view_id', sa.Integer, nullable=False,
+            server_default='0'))
+        op.add_column('discussion_activity_watermark', sa.Column(
+            'checkpoint_date', sa.DateTime))
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_column('discussion_activity_watermark', 'checkpoint_date')
+        op.drop_column('discussion_activity_watermark', 'checkpoint_view_id')
+        op.drop_column('discussion_activity_watermark', 'checkpoint_post_id')
+        op.drop_column('discussion_activity_watermark', 'counted_views')
+        op.drop_column('discussion_activity_watermark', 'counted_posts')
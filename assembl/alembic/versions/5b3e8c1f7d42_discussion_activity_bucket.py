@@ -0,0 +1,55 @@
+"""discussion_activity_bucket
+
+Revision ID: 5b3e8c1f7d42
+Revises: a2e634f2ce25
+Create Date: 2016-11-24 10:12:47.204318
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b3e8c1f7d42'
+down_revision = 'a2e634f2ce25'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'discussion_activity_bucket',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                "discussion.id", ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('bucket_start', sa.DateTime, nullable=False,
+                      index=True),
+            sa.Column('post_count', sa.Integer, nullable=False),
+            sa.Column('post_authors', sa.Binary),
+            sa.Column('post_viewers', sa.Binary),
+            sa.schema.UniqueConstraint('discussion_id', 'bucket_start'))
+        op.create_table(
+            'discussion_activity_watermark',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                "discussion.id", ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, unique=True),
+            sa.Column('last_post_id', sa.Integer, nullable=False),
+            sa.Column('last_view_id', sa.Integer, nullable=False))
+
+    # Do stuff with the app's models here.
+    from assembl import models as m
+    db = m.get_session_maker()()
+    with transaction.manager:
+        for (discussion_id,) in db.query(m.Discussion.id):
+            m.DiscussionActivityBucket.refresh(db, discussion_id)
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('discussion_activity_watermark')
+        op.drop_table('discussion_activity_bucket')
@@ -0,0 +1,38 @@
+"""notification_subscription_indices
+
+Revision ID: 5b8e1c0d7a42
+Revises: 3f7a2d9c1e65
+Create Date: 2016-12-05 15:21:09.386142
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b8e1c0d7a42'
+down_revision = '3f7a2d9c1e65'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_index(
+            'ix_notification_subscription_discussion_type_status',
+            'notification_subscription', ['discussion_id', 'type', 'status'])
+        op.create_index(
+            'ix_notification_subscription_on_post_post_id',
+            'notification_subscription_on_post', ['post_id'])
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_index(
+            'ix_notification_subscription_on_post_post_id',
+            'notification_subscription_on_post')
+        op.drop_index(
+            'ix_notification_subscription_discussion_type_status',
+            'notification_subscription')
@@ -0,0 +1,31 @@
+"""widget_user_config_widget_user_index
+
+Revision ID: 6e3d1a8c4b27
+Revises: 2c4b7e9a1f38
+Create Date: 2016-12-07 16:42:11.207354
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6e3d1a8c4b27'
+down_revision = '2c4b7e9a1f38'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_index(
+            'ix_widget_user_config_widget_user',
+            'widget_user_config', ['widget_id', 'user_id'])
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_index(
+            'ix_widget_user_config_widget_user', 'widget_user_config')
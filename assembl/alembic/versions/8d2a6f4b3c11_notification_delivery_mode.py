@@ -0,0 +1,34 @@
+"""notification_delivery_mode
+
+Revision ID: 8d2a6f4b3c11
+Revises: 5b8e1c0d7a42
+Create Date: 2016-12-06 11:02:53.144718
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8d2a6f4b3c11'
+down_revision = '5b8e1c0d7a42'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        from assembl.models.notification import NotificationDeliveryMode
+        schema = config.get('db_schema')+"."+config.get('db_user')
+        op.add_column("notification_subscription", sa.Column(
+            "delivery_mode", NotificationDeliveryMode.db_type(),
+            nullable=False,
+            server_default=NotificationDeliveryMode.IMMEDIATE.name),
+            schema=schema)
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_column("notification_subscription", "delivery_mode")
@@ -0,0 +1,42 @@
+"""idea_closure
+
+Revision ID: 8e2f6b9c4a17
+Revises: 5b3e8c1f7d42
+Create Date: 2016-11-25 16:03:21.873510
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8e2f6b9c4a17'
+down_revision = '5b3e8c1f7d42'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'idea_closure',
+            sa.Column('ancestor_id', sa.Integer, sa.ForeignKey(
+                'idea.id', ondelete="CASCADE", onupdate="CASCADE"),
+                primary_key=True),
+            sa.Column('descendant_id', sa.Integer, sa.ForeignKey(
+                'idea.id', ondelete="CASCADE", onupdate="CASCADE"),
+                primary_key=True, index=True),
+            sa.Column('depth', sa.Integer, nullable=False))
+
+    # Do stuff with the app's models here.
+    from assembl import models as m
+    db = m.get_session_maker()()
+    with transaction.manager:
+        m.IdeaClosure.rebuild(db)
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('idea_closure')
@@ -0,0 +1,44 @@
+"""post_read_state
+
+Revision ID: a2e634f2ce25
+Revises: d3a554698acf
+Create Date: 2016-11-22 15:40:11.532871
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a2e634f2ce25'
+down_revision = 'd3a554698acf'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'post_read_state',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                "discussion.id", ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('user_id', sa.Integer, sa.ForeignKey(
+                "user.id", ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('read_posts', sa.Binary),
+            sa.schema.UniqueConstraint('discussion_id', 'user_id'))
+
+    # Do stuff with the app's models here.
+    from assembl import models as m
+    db = m.get_session_maker()()
+    with transaction.manager:
+        m.PostReadState.rebuild(db)
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('post_read_state')
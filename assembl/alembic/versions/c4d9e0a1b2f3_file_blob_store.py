@@ -0,0 +1,46 @@
+"""file_blob_store
+
+Revision ID: c4d9e0a1b2f3
+Revises: 8e2f6b9c4a17
+Create Date: 2016-11-28 11:42:09.318827
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c4d9e0a1b2f3'
+down_revision = '8e2f6b9c4a17'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.add_column('file', sa.Column('file_sha256', sa.String(64)))
+        op.add_column('file', sa.Column('file_size', sa.Integer))
+        op.create_index('ix_file_file_sha256', 'file', ['file_sha256'])
+        op.alter_column('file', 'data', nullable=True)
+
+    # Move the file contents to the blob store
+    from cStringIO import StringIO
+    from assembl import models as m
+    db = m.get_session_maker()()
+    with transaction.manager:
+        file_ids = [id for (id,) in db.query(m.File.id).filter(
+            m.File.data != None)]
+    for file_id in file_ids:
+        with transaction.manager:
+            f = db.query(m.File).get(file_id)
+            f.add_file_data(StringIO(f.data))
+
+
+def downgrade(pyramid_env):
+    # Files in the blob store are not moved back to the database
+    with context.begin_transaction():
+        op.drop_index('ix_file_file_sha256', 'file')
+        op.drop_column('file', 'file_size')
+        op.drop_column('file', 'file_sha256')
@@ -0,0 +1,49 @@
+"""discussion_participant
+
+Revision ID: d3a554698acf
+Revises: 335e41a86a6b
+Create Date: 2016-11-21 10:12:37.204118
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd3a554698acf'
+down_revision = '335e41a86a6b'
+
+from alembic import context, op
+import sqlalchemy as sa
+import transaction
+
+
+from assembl.lib import config
+
+
+def upgrade(pyramid_env):
+    with context.begin_transaction():
+        op.create_table(
+            'discussion_participant',
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('discussion_id', sa.Integer, sa.ForeignKey(
+                "discussion.id", ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('profile_id', sa.Integer, sa.ForeignKey(
+                "agent_profile.id", ondelete='CASCADE', onupdate='CASCADE'),
+                nullable=False, index=True),
+            sa.Column('has_role', sa.Boolean, server_default='0'),
+            sa.Column('has_posted', sa.Boolean, server_default='0'),
+            sa.Column('has_extracted', sa.Boolean, server_default='0'),
+            sa.Column('has_read', sa.Boolean, server_default='0'),
+            sa.Column('first_activity', sa.DateTime),
+            sa.Column('last_activity', sa.DateTime),
+            sa.schema.UniqueConstraint('discussion_id', 'profile_id'))
+
+    # Do stuff with the app's models here.
+    from assembl import models as m
+    db = m.get_session_maker()()
+    with transaction.manager:
+        m.DiscussionParticipant.rebuild(db)
+
+
+def downgrade(pyramid_env):
+    with context.begin_transaction():
+        op.drop_table('discussion_participant')
@@ -0,0 +1,186 @@
+"""A compact set of integer ids, used for per-user read state."""
+import struct
+import zlib
+
+
+class IdBitmap(object):
+    """A compressed set of non-negative integer ids.
+
+    Modelled on roaring bitmaps: ids are split in chunks of 2**16 by their
+    high bits; each chunk holds its low bits in a python set while sparse,
+    and in a bitmap once dense. Adding, removing and testing an id are O(1).
+    """
+    CHUNK_BITS = 16
+    LOW_MASK = (1 << CHUNK_BITS) - 1
+    BITMAP_BYTES = (1 << CHUNK_BITS) >> 3
+    # Beyond this many entries, a bitmap is smaller than an array of shorts
+    DENSE_THRESHOLD = 4096
+    FORMAT_VERSION = 1
+
+    def __init__(self, ids=()):
+        self._chunks = {}
+        self._len = 0
+        self.update(ids)
+
+    def add(self, id):
+        "Add an id. Returns whether it was absent."
+        high, low = id >> self.CHUNK_BITS, id & self.LOW_MASK
+        chunk = self._chunks.get(high, None)
+        if chunk is None:
+            chunk = self._chunks[high] = set()
+        if isinstance(chunk, set):
+            if low in chunk:
+                return False
+            chunk.add(low)
+            if len(chunk) > self.DENSE_THRESHOLD:
+                self._chunks[high] = self._as_dense(chunk)
+        else:
+            byte, bit = low >> 3, 1 << (low & 7)
+            if chunk[byte] & bit:
+                return False
+            chunk[byte] |= bit
+        self._len += 1
+        return True
+
+    def update(self, ids):
+        for id in ids:
+            self.add(id)
+
+    def discard(self, id):
+        "Remove an id. Returns whether it was present."
+        high, low = id >> self.CHUNK_BITS, id & self.LOW_MASK
+        chunk = self._chunks.get(high, None)
+        if chunk is None:
+            return False
+        if isinstance(chunk, set):
+            if low not in chunk:
+                return False
+            chunk.remove(low)
+            if not chunk:
+                del self._chunks[high]
+        else:
+            byte, bit = low >> 3, 1 << (low & 7)
+            if not chunk[byte] & bit:
+                return False
+            chunk[byte] &= ~bit
+        self._len -= 1
+        return True
+
+    def __contains__(self, id):
+        chunk = self._chunks.get(id >> self.CHUNK_BITS, None)
+        if chunk is None:
+            return False
+        low = id & self.LOW_MASK
+        if isinstance(chunk, set):
+            return low in chunk
+        return bool(chunk[low >> 3] & (1 << (low & 7)))
+
+    def __len__(self):
+        return self._len
+
+    def __nonzero__(self):
+        return self._len > 0
+
+    def __iter__(self):
+        for high in sorted(self._chunks):
+            base = high << self.CHUNK_BITS
+            for low in self._chunk_lows(self._chunks[high]):
+                yield base + low
+
+    def __eq__(self, other):
+        return isinstance(other, IdBitmap) and len(self) == len(other) \
+            and all(id in other for id in self)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<IdBitmap %d ids>" % (self._len,)
+
+    def count_in(self, ids):
+        "How many of the given ids belong to this set"
+        return sum(1 for id in ids if id in self)
+
+    def intersection(self, ids):
+        if isinstance(ids, IdBitmap) and len(ids) > len(self):
+            return ids.intersection(self)
+        return IdBitmap(id for id in ids if id in self)
+
+    __and__ = intersection
+
+    @classmethod
+    def _as_dense(cls, lows):
+        bitmap = bytearray(cls.BITMAP_BYTES)
+        for low in lows:
+            bitmap[low >> 3] |= 1 << (low & 7)
+        return bitmap
+
+    @staticmethod
+    def _chunk_lows(chunk):
+        if isinstance(chunk, set):
+            for low in sorted(chunk):
+                yield low
+        else:
+            for byte_num, byte in enumerate(chunk):
+                if byte:
+                    for bit in range(8):
+                        if byte & (1 << bit):
+                            yield (byte_num << 3) + bit
+
+    def as_ranges(self):
+        """The ids as a list of inclusive [start, end] runs.
+
+        This is the compact representation sent to the client."""
+        ranges = []
+        for id in self:
+            if ranges and ranges[-1][1] == id - 1:
+                ranges[-1][1] = id
+            else:
+                ranges.append([id, id])
+        return ranges
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        bitmap = cls()
+        for (start, end) in ranges:
+            bitmap.update(xrange(start, end + 1))
+        return bitmap
+
+    def to_bytes(self):
+        """Serialize to a compressed binary string, for storage."""
+        parts = [struct.pack('>BI', self.FORMAT_VERSION, len(self._chunks))]
+        for high in sorted(self._chunks):
+            chunk = self._chunks[high]
+            if isinstance(chunk, set):
+                parts.append(struct.pack('>IBH', high, 0, len(chunk)))
+                parts.append(struct.pack(
+                    '>%dH' % len(chunk), *sorted(chunk)))
+            else:
+                parts.append(struct.pack('>IBH', high, 1, 0))
+                parts.append(str(chunk))
+        return zlib.compress(''.join(parts))
+
+    @classmethod
+    def from_bytes(cls, data):
+        bitmap = cls()
+        if not data:
+            return bitmap
+        data = zlib.decompress(data)
+        version, num_chunks = struct.unpack_from('>BI', data)
+        assert version == cls.FORMAT_VERSION, "Unknown bitmap format"
+        pos = struct.calcsize('>BI')
+        header_size = struct.calcsize('>IBH')
+        for i in xrange(num_chunks):
+            high, dense, count = struct.unpack_from('>IBH', data, pos)
+            pos += header_size
+            if dense:
+                chunk = bytearray(data[pos:pos + cls.BITMAP_BYTES])
+                pos += cls.BITMAP_BYTES
+                bitmap._len += sum(
+                    bin(byte).count('1') for byte in chunk if byte)
+            else:
+                chunk = set(struct.unpack_from('>%dH' % count, data, pos))
+                pos += 2 * count
+                bitmap._len += count
+            bitmap._chunks[high] = chunk
+        return bitmap
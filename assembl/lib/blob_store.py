@@ -0,0 +1,123 @@
+"""Content-addressed storage for uploaded files.
+
+Files are stored once per SHA-256 digest, outside the database. The store
+is chosen with the ``blob_store.class`` setting (a dotted name), and
+defaults to :py:class:`FileSystemBlobStore` rooted at ``blob_store.path``.
+"""
+from __future__ import absolute_import
+
+import os
+import hashlib
+from abc import ABCMeta, abstractmethod
+from tempfile import NamedTemporaryFile
+
+from pyramid.path import DottedNameResolver
+
+from . import config
+
+CHUNK_SIZE = 1 << 16
+
+
+class BlobStore(object):
+    """Abstract content-addressed store. Keys are hex SHA-256 digests."""
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def put_stream(self, stream):
+        """Store the content of a file-like object, read in chunks.
+
+        Returns the (key, size) of the content. Storing content which is
+        already present is cheap and does not duplicate it."""
+
+    @abstractmethod
+    def open(self, key):
+        "A readable binary file-like object for the blob."
+
+    @abstractmethod
+    def exists(self, key):
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+    def local_path(self, key):
+        """A filesystem path for the blob, if the store has one.
+
+        Allows serving the blob directly or through X-Sendfile."""
+        return None
+
+    def put_data(self, data):
+        from cStringIO import StringIO
+        return self.put_stream(StringIO(data))
+
+
+class FileSystemBlobStore(BlobStore):
+    """Stores blobs in a directory tree, as ``root/ab/cd/abcd...``."""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.tmp_dir = os.path.join(self.root, 'tmp')
+        if not os.path.isdir(self.tmp_dir):
+            os.makedirs(self.tmp_dir)
+
+    def local_path(self, key):
+        assert len(key) == 64 and all(c in '0123456789abcdef' for c in key)
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def put_stream(self, stream):
+        digest = hashlib.sha256()
+        size = 0
+        with NamedTemporaryFile(dir=self.tmp_dir, delete=False) as tmp:
+            try:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    size += len(chunk)
+                    tmp.write(chunk)
+            except:
+                os.unlink(tmp.name)
+                raise
+        key = digest.hexdigest()
+        path = self.local_path(key)
+        if os.path.exists(path):
+            os.unlink(tmp.name)
+        else:
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                try:
+                    os.makedirs(dirname)
+                except OSError:
+                    # created concurrently
+                    if not os.path.isdir(dirname):
+                        raise
+            # atomic, so readers never see a partial blob
+            os.rename(tmp.name, path)
+        return key, size
+
+    def open(self, key):
+        return open(self.local_path(key), 'rb')
+
+    def exists(self, key):
+        return os.path.exists(self.local_path(key))
+
+    def delete(self, key):
+        path = self.local_path(key)
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+_blob_store = None
+
+
+def get_blob_store():
+    "The configured blob store"
+    global _blob_store
+    if _blob_store is None:
+        store_class = config.get('blob_store.class', None)
+        store_class = DottedNameResolver(__package__).resolve(
+            store_class) if store_class else FileSystemBlobStore
+        _blob_store = store_class(config.get('blob_store.path', 'var/blobs'))
+    return _blob_store
@@ -0,0 +1,117 @@
+"""Per-discussion content versions, for the invalidation of derived data.
+
+Every commit that changes objects of a discussion increments the version of
+that discussion, and records the URIs of the changed objects with the
+version at which they changed. Caches can tag what they hold with the
+version they were computed at, and later know both that they are stale and
+which objects changed since. Objects outside of any discussion, such as
+user profiles, are counted under the ``"*"`` pseudo-discussion; other
+pseudo-discussions, such as ``"roles"``, count changes to global tables.
+
+The versions are kept in a dogpile.cache dbm file, named by the
+``content_versions.filename`` setting, which is shared by all processes
+of the server, including celery workers.
+"""
+from __future__ import absolute_import
+
+from os.path import join, dirname, isabs
+import logging
+
+from dogpile.cache import make_region
+
+from . import config
+
+log = logging.getLogger('assembl')
+
+# Past this many changed objects, the change log of a discussion is reset,
+# and caches older than the reset have to be recomputed in full.
+MAX_LOGGED_CHANGES = 5000
+
+_region = None
+
+
+def get_region():
+    global _region
+    if _region is None:
+        filename = config.get(
+            'content_versions.filename', 'var/content_versions.dbm')
+        if not isabs(filename):
+            filename = join(
+                dirname(dirname(dirname(__file__))), filename)
+        _region = make_region().configure(
+            'dogpile.cache.dbm', arguments={'filename': filename})
+    return _region
+
+
+def version_key(discussion_id):
+    return "content_version:%s" % (discussion_id,)
+
+
+class ContentVersion(object):
+    """The version of a discussion's content, and the log of changes.
+
+    The log covers all changes after version ``log_start``."""
+
+    def __init__(self, version=0, log_start=0, changes=None):
+        self.version = version
+        self.log_start = log_start
+        self.changes = changes or {}
+
+    def changed_since(self, version):
+        """The URIs of objects changed after a version, or None if the log
+        does not go back that far."""
+        if version < self.log_start:
+            return None
+        return {uri for (uri, v) in self.changes.iteritems() if v > version}
+
+    def as_tuple(self):
+        return (self.version, self.log_start, self.changes)
+
+
+def get_version(discussion_id):
+    region = get_region()
+    value = region.get(version_key(discussion_id))
+    if not value:
+        return ContentVersion()
+    return ContentVersion(*value)
+
+
+def record_changes(discussion_id, uris):
+    """Increment the version of a discussion, for changes to those objects"""
+    return record_all_changes({discussion_id: uris})[discussion_id]
+
+
+def record_all_changes(changes_by_discussion):
+    """Increment the versions of many discussions, for changes to objects
+    given as a {discussion_id: uris} dict. Returns the new versions.
+
+    Each change is a read-modify-write under the lock of the backend, and
+    the dbm backend has a single lock for the whole file; so every commit
+    that changes content serializes on it, across all processes. Hence
+    the changes of a transaction are recorded together, under one lock."""
+    region = get_region()
+    keys = {discussion_id: version_key(discussion_id)
+            for discussion_id in changes_by_discussion}
+    mutexes = []
+    for key in sorted(keys.itervalues()):
+        mutex = region.backend.get_mutex(key)
+        if mutex is not None and not any(m is mutex for m in mutexes):
+            mutexes.append(mutex)
+    for mutex in mutexes:
+        mutex.acquire()
+    try:
+        versions = {}
+        for discussion_id, uris in changes_by_discussion.iteritems():
+            current = get_version(discussion_id)
+            current.version += 1
+            for uri in uris:
+                current.changes[uri] = current.version
+            if len(current.changes) > MAX_LOGGED_CHANGES:
+                current.changes = {}
+                current.log_start = current.version
+            region.set(keys[discussion_id], current.as_tuple())
+            versions[discussion_id] = current.version
+    finally:
+        for mutex in reversed(mutexes):
+            mutex.release()
+    return versions
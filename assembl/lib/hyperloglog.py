@@ -0,0 +1,97 @@
+"""A mergeable cardinality estimator, used for pre-aggregated analytics."""
+import hashlib
+import math
+import struct
+import zlib
+
+
+class HyperLogLog(object):
+    """A HyperLogLog_ sketch of a set of values.
+
+    Sketches of disjoint time buckets can be merged to estimate the number
+    of distinct values over any union of buckets. With the default
+    precision (2**12 registers), the standard error is about 1.6%;
+    small cardinalities use linear counting and are nearly exact.
+
+    .. _HyperLogLog: http://algo.inria.fr/flajolet/Publications/FlFuGaMe07.pdf
+    """
+    DEFAULT_PRECISION = 12
+
+    def __init__(self, precision=DEFAULT_PRECISION, values=()):
+        self.precision = precision
+        self.num_registers = 1 << precision
+        self.registers = bytearray(self.num_registers)
+        for value in values:
+            self.add(value)
+
+    @staticmethod
+    def _hash(value):
+        return struct.unpack(
+            '>Q', hashlib.md5(str(value)).digest()[:8])[0]
+
+    def add(self, value):
+        h = self._hash(value)
+        index = h >> (64 - self.precision)
+        remaining = (h << self.precision) & 0xFFFFFFFFFFFFFFFF
+        # rank: position of the leftmost 1 bit in the remaining bits
+        rank = 1
+        max_rank = 64 - self.precision + 1
+        while rank < max_rank and not remaining & (1 << 63):
+            rank += 1
+            remaining <<= 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        "Merge another sketch of the same precision into this one."
+        assert self.precision == other.precision
+        registers = self.registers
+        for i, rank in enumerate(other.registers):
+            if rank > registers[i]:
+                registers[i] = rank
+        return self
+
+    def copy(self):
+        sketch = self.__class__(self.precision)
+        sketch.registers = bytearray(self.registers)
+        return sketch
+
+    def __len__(self):
+        return int(round(self.cardinality()))
+
+    def cardinality(self):
+        m = self.num_registers
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        elif m == 64:
+            alpha = 0.709
+        elif m == 32:
+            alpha = 0.697
+        else:
+            alpha = 0.673
+        estimate = alpha * m * m / sum(
+            2.0 ** -rank for rank in self.registers)
+        if estimate <= 2.5 * m:
+            zeros = self.registers.count(b"\x00")
+            if zeros:
+                return m * math.log(float(m) / zeros)
+        return estimate
+
+    def to_bytes(self):
+        return zlib.compress(
+            struct.pack('>B', self.precision) + str(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data, precision=DEFAULT_PRECISION):
+        if not data:
+            return cls(precision)
+        data = zlib.decompress(data)
+        (precision,) = struct.unpack_from('>B', data)
+        sketch = cls(precision)
+        sketch.registers = bytearray(data[1:])
+        assert len(sketch.registers) == sketch.num_registers
+        return sketch
@@ -16,7 +16,7 @@ from anyjson import dumps, loads
 from colanderalchemy import SQLAlchemySchemaNode
 from sqlalchemy import (
     DateTime, MetaData, engine_from_config, event, Column, Integer,
-    inspect)
+    inspect, Sequence, select, func)
 from sqlalchemy.exc import NoInspectionAvailable
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import AssociationProxy
@@ -36,6 +36,7 @@ from pyramid.httpexceptions import HTTPUnauthorized, HTTPBadRequest
 from .parsedatetime import parse_datetime
 from ..view_def import get_view_def
 from .zmqlib import get_pub_socket, send_changes
+from .raven_client import capture_exception
 from ..semantic.namespaces import QUADNAMES
 from ..auth import *
 from .decl_enums import EnumSymbol, DeclEnumType
@@ -1675,20 +1676,42 @@ def after_commit_listener(session):
     if getattr(session, 'cdict2', None):
         for discussion, changes in session.cdict2.iteritems():
             send_changes(session.zsocket, discussion, changes)
+        record_content_versions(session.cdict2)
         del session.cdict2
 
 
+def record_content_versions(changes_by_discussion):
+    """Increment the :py:mod:`assembl.lib.content_version` of discussions
+    with changed objects, so caches of derived data know they are stale."""
+    from .content_version import record_all_changes
+    try:
+        # All at once, as the version store has a global lock
+        record_all_changes({
+            discussion: [
+                change['@id'] for change in changes if '@id' in change]
+            for discussion, changes in changes_by_discussion.iteritems()})
+    except Exception:
+        # The commit is done; at worst, caches stay stale for a while.
+        capture_exception()
+
+
 def session_rollback_listener(session):
     """In case of rollback, forget about object changes."""
     if getattr(session, 'cdict2', None):
         del session.cdict2
 
 
+# Keys of connection.info where listeners queue work for later in the
+# transaction; models add theirs.
+transient_connection_info_keys = {'cdict'}
+
+
 def engine_rollback_listener(connection):
     """In case of rollback, forget about object changes."""
     info = getattr(connection, 'info', None)
-    if info and 'cdict' in info:
-        del info['cdict']
+    if info:
+        for key in transient_connection_info_keys:
+            info.pop(key, None)
 
 
 event.listen(BaseOps, 'after_insert', orm_insert_listener, propagate=True)
@@ -1747,6 +1770,21 @@ def mark_changed(session=None):
     z_mark_changed(session)
 
 
+def reserve_ids(session, column, count):
+    """Draw count values from the sequence of an integer primary key, to
+    insert rows in bulk with explicit ids. Postgres only."""
+    if not count:
+        return []
+    if isinstance(column.default, Sequence):
+        next_value = column.default.next_value()
+    else:
+        next_value = func.nextval(session.execute(select([
+            func.pg_get_serial_sequence(
+                column.table.fullname, column.name)])).scalar())
+    return [id for (id,) in session.execute(select([next_value]).select_from(
+        func.generate_series(1, count))).fetchall()]
+
+
 def get_metadata():
     global _metadata
     return _metadata
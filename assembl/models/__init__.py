@@ -107,6 +107,7 @@ from .auth import (
     AgentProfile,
     AgentStatusInDiscussion,
     AnonymousUser,
+    DiscussionParticipant,
     DiscussionPermission,
     EmailAccount,
     IdentityProvider,
@@ -169,6 +170,7 @@ from .mail import (
 from .idea import (
     Idea,
     IdeaLink,
+    IdeaClosure,
     RootIdea,
 )
 from .idea_msg_columns import (
@@ -181,6 +183,7 @@ from .action import (
     CollapsePost,
     ExpandPost,
     LikedPost,
+    PostReadState,
     UniqueActionOnIdea,
     UniqueActionOnPost,
     ViewIdea,
@@ -262,8 +265,10 @@ from .notification import (
     Notification,
     NotificationCreationOrigin,
     NotificationDeliveryStateType,
+    NotificationDeliveryMode,
     NotificationOnPost,
     NotificationOnPostCreated,
+    NotificationDigest,
 )
 
 from .feed_parsing import (
@@ -302,6 +307,11 @@ from .announcement import (
     IdeaAnnouncement,
 )
 
+from .analytics import (
+    DiscussionActivityBucket,
+    DiscussionActivityWatermark,
+)
+
 
 def includeme(config):
     config.include('.langstrings')
@@ -3,8 +3,10 @@
 """
 
 from datetime import datetime
+from collections import defaultdict
 
 from sqlalchemy import (
+    Binary,
     Boolean,
     Column,
     String,
@@ -16,16 +18,20 @@ from sqlalchemy import (
     select,
     func,
     event,
+    UniqueConstraint,
 )
 from sqlalchemy.inspection import inspect
-from sqlalchemy.orm import relationship, backref, column_property
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import relationship, backref, column_property, deferred
 from virtuoso.vmapping import IriClass
 
 from . import DiscussionBoundBase, DiscussionBoundTombstone, TombstonableMixin, Post
 from ..semantic.namespaces import (
     ASSEMBL, QUADNAMES, VERSION, RDF, VirtRDF)
 from ..semantic.virtuoso_mapping import QuadMapPatternS
-from .auth import User, AgentProfile
+from ..lib.bitmap import IdBitmap
+from ..lib.sqla import get_session_maker, transient_connection_info_keys
+from .auth import User, AgentProfile, DiscussionParticipant
 from .generic import Content
 from .discussion import Discussion
 from .idea import Idea
@@ -180,6 +186,175 @@ class ViewPost(UniqueActionOnPost):
     verb = 'viewed'
 
 
+@event.listens_for(ViewPost, 'after_insert', propagate=True)
+def record_participation_for_view(mapper, connection, target):
+    DiscussionParticipant.record_activity(
+        connection, target.get_discussion_id(), target.actor_id,
+        'has_read', target.creation_date)
+    PostReadState.mark(
+        connection, target.get_discussion_id(), target.actor_id,
+        target.post_id, True)
+
+
+@event.listens_for(ViewPost, 'after_update', propagate=True)
+def update_read_state_for_view(mapper, connection, target):
+    if not inspect(target).unmodified_intersection(('tombstone_date',)):
+        PostReadState.mark(
+            connection, target.get_discussion_id(), target.actor_id,
+            target.post_id, target.tombstone_date is None)
+
+
+class PostReadState(DiscussionBoundBase):
+    """The set of posts read by a user in a discussion, as a compact bitmap.
+
+    This is a materialization of the live :py:class:`ViewPost` actions,
+    maintained by listeners on that class. It avoids joining on the action
+    table to know read status."""
+    __tablename__ = 'post_read_state'
+    __table_args__ = (
+        UniqueConstraint('discussion_id', 'user_id'), )
+
+    id = Column(Integer, primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+            "discussion.id", ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    discussion = relationship(
+        Discussion, backref=backref(
+            "post_read_states", cascade="all, delete-orphan"))
+    user_id = Column(Integer, ForeignKey(
+            "user.id", ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    user = relationship(
+        User, backref=backref(
+            "post_read_states", cascade="all, delete-orphan"))
+    read_posts = deferred(Column(Binary))
+
+    @property
+    def bitmap(self):
+        return IdBitmap.from_bytes(self.read_posts)
+
+    @bitmap.setter
+    def bitmap(self, bitmap):
+        self.read_posts = bitmap.to_bytes()
+
+    def get_discussion_id(self):
+        return self.discussion_id or self.discussion.id
+
+    @classmethod
+    def get_discussion_conditions(cls, discussion_id, alias_maker=None):
+        return (cls.discussion_id == discussion_id,)
+
+    def is_owner(self, user_id):
+        return user_id == self.user_id
+
+    @classmethod
+    def restrict_to_owners(cls, q, user_id):
+        return q.filter(cls.user_id == user_id)
+
+    @classmethod
+    def get_bitmap(cls, db, discussion_id, user_id):
+        "The bitmap of ids of posts read by that user in that discussion"
+        row = db.query(cls.read_posts).filter_by(
+            discussion_id=discussion_id, user_id=user_id).first()
+        return IdBitmap.from_bytes(row[0] if row else None)
+
+    # How many read post ids go in one IN clause
+    READ_IDS_CHUNK_SIZE = 1000
+
+    @classmethod
+    def count_read(cls, query, id_column, read_posts):
+        """How many rows of the query have an id among the read posts.
+
+        Counted in SQL, with the read ids given in chunks, so only the
+        user's read posts are sent rather than all posts fetched."""
+        read_ids = list(read_posts)
+        total = 0
+        for start in range(0, len(read_ids), cls.READ_IDS_CHUNK_SIZE):
+            (chunk_count,) = query.filter(id_column.in_(
+                read_ids[start:start + cls.READ_IDS_CHUNK_SIZE])
+            ).with_entities(func.count(id_column)).first()
+            total += chunk_count
+        return total
+
+    @classmethod
+    def mark(cls, connection, discussion_id, user_id, post_id, read=True):
+        """Mark a post as read or unread. Works on the connection,
+        as it is meant to be called from flush listeners.
+
+        The marks are only queued; they are written by :py:meth:`apply_marks`
+        after the flush, so each bitmap is decoded and encoded once."""
+        marks = connection.info.setdefault('post_read_marks', {})
+        marks.setdefault((discussion_id, user_id), {})[post_id] = read
+
+    @classmethod
+    def apply_marks(cls, connection, marks):
+        """Write the queued marks, as a dictionary of
+        {(discussion_id, user_id): {post_id: read}}"""
+        for ((discussion_id, user_id), posts) in marks.iteritems():
+            cls._apply_user_marks(connection, discussion_id, user_id, posts)
+
+    @classmethod
+    def _apply_user_marks(cls, connection, discussion_id, user_id, posts):
+        t = cls.__table__
+        query = select([t.c.id, t.c.read_posts]).where(
+            (t.c.discussion_id == discussion_id) &
+            (t.c.user_id == user_id))
+        if not cls.using_virtuoso:
+            # Concurrent marks for the same user must not lose updates
+            query = query.with_for_update()
+        row = connection.execute(query).first()
+        bitmap = IdBitmap.from_bytes(row.read_posts if row else None)
+        changed = False
+        for post_id, read in posts.iteritems():
+            if read:
+                changed = bitmap.add(post_id) or changed
+            else:
+                changed = bitmap.discard(post_id) or changed
+        if not changed:
+            return
+        if row is None:
+            # Another transaction may insert the first state of that user
+            # concurrently; if so, mark its row instead.
+            savepoint = connection.begin_nested()
+            try:
+                connection.execute(t.insert().values(
+                    discussion_id=discussion_id, user_id=user_id,
+                    read_posts=bitmap.to_bytes()))
+                savepoint.commit()
+                return
+            except IntegrityError:
+                savepoint.rollback()
+            return cls._apply_user_marks(
+                connection, discussion_id, user_id, posts)
+        connection.execute(t.update().where(t.c.id == row.id).values(
+            read_posts=bitmap.to_bytes()))
+
+    @classmethod
+    def rebuild(cls, db, discussion_id=None):
+        "Recompute read states from the ViewPost actions"
+        t = cls.__table__
+        query = db.query(
+            Content.discussion_id, ViewPost.actor_id, ViewPost.post_id
+            ).join(Content, Content.id == ViewPost.post_id).filter(
+            ViewPost.tombstone_date == None)
+        if discussion_id is None:
+            db.execute(t.delete())
+        else:
+            db.execute(t.delete().where(t.c.discussion_id == discussion_id))
+            query = query.filter(Content.discussion_id == discussion_id)
+        bitmaps = defaultdict(IdBitmap)
+        for (d_id, user_id, post_id) in query:
+            bitmaps[(d_id, user_id)].add(post_id)
+        if bitmaps:
+            db.execute(t.insert(), [
+                dict(discussion_id=d_id, user_id=user_id,
+                     read_posts=bitmap.to_bytes())
+                for ((d_id, user_id), bitmap) in bitmaps.iteritems()])
+
+    crud_permissions = CrudPermissions(
+        P_READ, P_SYSADMIN, P_SYSADMIN, P_SYSADMIN, P_READ, P_READ, P_READ)
+
+
 class LikedPost(UniqueActionOnPost):
     """
     A like action on a post.
@@ -205,6 +380,17 @@ class LikedPost(UniqueActionOnPost):
         P_READ, P_READ, P_SYSADMIN, P_SYSADMIN, P_READ, P_READ, P_READ)
 
 
+transient_connection_info_keys.add('post_read_marks')
+
+
+@event.listens_for(get_session_maker(), "after_flush")
+def write_post_read_marks(session, flush_context):
+    connection = session.connection()
+    marks = connection.info.pop('post_read_marks', None)
+    if marks:
+        PostReadState.apply_marks(connection, marks)
+
+
 @event.listens_for(LikedPost, 'after_insert', propagate=True)
 def send_post_to_socket(mapper, connection, target):
     target.post.send_to_changes()
@@ -0,0 +1,314 @@
+"""Pre-aggregated activity of discussions, for time series analytics"""
+from datetime import datetime, timedelta
+from bisect import bisect_left
+from collections import defaultdict
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    DateTime,
+    Binary,
+    ForeignKey,
+    UniqueConstraint,
+)
+from sqlalchemy.orm import relationship, backref, deferred
+from sqlalchemy.exc import IntegrityError
+
+from ..auth import CrudPermissions, P_DISC_STATS, P_SYSADMIN
+from ..lib.hyperloglog import HyperLogLog
+from ..lib.bitmap import IdBitmap
+from . import DiscussionBoundBase
+from .discussion import Discussion
+
+
+class DiscussionActivityBucket(DiscussionBoundBase):
+    """The activity of a discussion during one hour.
+
+    Post counts are exact and can be summed; distinct authors and readers
+    are kept as :py:class:`assembl.lib.hyperloglog.HyperLogLog` sketches,
+    which can be merged over any range of buckets. Only hours with activity
+    have a bucket."""
+    __tablename__ = "discussion_activity_bucket"
+    __table_args__ = (
+        UniqueConstraint('discussion_id', 'bucket_start'), )
+
+    bucket_duration = timedelta(hours=1)
+
+    id = Column(Integer, primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+            "discussion.id", ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    discussion = relationship(
+        Discussion, backref=backref(
+            "activity_buckets", cascade="all, delete-orphan"))
+    bucket_start = Column(DateTime, nullable=False, index=True)
+    post_count = Column(Integer, nullable=False, default=0)
+    post_authors = deferred(Column(Binary))
+    post_viewers = deferred(Column(Binary))
+
+    @property
+    def post_authors_sketch(self):
+        return HyperLogLog.from_bytes(self.post_authors)
+
+    @post_authors_sketch.setter
+    def post_authors_sketch(self, sketch):
+        self.post_authors = sketch.to_bytes()
+
+    @property
+    def post_viewers_sketch(self):
+        return HyperLogLog.from_bytes(self.post_viewers)
+
+    @post_viewers_sketch.setter
+    def post_viewers_sketch(self, sketch):
+        self.post_viewers = sketch.to_bytes()
+
+    @staticmethod
+    def bucket_start_for(date):
+        return date.replace(minute=0, second=0, microsecond=0)
+
+    def get_discussion_id(self):
+        return self.discussion_id or self.discussion.id
+
+    @classmethod
+    def get_discussion_conditions(cls, discussion_id, alias_maker=None):
+        return (cls.discussion_id == discussion_id,)
+
+    @classmethod
+    def refresh(cls, db, discussion_id):
+        """Aggregate the posts and views created since the last refresh.
+
+        Progress is tracked by post and view ids, so imported content with
+        old creation dates still lands in the right bucket. Ids are not
+        committed in order, so ids above the settled watermark are tracked
+        individually; see :py:class:`DiscussionActivityWatermark`."""
+        from .post import Post
+        from .generic import Content
+        from .action import ViewPost
+        watermark, is_new = DiscussionActivityWatermark.get_for_update(
+            db, discussion_id)
+        counted_posts = IdBitmap.from_bytes(watermark.counted_posts)
+        counted_views = IdBitmap.from_bytes(watermark.counted_views)
+        # hour -> [post count, author ids, viewer ids]
+        changes = defaultdict(lambda: [0, set(), set()])
+        posts = db.query(
+            Post.id, Post.creator_id, Post.creation_date).filter(
+            Post.discussion_id == discussion_id,
+            Post.id > watermark.last_post_id)
+        for (post_id, creator_id, creation_date) in posts.yield_per(1000):
+            if not counted_posts.add(post_id):
+                continue
+            change = changes[cls.bucket_start_for(creation_date)]
+            change[0] += 1
+            change[1].add(creator_id)
+        views = db.query(
+            ViewPost.id, ViewPost.actor_id, ViewPost.creation_date).join(
+            Content, Content.id == ViewPost.post_id).filter(
+            Content.discussion_id == discussion_id,
+            ViewPost.id > watermark.last_view_id)
+        for (view_id, actor_id, creation_date) in views.yield_per(1000):
+            if counted_views.add(view_id):
+                changes[cls.bucket_start_for(creation_date)][2].add(actor_id)
+        watermark.advance(counted_posts, counted_views)
+        if not changes:
+            db.flush()
+            return
+        buckets = {}
+        if not is_new:
+            hours = changes.keys()
+            for start in range(0, len(hours), 500):
+                buckets.update({b.bucket_start: b for b in db.query(
+                    cls).filter(
+                    cls.discussion_id == discussion_id,
+                    cls.bucket_start.in_(hours[start:start + 500]))})
+        for hour, (post_count, author_ids, viewer_ids) in changes.iteritems():
+            bucket = buckets.get(hour, None)
+            if bucket is None:
+                bucket = cls(
+                    discussion_id=discussion_id, bucket_start=hour,
+                    post_count=0)
+                db.add(bucket)
+            bucket.post_count += post_count
+            if author_ids:
+                sketch = bucket.post_authors_sketch
+                sketch.update(author_ids)
+                bucket.post_authors_sketch = sketch
+            if viewer_ids:
+                sketch = bucket.post_viewers_sketch
+                sketch.update(viewer_ids)
+                bucket.post_viewers_sketch = sketch
+        db.flush()
+
+    @classmethod
+    def time_series(cls, db, discussion_id, intervals):
+        """Activity statistics for each of a list of consecutive
+        (start, end) intervals, as a list of dicts.
+
+        Posts and views are counted in the interval that contains the
+        start of their hour bucket."""
+        from .auth import AgentStatusInDiscussion
+        cls.refresh(db, discussion_id)
+        buckets = db.query(
+            cls.bucket_start, cls.post_count, cls.post_authors,
+            cls.post_viewers).filter(
+            cls.discussion_id == discussion_id,
+            cls.bucket_start < intervals[-1][1]).order_by(
+            cls.bucket_start).all()
+        statuses = db.query(
+            AgentStatusInDiscussion.first_visit,
+            AgentStatusInDiscussion.last_visit,
+            AgentStatusInDiscussion.first_subscribed,
+            AgentStatusInDiscussion.last_unsubscribed).filter_by(
+            discussion_id=discussion_id).all()
+        # Sorted lists of dates, for range counts by bisection
+        first_visits, last_visits, first_subscribed, last_unsubscribed = [
+            sorted(d for d in dates if d is not None)
+            for dates in zip(*statuses)] if statuses else ([], [], [], [])
+
+        def count_in(dates, start, end):
+            return bisect_left(dates, end) - bisect_left(dates, start)
+
+        cumulative_posts = 0
+        cumulative_authors = HyperLogLog()
+        pos = 0
+        # Everything before the first interval is part of the cumulative data
+        while pos < len(buckets) and buckets[pos][0] < intervals[0][0]:
+            cumulative_posts += buckets[pos][1]
+            cumulative_authors.merge(HyperLogLog.from_bytes(buckets[pos][2]))
+            pos += 1
+        results = []
+        for interval_id, (start, end) in enumerate(intervals, 1):
+            posts = 0
+            authors = HyperLogLog()
+            viewers = HyperLogLog()
+            while pos < len(buckets) and buckets[pos][0] < end:
+                (bucket_start, post_count, post_authors, post_viewers) = \
+                    buckets[pos]
+                posts += post_count
+                authors.merge(HyperLogLog.from_bytes(post_authors))
+                viewers.merge(HyperLogLog.from_bytes(post_viewers))
+                pos += 1
+            cumulative_posts += posts
+            cumulative_authors.merge(authors)
+            count_post_authors = len(authors)
+            count_cumulative_post_authors = len(cumulative_authors)
+            count_cumulative_visitors = bisect_left(first_visits, end)
+            results.append(dict(
+                interval_id=interval_id,
+                interval_start=start,
+                interval_end=end,
+                count_posts=posts,
+                count_post_authors=count_post_authors,
+                count_cumulative_posts=cumulative_posts,
+                count_cumulative_post_authors=count_cumulative_post_authors,
+                UNRELIABLE_count_post_viewers=len(viewers),
+                count_first_time_logged_in_visitors=count_in(
+                    first_visits, start, end),
+                count_cumulative_logged_in_visitors=count_cumulative_visitors,
+                fraction_cumulative_authors_who_posted_in_period=(
+                    float(count_post_authors) / count_cumulative_post_authors
+                    if count_cumulative_post_authors else None),
+                fraction_cumulative_logged_in_visitors_who_posted_in_period=(
+                    float(count_post_authors) / count_cumulative_visitors
+                    if count_cumulative_visitors else None),
+                retention_count_last_visit_in_period=count_in(
+                    last_visits, start, end),
+                recruitment_count_first_visit_in_period=count_in(
+                    first_visits, start, end),
+                UNRELIABLE_recruitment_count_first_subscribed_in_period=count_in(
+                    first_subscribed, start, end),
+                UNRELIABLE_retention_count_first_subscribed_in_period=count_in(
+                    last_unsubscribed, start, end),
+            ))
+        return results
+
+    crud_permissions = CrudPermissions(
+        P_SYSADMIN, P_DISC_STATS, P_SYSADMIN, P_SYSADMIN)
+
+
+class DiscussionActivityWatermark(DiscussionBoundBase):
+    """How far :py:class:`DiscussionActivityBucket` aggregation has gone
+    for a discussion.
+
+    Ids are allocated when a row is inserted, not when it is committed, so
+    a long import or a slow transaction can commit ids lower than some that
+    were already aggregated. All post and view ids up to ``last_post_id``
+    and ``last_view_id`` are settled; ids above them that were aggregated
+    are kept in the ``counted_posts`` and ``counted_views`` bitmaps.
+    On each refresh, the highest ids seen are checkpointed; a checkpoint
+    becomes the settled line once it is older than :py:attr:`settle_delay`,
+    on the assumption that no transaction stays open that long."""
+    __tablename__ = "discussion_activity_watermark"
+
+    settle_delay = timedelta(days=1)
+
+    id = Column(Integer, primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+            "discussion.id", ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, unique=True)
+    discussion = relationship(
+        Discussion, backref=backref(
+            "activity_watermark", cascade="all, delete-orphan"))
+    last_post_id = Column(Integer, nullable=False, default=0)
+    last_view_id = Column(Integer, nullable=False, default=0)
+    counted_posts = deferred(Column(Binary))
+    counted_views = deferred(Column(Binary))
+    checkpoint_post_id = Column(Integer, nullable=False, default=0)
+    checkpoint_view_id = Column(Integer, nullable=False, default=0)
+    checkpoint_date = Column(DateTime)
+
+    @classmethod
+    def get_for_update(cls, db, discussion_id):
+        """The locked watermark of a discussion, created if needed.
+
+        Returns the watermark and whether it was just created."""
+        watermark = db.query(cls).filter_by(
+            discussion_id=discussion_id).with_for_update().first()
+        if watermark is not None:
+            return watermark, False
+        savepoint = db.begin_nested()
+        try:
+            watermark = cls(
+                discussion_id=discussion_id, last_post_id=0, last_view_id=0,
+                checkpoint_post_id=0, checkpoint_view_id=0)
+            db.add(watermark)
+            db.flush()
+            savepoint.commit()
+            return watermark, True
+        except IntegrityError:
+            # A concurrent refresh created it first
+            savepoint.rollback()
+            return db.query(cls).filter_by(
+                discussion_id=discussion_id).with_for_update().one(), False
+
+    def advance(self, counted_posts, counted_views, now=None):
+        """Store the ids counted above the settled line, settling the
+        previous checkpoint if it is old enough."""
+        now = now or datetime.utcnow()
+        if self.checkpoint_date is None or \
+                now - self.checkpoint_date >= self.settle_delay:
+            if self.checkpoint_date is not None:
+                self.last_post_id = max(
+                    self.last_post_id, self.checkpoint_post_id)
+                self.last_view_id = max(
+                    self.last_view_id, self.checkpoint_view_id)
+                counted_posts = IdBitmap(
+                    id for id in counted_posts if id > self.last_post_id)
+                counted_views = IdBitmap(
+                    id for id in counted_views if id > self.last_view_id)
+            self.checkpoint_post_id = max(
+                self.last_post_id, max(counted_posts or [0]))
+            self.checkpoint_view_id = max(
+                self.last_view_id, max(counted_views or [0]))
+            self.checkpoint_date = now
+        self.counted_posts = counted_posts.to_bytes()
+        self.counted_views = counted_views.to_bytes()
+
+    def get_discussion_id(self):
+        return self.discussion_id or self.discussion.id
+
+    @classmethod
+    def get_discussion_conditions(cls, discussion_id, alias_maker=None):
+        return (cls.discussion_id == discussion_id,)
+
+    crud_permissions = CrudPermissions(
+        P_SYSADMIN, P_DISC_STATS, P_SYSADMIN, P_SYSADMIN)
@@ -16,7 +16,7 @@ from sqlalchemy import (
     func
 )
 from ..lib.sqla_types import CoerceUnicode
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, deferred
 
 from datetime import datetime
 from ..lib.sqla import DuplicateHandling
@@ -159,7 +159,32 @@ class File(Document):
                 'document.id', ondelete='CASCADE',
                 onupdate='CASCADE'), primary_key=True)
 
-    data = Column(LargeBinary, nullable=False)
+    # Only for files uploaded before the blob store; see file_sha256
+    data = deferred(Column(LargeBinary))
+
+    # Key of the content in the blob store
+    file_sha256 = Column(String(64), index=True)
+    file_size = Column(Integer)
+
+    def add_file_data(self, stream):
+        "Store the content of a file-like object in the blob store"
+        from ..lib.blob_store import get_blob_store
+        self.file_sha256, self.file_size = get_blob_store().put_stream(stream)
+        self.data = None
+
+    def open_file_data(self):
+        "A readable file-like object for the content"
+        if self.file_sha256:
+            from ..lib.blob_store import get_blob_store
+            return get_blob_store().open(self.file_sha256)
+        from cStringIO import StringIO
+        return StringIO(self.data)
+
+    @property
+    def local_file_path(self):
+        if self.file_sha256:
+            from ..lib.blob_store import get_blob_store
+            return get_blob_store().local_path(self.file_sha256)
 
     @Document.external_url.getter
     def external_url(self):
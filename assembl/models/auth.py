@@ -25,12 +25,15 @@ from sqlalchemy import (
     event,
     Index,
     func,
+    exists,
+    null,
     UniqueConstraint
 )
 from pyramid.httpexceptions import HTTPBadRequest, HTTPUnauthorized
 from sqlalchemy.orm import (
-    relationship, backref, deferred)
+    relationship, backref, deferred, object_session)
 from sqlalchemy.types import Text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.attributes import NO_VALUE
 from sqlalchemy.sql.functions import count
 from pyramid.security import Everyone, Authenticated
@@ -43,7 +46,8 @@ from ..lib import config
 from ..lib.utils import get_global_base_url
 from ..lib.locale import to_posix_string
 from ..lib.sqla import (
-    CrudOperation, get_model_watcher, ObjectNotUniqueError)
+    CrudOperation, get_model_watcher, get_session_maker,
+    ObjectNotUniqueError, record_content_versions)
 from ..lib.sqla_types import (
     URLString, EmailString, EmailUnicode, CaseInsensitiveWord, CoerceUnicode)
 from ..lib.raven_client import capture_message
@@ -219,6 +223,27 @@ class AgentProfile(Base):
                 else:
                     status.agent_profile = self
 
+            my_participation_by_discussion = {
+                p.discussion_id: p for p in self.discussion_participations
+            }
+            for participation in other_profile.discussion_participations[:]:
+                my_participation = my_participation_by_discussion.get(
+                    participation.discussion_id, None)
+                if my_participation is not None:
+                    for flag in DiscussionParticipant.participation_flags:
+                        setattr(my_participation, flag, bool(
+                            getattr(my_participation, flag) or
+                            getattr(participation, flag)))
+                    my_participation.first_activity = minN(
+                        my_participation.first_activity,
+                        participation.first_activity)
+                    my_participation.last_activity = maxN(
+                        my_participation.last_activity,
+                        participation.last_activity)
+                    participation.delete()
+                else:
+                    participation.agent_profile = self
+
 
     def has_permission(self, verb, subject):
         if self is subject.owner:
@@ -614,6 +639,175 @@ def send_user_to_socket_for_asid(mapper, connection, target):
         connection, CrudOperation.UPDATE, target.discussion_id)
 
 
+class DiscussionParticipant(DiscussionBoundBase):
+    """Materialized participation of an agent in a discussion
+
+    One row per (discussion, agent), with a flag for each way of taking part
+    in the discussion. It is maintained by insert listeners on
+    :py:class:`LocalUserRole`, :py:class:`.post.Post`,
+    :py:class:`.idea_content_link.Extract` and :py:class:`.action.ViewPost`,
+    so participant queries do not have to union over those tables."""
+    __tablename__ = 'discussion_participant'
+    __table_args__ = (
+        UniqueConstraint('discussion_id', 'profile_id'), )
+
+    id = Column(Integer, primary_key=True)
+    discussion_id = Column(Integer, ForeignKey(
+            "discussion.id", ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    discussion = relationship(
+        "Discussion", backref=backref(
+            "participations", cascade="all, delete-orphan"))
+    profile_id = Column(Integer, ForeignKey(
+            "agent_profile.id", ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
+    agent_profile = relationship(
+        AgentProfile, backref=backref(
+            "discussion_participations", cascade="all, delete-orphan"))
+    has_role = Column(Boolean, server_default='0', default=False)
+    has_posted = Column(Boolean, server_default='0', default=False)
+    has_extracted = Column(Boolean, server_default='0', default=False)
+    has_read = Column(Boolean, server_default='0', default=False)
+    first_activity = Column(DateTime)
+    last_activity = Column(DateTime)
+
+    participation_flags = (
+        'has_role', 'has_posted', 'has_extracted', 'has_read')
+
+    def get_discussion_id(self):
+        return self.discussion_id or self.discussion.id
+
+    @classmethod
+    def get_discussion_conditions(cls, discussion_id, alias_maker=None):
+        return (cls.discussion_id == discussion_id,)
+
+    def is_owner(self, user_id):
+        return user_id == self.profile_id
+
+    @classmethod
+    def participation_condition(cls, include_readers=False):
+        "The condition for an agent to count as a discussion participant"
+        condition = cls.has_role | cls.has_posted | cls.has_extracted
+        if include_readers:
+            condition = condition | cls.has_read
+        return condition
+
+    @classmethod
+    def record_activity(
+            cls, connection, discussion_id, profile_id, flag, date=None):
+        """Mark an agent as participating in a discussion in a given way.
+
+        Meant to be called from flush listeners, hence works on the
+        connection. Returns whether the flag was newly set."""
+        assert flag in cls.participation_flags
+        date = date or datetime.utcnow()
+        t = cls.__table__
+        select = t.select().where(
+            (t.c.discussion_id == discussion_id) &
+            (t.c.profile_id == profile_id))
+        row = connection.execute(select).first()
+        if row is None:
+            # A concurrent transaction may insert the same row first;
+            # then the insert fails in its savepoint and we update that row.
+            savepoint = connection.begin_nested()
+            try:
+                connection.execute(t.insert().values(
+                    discussion_id=discussion_id, profile_id=profile_id,
+                    first_activity=date, last_activity=date,
+                    **{flag: True}))
+                savepoint.commit()
+                return True
+            except IntegrityError:
+                savepoint.rollback()
+                row = connection.execute(select).first()
+        values = {}
+        if not row[flag]:
+            values[flag] = True
+        if row.first_activity is None or date < row.first_activity:
+            values['first_activity'] = date
+        if row.last_activity is None or date > row.last_activity:
+            values['last_activity'] = date
+        if values:
+            connection.execute(t.update().where(
+                t.c.id == row.id).values(**values))
+        return not row[flag]
+
+    @classmethod
+    def reset_role_flag(cls, connection, discussion_id, profile_id):
+        "Recompute has_role after a local role was removed"
+        lur = LocalUserRole.__table__
+        t = cls.__table__
+        connection.execute(t.update().where(
+            (t.c.discussion_id == discussion_id) &
+            (t.c.profile_id == profile_id)).values(
+                has_role=exists().where(
+                    (lur.c.discussion_id == discussion_id) &
+                    (lur.c.user_id == profile_id))))
+
+    @classmethod
+    def rebuild(cls, db, discussion_id=None):
+        """Repopulate the table from the source tables.
+
+        Used by migrations and to repair the materialization."""
+        from .post import Post
+        from .action import ViewPost
+        from .idea_content_link import Extract
+        from .generic import Content
+        # (flag, query, discussion column); queries return
+        # (discussion_id, profile_id, first_activity, last_activity)
+        sources = [
+            ('has_role', db.query(
+                LocalUserRole.discussion_id, LocalUserRole.user_id,
+                null(), null()).distinct(), LocalUserRole.discussion_id),
+            ('has_posted', db.query(
+                Post.discussion_id, Post.creator_id,
+                func.min(Post.creation_date), func.max(Post.creation_date)
+                ).group_by(Post.discussion_id, Post.creator_id),
+             Post.discussion_id),
+            ('has_extracted', db.query(
+                Extract.discussion_id, Extract.creator_id,
+                func.min(Extract.creation_date),
+                func.max(Extract.creation_date)
+                ).group_by(Extract.discussion_id, Extract.creator_id),
+             Extract.discussion_id),
+            ('has_read', db.query(
+                Content.discussion_id, ViewPost.actor_id,
+                func.min(ViewPost.creation_date),
+                func.max(ViewPost.creation_date)
+                ).join(Content, Content.id == ViewPost.post_id).group_by(
+                Content.discussion_id, ViewPost.actor_id),
+             Content.discussion_id),
+        ]
+        t = cls.__table__
+        if discussion_id is None:
+            db.execute(t.delete())
+        else:
+            db.execute(t.delete().where(t.c.discussion_id == discussion_id))
+        participations = {}
+        for flag, query, discussion_column in sources:
+            if discussion_id is not None:
+                query = query.filter(discussion_column == discussion_id)
+            for (d_id, profile_id, first, last) in query:
+                key = (d_id, profile_id)
+                p = participations.get(key, None)
+                if p is None:
+                    p = participations[key] = dict(
+                        discussion_id=d_id, profile_id=profile_id,
+                        first_activity=first, last_activity=last,
+                        has_role=False, has_posted=False,
+                        has_extracted=False, has_read=False)
+                else:
+                    p['first_activity'] = minN(p['first_activity'], first)
+                    p['last_activity'] = maxN(p['last_activity'], last)
+                p[flag] = True
+        if participations:
+            db.execute(t.insert(), participations.values())
+
+    crud_permissions = CrudPermissions(
+        P_READ, P_ADMIN_DISC, P_ADMIN_DISC, P_ADMIN_DISC,
+        P_READ, P_READ, P_READ)
+
+
 class User(AgentProfile):
     """
     A user of the platform.
@@ -742,6 +936,18 @@ class User(AgentProfile):
                 role.user = self
             for role in other_user.local_roles[:]:
                 role.user = self
+            my_read_states = {
+                rs.discussion_id: rs for rs in self.post_read_states}
+            for read_state in other_user.post_read_states[:]:
+                my_read_state = my_read_states.get(
+                    read_state.discussion_id, None)
+                if my_read_state is not None:
+                    bitmap = my_read_state.bitmap
+                    bitmap.update(read_state.bitmap)
+                    my_read_state.bitmap = bitmap
+                    read_state.delete()
+                else:
+                    read_state.user = self
             for announcement in other_user.announcements_created[:]:
                 announcement.creator = self
             for announcement in other_user.announcements_updated[:]:
@@ -1114,6 +1320,29 @@ class Role(Base):
             db.add(cls(name=role))
 
 
+# The content version that counts changes to roles
+ROLES_VERSION_KEY = "roles"
+
+
+@event.listens_for(Role, 'after_insert', propagate=True)
+@event.listens_for(Role, 'after_update', propagate=True)
+@event.listens_for(Role, 'after_delete', propagate=True)
+def roles_changed(mapper, connection, target):
+    # Only recorded once committed, so a rolled back change is never seen
+    object_session(target).info['roles_changed'] = True
+
+
+@event.listens_for(get_session_maker(), "after_commit")
+def record_roles_version(session):
+    if session.info.pop('roles_changed', False):
+        record_content_versions({ROLES_VERSION_KEY: ()})
+
+
+@event.listens_for(get_session_maker(), "after_rollback")
+def forget_roles_changed(session):
+    session.info.pop('roles_changed', None)
+
+
 class UserRole(Base, PrivateObjectMixin):
     """roles that a user has globally (eg admin.)"""
     __tablename__ = 'user_role'
@@ -1311,6 +1540,18 @@ def send_user_to_socket_for_local_user_role(
         connection, CrudOperation.UPDATE, target.discussion_id, "private")
 
 
+@event.listens_for(LocalUserRole, 'after_insert', propagate=True)
+def record_participation_for_local_user_role(mapper, connection, target):
+    DiscussionParticipant.record_activity(
+        connection, target.get_discussion_id(), target.user_id, 'has_role')
+
+
+@event.listens_for(LocalUserRole, 'after_delete', propagate=True)
+def reset_participation_for_local_user_role(mapper, connection, target):
+    DiscussionParticipant.reset_role_flag(
+        connection, target.get_discussion_id(), target.user_id)
+
+
 class Permission(Base):
     """A permission that a user may have"""
     __tablename__ = 'permission'
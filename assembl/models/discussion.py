@@ -135,21 +135,21 @@ class Discussion(DiscussionBoundBase, NamedClassMixin):
         url = self.check_url_or_none(url)
         self.logo_url = url
 
+    def read_post_bitmap(self, user_id):
+        from .action import PostReadState
+        return PostReadState.get_bitmap(self.db, self.id, user_id)
+
     def read_post_ids(self, user_id):
-        from .post import Post
-        from .action import ViewPost
-        return (x[0] for x in self.db.query(Post.id).join(
-            ViewPost
-        ).filter(
-            Post.discussion_id == self.id,
-            ViewPost.actor_id == user_id,
-            ViewPost.post_id == Post.id
-        ))
+        return iter(self.read_post_bitmap(user_id))
 
     def get_read_posts_ids_preload(self, user_id):
+        """The read posts, as compact ranges of post database ids.
+
+        The client reconstructs URIs with the prefix."""
         from .post import Post
-        return json.dumps([
-            Post.uri_generic(id) for id in self.read_post_ids(user_id)])
+        return json.dumps({
+            "prefix": Post.uri_generic(''),
+            "ranges": self.read_post_bitmap(user_id).as_ranges()})
 
     def import_from_sources(self, only_new=True):
         for source in self.sources:
@@ -631,29 +631,12 @@ class Discussion(DiscussionBoundBase, NamedClassMixin):
         backref="participant_in_discussion")
 
     def get_participants_query(self, ids_only=False, include_readers=False):
-        from .auth import AgentProfile, LocalUserRole
-        from .generic import Content
-        from .post import Post
-        from .action import ViewPost
-        from .idea_content_link import Extract
-
-        query = self.db.query(AgentProfile.id).join(LocalUserRole,
-                LocalUserRole.user_id==AgentProfile.id).filter(
-            LocalUserRole.discussion_id == self.id).union(
-            self.db.query(AgentProfile.id).join(Post,
-                Post.creator_id==AgentProfile.id).filter(
-            Post.discussion_id == self.id)).union(
-            self.db.query(AgentProfile.id).join(
-                Extract, Extract.creator_id==AgentProfile.id).filter(
-            Extract.discussion_id == self.id))
-        query = query.union(self.db.query(AgentProfile.id).join(UserRole,
-                UserRole.user_id==AgentProfile.id))
-        if include_readers:
-            query = query.union(
-                self.db.query(ViewPost.actor_id).join(
-                Content, Content.id==ViewPost.post_id).filter(
-                Content.discussion_id==self.id))
-        query = query.distinct()
+        from .auth import AgentProfile, DiscussionParticipant
+
+        query = self.db.query(DiscussionParticipant.profile_id).filter(
+            DiscussionParticipant.discussion_id == self.id,
+            DiscussionParticipant.participation_condition(include_readers))
+        query = query.union(self.db.query(UserRole.user_id))
         if ids_only:
             return query
         return self.db.query(AgentProfile).filter(AgentProfile.id.in_(query))
@@ -664,6 +647,9 @@ class Discussion(DiscussionBoundBase, NamedClassMixin):
             return (id for (id,) in query.all())
         return query.all()
 
+    def count_participants(self, include_readers=False):
+        return self.get_participants_query(True, include_readers).count()
+
     def get_url(self):
         from assembl.lib.frontend_urls import FrontendUrls
         frontendUrls = FrontendUrls(self)
@@ -679,6 +665,30 @@ class Discussion(DiscussionBoundBase, NamedClassMixin):
         if self.creator:
             return self.creator.get_preferred_email()
 
+    def activity_version(self):
+        """A cheap fingerprint of the discussion's activity, and the date of
+        the latest activity.
+
+        Statistics derived from posts, readers and visitors can be cached
+        for as long as the fingerprint is unchanged."""
+        from .generic import Content
+        from .auth import AgentStatusInDiscussion, DiscussionParticipant
+        content = self.db.query(
+            func.max(Content.id), func.count(Content.tombstone_date)).filter(
+            Content.discussion_id == self.id).subquery()
+        participants = self.db.query(
+            func.max(DiscussionParticipant.last_activity),
+            func.count(DiscussionParticipant.id)).filter(
+            DiscussionParticipant.discussion_id == self.id).subquery()
+        visitors = self.db.query(
+            func.max(AgentStatusInDiscussion.last_visit),
+            func.count(AgentStatusInDiscussion.id)).filter(
+            AgentStatusInDiscussion.discussion_id == self.id).subquery()
+        version = self.db.query(content, participants, visitors).first()
+        last_modified = max(
+            [d for d in (version[2], version[4]) if d is not None] or [None])
+        return ",".join(str(v) for v in version), last_modified
+
     def count_contributions_per_agent(
             self, start_date=None, end_date=None, as_agent=True):
         from .post import Post
@@ -721,7 +731,11 @@ class Discussion(DiscussionBoundBase, NamedClassMixin):
             self, start_date=None, end_date=None, as_agent=True):
         from .post import Post
         from .action import ViewPost
+        from .auth import DiscussionParticipant
         from sqlalchemy.sql.expression import distinct
+        if not (start_date or end_date):
+            return self.db.query(DiscussionParticipant).filter_by(
+                discussion_id=self.id, has_read=True).count()
         query = self.db.query(
             func.count(distinct(ViewPost.actor_id))).join(Post).filter(
                 Post.discussion_id == self.id)
@@ -2,6 +2,7 @@
 
 .. _`Edgesense Drupal module`: https://github.com/Wikitalia/edgesense/tree/master/php/drupal
 """
+from collections import OrderedDict
 from datetime import datetime
 from urlparse import urlparse, urljoin
 import uuid
@@ -14,17 +15,20 @@ from sqlalchemy import (
     Integer,
     String,
     UniqueConstraint,
-    Text
+    Text,
+    and_,
+    bindparam
  )
 import requests
 import simplejson as json
 
-from .langstrings import LangString
-from .generic import PostSource
+from .langstrings import LangString, LangStringEntry, Locale
+from .generic import PostSource, Content
 from .post import ImportedPost
-from .auth import AbstractAgentAccount, AgentProfile
+from .auth import AbstractAgentAccount, AgentProfile, DiscussionParticipant
 from ..tasks.source_reader import PullSourceReader
 from ..lib import config
+from ..lib.sqla import reserve_ids, CrudOperation
 from ..lib.sqla_types import URLString
 from ..lib.locale import get_localizer, _
 
@@ -306,6 +310,10 @@ class EdgeSenseFetcher(object):
 class EdgeSenseParser(object):
     # In the parsing process, ALWAYS parse the USERS FIRST, because they will
     # be queried to get their agent-profile
+
+    # How many bulk written objects are loaded at once to send their changes
+    CHANGES_CHUNK_SIZE = 500
+
     def __init__(self, source, fetcher=None):
         self.source = source
         self.session = source.db
@@ -590,6 +598,286 @@ class EdgeSenseParser(object):
         self._process_comment_threading(posts_db)
         self.session.commit()
 
+    def _fetched_posts(self):
+        """The fetched nodes and comments which have an author, by
+        source_post_id, as (class, json, content, body, parent
+        source_post_id) tuples, nodes first."""
+        posts = OrderedDict()
+        for node in self.nodes:
+            nde = node['node']
+            nid = EdgeSenseSpecificPost.create_nid(nde)
+            if 'uid' in nde and nid not in posts:
+                posts[nid] = (EdgeSenseNode, node, nde, nde.get('Body'), None)
+        for comment in self.comments:
+            comm = comment['comment']
+            if 'uid' not in comm or comm['cid'] in posts:
+                continue
+            if int(comm['pid']) == 0:
+                # Node nid is the parent
+                parent_id = 'nid_' + comm['nid']
+            else:
+                parent_id = comm['pid']
+            posts[comm['cid']] = (
+                EdgeSenseComment, comment, comm, comm.get('Comment'),
+                parent_id)
+        return posts
+
+    def _bulk_import_users(self, user_ids, reimport):
+        """Insert the missing accounts with their profiles, update the
+        others on reimport. Returns {user_id: (account id, profile id)},
+        and the ids of the profiles which changed."""
+        source = self.source
+        accounts = {
+            user_id: (id, profile_id) for (user_id, id, profile_id) in
+            self.session.query(
+                SourceSpecificAccount.user_id, SourceSpecificAccount.id,
+                SourceSpecificAccount.profile_id).filter(
+                SourceSpecificAccount.source_id == source.id)}
+        new_user_ids = [x for x in user_ids if x not in accounts]
+        profile_ids = reserve_ids(
+            self.session, AgentProfile.__table__.c.id, len(new_user_ids))
+        account_ids = reserve_ids(
+            self.session, AbstractAgentAccount.__table__.c.id,
+            len(new_user_ids))
+        profiles = []
+        new_accounts = []
+        for user_id, profile_id, account_id in zip(
+                new_user_ids, profile_ids, account_ids):
+            user = self.users.get(user_id, None)
+            cls = SourceSpecificAccount
+            if not user:
+                # Simplification:
+                # There is a user that is created with a user that
+                # does not exist in the users.json db
+                user = {"user": {"uid": user_id, "name": None}}
+                cls = SourceSpecificUnknownAccount
+            profiles.append(dict(
+                id=profile_id,
+                type=AgentProfile.__mapper__.polymorphic_identity,
+                name=user['user']['name']))
+            new_accounts.append(dict(
+                id=account_id, type=cls.__mapper__.polymorphic_identity,
+                profile_id=profile_id, user_id=user_id,
+                user_link=u"https://edgeryders.eu/user/%s" % user_id,
+                user_info=json.dumps(user), source_id=source.id))
+            accounts[user_id] = (account_id, profile_id)
+        self.session.bulk_insert_mappings(AgentProfile, profiles)
+        self.session.bulk_insert_mappings(SourceSpecificAccount, new_accounts)
+        if reimport:
+            # If a user is not in the fetched users (for whatever reason),
+            # then retain the old data.
+            new_user_ids = set(new_user_ids)
+            updated = [x for x in user_ids
+                       if x not in new_user_ids and x in self.users]
+            self.session.bulk_update_mappings(SourceSpecificAccount, [dict(
+                id=accounts[user_id][0],
+                user_info=json.dumps(self.users[user_id]),
+                user_link=u"https://edgeryders.eu/user/%s" % user_id)
+                for user_id in updated])
+            self.session.bulk_update_mappings(AgentProfile, [dict(
+                id=accounts[user_id][1],
+                name=self.users[user_id]['user'].get('name'))
+                for user_id in updated])
+            profile_ids.extend(accounts[user_id][1] for user_id in updated)
+        return accounts, profile_ids
+
+    def bulk_import(self, reimport=False):
+        """Import (or re-import) with bulk statements.
+
+        The fetched users, nodes and comments are staged in lists, with ids
+        drawn from the sequences, the parent links and ancestries of all
+        the posts of the source are computed in memory, then each kind of
+        row is inserted or updated with a single executemany. Existing
+        posts are only updated on reimport.
+        On Virtuoso, uses :py:meth:`parse` or :py:meth:`re_import`."""
+        if self.source.using_virtuoso:
+            return self.re_import() if reimport else self.parse()
+        self._setup()
+        if not self.nodes:
+            raise ValueError('There are no nodes to parse')
+        if not self.comments:
+            raise ValueError('There are no comments to parse')
+        session = self.session
+        source = self.source
+        fetched = self._fetched_posts()
+        accounts, changed_profile_ids = self._bulk_import_users(
+            OrderedDict.fromkeys(
+                fetched_post[2]['uid'] for fetched_post
+                in fetched.itervalues()).keys(), reimport)
+
+        existing = {
+            source_post_id: (id, body_id, parent_id, ancestry)
+            for (source_post_id, id, body_id, parent_id, ancestry)
+            in session.query(
+                SourceSpecificPost.source_post_id, SourceSpecificPost.id,
+                SourceSpecificPost.body_id, SourceSpecificPost.parent_id,
+                SourceSpecificPost.ancestry).filter(
+                SourceSpecificPost.source_id == source.id)}
+        new_source_post_ids = [x for x in fetched if x not in existing]
+        count = len(new_source_post_ids)
+        new_ids = dict(zip(new_source_post_ids, zip(
+            reserve_ids(session, Content.__table__.c.id, count),
+            reserve_ids(session, LangString.__table__.c.id, count),
+            reserve_ids(session, LangStringEntry.__table__.c.id, count))))
+        post_ids = {x: y[0] for (x, y) in existing.iteritems()}
+        post_ids.update({x: y[0] for (x, y) in new_ids.iteritems()})
+
+        # Parent links and ancestry of all the posts of the source
+        parents = {id: parent_id for (id, body_id, parent_id, ancestry)
+                   in existing.itervalues()}
+        for source_post_id, fetched_post in fetched.iteritems():
+            parent_id = post_ids.get(fetched_post[4], None)
+            if parent_id is not None or source_post_id in new_ids:
+                parents[post_ids[source_post_id]] = parent_id
+        ancestries = compute_ancestries(parents)
+
+        now = datetime.utcnow()
+        und_id = Locale.get_id_of(Locale.UNDEFINED)
+        new_posts = []
+        langstrings = []
+        entries = []
+        updated_posts = []
+        updated_bodies = []
+        for source_post_id, (cls, blob, content, body, parent) in \
+                fetched.iteritems():
+            id = post_ids[source_post_id]
+            values = dict(
+                import_date=now,
+                source_post_id=source_post_id,
+                message_id=source.generate_message_id(source_post_id),
+                discussion_id=source.discussion_id,
+                creator_id=accounts[content['uid']][1],
+                body_mime_type='text/plain',
+                creation_date=datetime.fromtimestamp(int(content['created'])))
+            body = cls.process_body(body, source.node_root)
+            if source_post_id in new_ids:
+                (id, body_id, entry_id) = new_ids[source_post_id]
+                langstrings.append(dict(id=body_id))
+                entries.append(dict(
+                    id=entry_id, langstring_id=body_id, locale_id=und_id,
+                    value=body))
+                values.update(
+                    id=id, type=cls.__mapper__.polymorphic_identity,
+                    source_id=source.id, body_id=body_id,
+                    imported_blob=json.dumps(blob),
+                    parent_id=parents.get(id, None),
+                    ancestry=ancestries.get(id, ''))
+                new_posts.append(values)
+            elif reimport:
+                values['id'] = id
+                updated_posts.append(values)
+                updated_bodies.append(dict(
+                    b_langstring_id=existing[source_post_id][1],
+                    b_locale_id=und_id, b_value=body))
+        # Parents must be inserted before their children
+        new_posts.sort(key=lambda post: post['ancestry'].count(','))
+        for (id, body_id, parent_id, ancestry) in existing.itervalues():
+            if id in ancestries and (parents[id], ancestries[id]) != (
+                    parent_id, ancestry):
+                updated_posts.append(dict(
+                    id=id, parent_id=parents[id], ancestry=ancestries[id]))
+
+        session.bulk_insert_mappings(LangString, langstrings)
+        session.bulk_insert_mappings(LangStringEntry, entries)
+        session.bulk_insert_mappings(EdgeSenseSpecificPost, new_posts)
+        session.bulk_update_mappings(EdgeSenseSpecificPost, updated_posts)
+        if updated_bodies:
+            entry_table = LangStringEntry.__table__
+            session.execute(entry_table.update().where(and_(
+                entry_table.c.langstring_id == bindparam('b_langstring_id'),
+                entry_table.c.locale_id == bindparam('b_locale_id'))).values(
+                value=bindparam('b_value')), updated_bodies)
+        new_participant_ids = self._bulk_record_participation(new_posts)
+        self._send_bulk_changes(
+            [post['id'] for post in new_posts],
+            [post['id'] for post in updated_posts],
+            changed_profile_ids, new_participant_ids)
+        session.commit()
+
+    def _send_bulk_changes(
+            self, new_post_ids, updated_post_ids, profile_ids,
+            new_participant_ids):
+        """Bulk statements do not go through the ORM listeners. Queue what
+        they would send to the changes socket: the posts, the changed
+        profiles, and the root idea, whose post counts changed. The commit
+        sends them and records the content versions.
+        Sending the new posts as created tells the model watcher."""
+        session = self.session
+        connection = session.connection()
+        discussion_id = self.source.discussion_id
+        new_post_ids = set(new_post_ids)
+        post_ids = list(new_post_ids) + updated_post_ids
+        for start in range(0, len(post_ids), self.CHANGES_CHUNK_SIZE):
+            for post in session.query(EdgeSenseSpecificPost).filter(
+                    EdgeSenseSpecificPost.id.in_(
+                        post_ids[start:start + self.CHANGES_CHUNK_SIZE])):
+                post.send_to_changes(
+                    connection, CrudOperation.CREATE
+                    if post.id in new_post_ids else CrudOperation.UPDATE)
+        # New participants also change the participants of the discussion
+        new_participant_ids = set(new_participant_ids)
+        profile_ids = list(new_participant_ids.union(profile_ids))
+        for start in range(0, len(profile_ids), self.CHANGES_CHUNK_SIZE):
+            for profile in session.query(AgentProfile).filter(
+                    AgentProfile.id.in_(
+                        profile_ids[start:start + self.CHANGES_CHUNK_SIZE])):
+                profile.send_to_changes(
+                    connection, CrudOperation.UPDATE,
+                    discussion_id if profile.id in new_participant_ids
+                    else None)
+        root_idea = self.source.discussion.root_idea
+        if new_post_ids and root_idea:
+            root_idea.send_to_changes(connection)
+
+    def _bulk_record_participation(self, new_posts):
+        """Mark the authors of bulk inserted posts as having posted, as
+        :py:func:`assembl.models.post.orm_insert_listener` would.
+        Returns the ids of the authors who had not posted before."""
+        dates = {}
+        for post in new_posts:
+            first, last = dates.get(post['creator_id'], (None, None))
+            date = post['creation_date']
+            dates[post['creator_id']] = (
+                min(first or date, date), max(last or date, date))
+        connection = self.session.connection()
+        discussion_id = self.source.discussion_id
+        new_participant_ids = []
+        for profile_id, (first, last) in dates.iteritems():
+            if DiscussionParticipant.record_activity(
+                    connection, discussion_id, profile_id, 'has_posted',
+                    first):
+                new_participant_ids.append(profile_id)
+            if last != first:
+                DiscussionParticipant.record_activity(
+                    connection, discussion_id, profile_id, 'has_posted',
+                    last)
+        return new_participant_ids
+
+
+def compute_ancestries(parents):
+    """The ancestry strings of posts, from a {post id: parent id} dict.
+
+    Posts whose parent is not in the dict, or that are in a cycle,
+    are left out."""
+    ancestries = {}
+    for post_id in parents:
+        path = []
+        seen = set()
+        current = post_id
+        while current is not None and current not in ancestries:
+            if current not in parents or current in seen:
+                break
+            path.append(current)
+            seen.add(current)
+            current = parents[current]
+        else:
+            prefix = '' if current is None else "%s%d," % (
+                ancestries[current], current)
+            for ancestor_id in reversed(path):
+                ancestries[ancestor_id] = prefix
+                prefix = "%s%d," % (prefix, ancestor_id)
+    return ancestries
+
 
 class EdgeSenseReader(PullSourceReader):
     def setup(self):
@@ -597,7 +885,7 @@ class EdgeSenseReader(PullSourceReader):
         self.parser = EdgeSenseParser(self.source)
 
     def do_read(self):
-        self.parser.parse()
+        self.parser.bulk_import()
 
     def re_import(self):
-        self.parser.re_import()
+        self.parser.bulk_import(reimport=True)
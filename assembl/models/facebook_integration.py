@@ -2,8 +2,12 @@
 from abc import abstractmethod
 from collections import defaultdict
 from datetime import datetime, timedelta
+from itertools import chain, takewhile
+from multiprocessing.pool import ThreadPool
+from urllib import urlencode
 from urlparse import urlparse, parse_qs
 import logging
+import re
 
 import facebook
 from sqlalchemy import (
@@ -45,6 +49,14 @@ log = logging.getLogger('assembl')
 API_VERSION_USED = 2.2
 DEFAULT_TIMEOUT = 30  # seconds
 DOMAIN = 'facebook.com'
+# The Graph API accepts at most 50 requests in a batch
+BATCH_SIZE = 50
+DEFAULT_BATCH_WORKERS = 4
+PAGE_LIMIT = 100
+POST_FIELDS = ('id,from,to,message,story,created_time,message_tags,'
+               'attachments')
+COMMENT_FIELDS = 'id,from,message,created_time,message_tags,attachment'
+VERSION_PREFIX_RE = re.compile(r'^v\d+\.\d+/')
 
 
 facebook_sdk_locales = defaultdict(set)
@@ -336,6 +348,121 @@ class FacebookParser(object):
             for page_post in self._get_next_posts_page(object_id, page):
                 for post in page_post:
                     yield post
+
+    # ----------------------------- batches -----------------------------------
+    def expanded_post_fields(self):
+        "Post fields, with comments, sub-comments and attachments expanded"
+        return "%s,comments.limit(%d){%s}" % (
+            POST_FIELDS, PAGE_LIMIT, self.expanded_comment_fields())
+
+    def expanded_comment_fields(self):
+        "Comment fields, with sub-comments expanded"
+        return "%s,comments.limit(%d){%s}" % (
+            COMMENT_FIELDS, PAGE_LIMIT, COMMENT_FIELDS)
+
+    def get_expanded_pages(self, object_id, endpoint='feed'):
+        """The pages of posts of a feed or posts edge, each post with its
+        first page of comments, sub-comments and attachments.
+        Use :py:meth:`complete_comments` for the remaining comments."""
+        args = {'fields': self.expanded_post_fields(), 'limit': PAGE_LIMIT}
+        while True:
+            resp = self.api.get_connections(object_id, endpoint, **args)
+            if 'error' in resp:
+                log.warning("Getting facebook %s %s with args %s yielded \
+                            an error: %s", endpoint,
+                            object_id, json.dumps(args), json.dumps(resp))
+                return
+            posts = resp.get('data', [])
+            if not posts:
+                return
+            yield posts
+            next_page = resp.get('paging', {}).get('next', None)
+            if not next_page:
+                return
+            args = {k: v[0] for (k, v) in self._get_query_from_url(
+                next_page).iteritems() if k != 'access_token'}
+
+    def _relative_url(self, page, fields):
+        # The paging urls are absolute and carry the access token;
+        # batched requests use the path (without version) and cursor.
+        parse = urlparse(page)
+        path = VERSION_PREFIX_RE.sub('', parse.path.lstrip('/'))
+        args = {k: v[0] for (k, v) in parse_qs(parse.query).iteritems()
+                if k not in ('access_token', 'fields')}
+        args['fields'] = fields
+        return "%s?%s" % (path, urlencode(args))
+
+    def _batch_request(self, relative_urls):
+        batch = [{'method': 'GET', 'relative_url': url}
+                 for url in relative_urls]
+        try:
+            responses = self.api.request(
+                '', post_args={'batch': json.dumps(batch)})
+        except facebook.GraphAPIError as e:
+            log.warning("Facebook batch request failed: %s", e)
+            return [None] * len(relative_urls)
+        results = []
+        for url, response in zip(relative_urls, responses):
+            if not response or response.get('code') != 200:
+                log.warning("Getting facebook %s in a batch yielded \
+                            an error: %s", url, json.dumps(response))
+                results.append(None)
+            else:
+                results.append(json.loads(response['body']))
+        return results
+
+    def batch_get(self, relative_urls):
+        """GET Graph API paths with batch requests, of up to BATCH_SIZE
+        requests each, sent concurrently by at most
+        ``facebook.batch_workers`` threads.
+
+        Returns the decoded responses, in order, or None for failures."""
+        chunks = [relative_urls[i:i + BATCH_SIZE]
+                  for i in range(0, len(relative_urls), BATCH_SIZE)]
+        if len(chunks) < 2:
+            return list(chain.from_iterable(
+                self._batch_request(chunk) for chunk in chunks))
+        workers = int(get_config().get(
+            'facebook.batch_workers', None) or DEFAULT_BATCH_WORKERS)
+        pool = ThreadPool(min(workers, len(chunks)))
+        try:
+            return list(chain.from_iterable(
+                pool.map(self._batch_request, chunks)))
+        finally:
+            pool.close()
+
+    def complete_comments(self, posts):
+        """Fetch the remaining pages of comments of the posts, then of
+        sub-comments of their comments, in batches, and add them to the
+        post (or comment) json, so all comments are in ``comments.data``."""
+        self._complete_edges(posts, self.expanded_comment_fields())
+        comments = list(chain.from_iterable(
+            post.get('comments', {}).get('data', []) for post in posts))
+        self._complete_edges(comments, COMMENT_FIELDS)
+
+    def _complete_edges(self, objects, fields):
+        pending = [obj for obj in objects
+                   if obj.get('comments', {}).get('paging', {}).get('next')]
+        while pending:
+            pages = self.batch_get([
+                self._relative_url(obj['comments']['paging']['next'], fields)
+                for obj in pending])
+            next_pending = []
+            for obj, page in zip(pending, pages):
+                comments = obj['comments']
+                comments.pop('paging')
+                if not page or not page.get('data'):
+                    continue
+                comments['data'].extend(page['data'])
+                if page.get('paging', {}).get('next'):
+                    comments['paging'] = page['paging']
+                    next_pending.append(obj)
+            pending = next_pending
+
+    def get_comments_expanded(self, obj):
+        "The comments of a post or comment completed by complete_comments"
+        return obj.get('comments', {}).get('data', [])
+
     # -------------------------------------------------------------------------
 
     def get_app_id(self):
@@ -431,6 +558,17 @@ class FacebookParser(object):
         resp = self.api.get_object(comment_id, **kwarg)
         return resp.get('attachment', None)
 
+    def get_expanded_post_attachment(self, post):
+        "The first attachment of a post fetched with expanded fields"
+        data = post.get('attachments', {}).get('data', None)
+        if data:
+            return data[0]
+        return None
+
+    def get_expanded_comment_attachment(self, comment):
+        "The attachment of a comment fetched with expanded fields"
+        return comment.get('attachment', None)
+
     def parse_attachment_url(self, url):
         try:
             qs = parse_qs(urlparse(url).query)
@@ -604,18 +742,21 @@ class FacebookGenericSource(PostSource):
             filter_by(discussion=self.discussion).all()
         return results
 
+    def _new_fb_user(self, user):
+        # avatar_url = self.parser.get_user_profile_photo(user)
+        userid = user.get('id')
+        return SocialAuthAccount(
+            profile=user,
+            identity_provider=self.provider,
+            full_name=user.get("name"),
+            userid=userid,
+            provider_domain=self.parser.get_app_id(),
+            picture_url='http://graph.facebook.com/%s/picture' % (userid,)
+        )
+
     def _create_fb_user(self, user, db):
         if user['id'] not in db:
-            # avatar_url = self.parser.get_user_profile_photo(user)
-            userid = user.get('id')
-            new_user = SocialAuthAccount(
-                profile=user,
-                identity_provider=self.provider,
-                full_name=user.get("name"),
-                userid=userid,
-                provider_domain=self.parser.get_app_id(),
-                picture_url='http://graph.facebook.com/%s/picture' % (userid,)
-            )
+            new_user = self._new_fb_user(user)
             self.db.add(new_user)
             self.db.flush()
             db[user['id']] = new_user
@@ -874,6 +1015,111 @@ class FacebookGenericSource(PostSource):
                 if self.read_status == ReaderStatus.SHUTDOWN:
                     break
 
+    def _in_bounds(self, post, upper, lower):
+        post_created_time = parse_datetime(post.get('created_time'))
+        if upper and post_created_time > upper:
+            return False
+        if lower and post_created_time < lower:
+            return False
+        return True
+
+    def _import_expanded_pages(self, pages, obj_id, posts_db, users_db,
+                               upper, lower, reimport=False):
+        """Import pages of posts fetched with their comments and attachments
+        expanded (see :py:meth:`FacebookParser.get_expanded_pages`).
+
+        The remaining comments of a page are fetched in batches, then its
+        users and posts are created or updated in bulk, with one commit
+        per page. Stops at the first post outside of the bounds."""
+        upper = upper or self.upper_bound
+        lower = lower or self.lower_bound
+        for posts in pages:
+            in_bounds = list(takewhile(
+                lambda post: self._in_bounds(post, upper, lower), posts))
+            if in_bounds:
+                self.parser.complete_comments(in_bounds)
+                self._bulk_import(in_bounds, obj_id, posts_db, users_db,
+                                  reimport)
+            if len(in_bounds) < len(posts):
+                # A bound is reached
+                break
+            if self.read_status == ReaderStatus.SHUTDOWN:
+                break
+
+    def _bulk_import(self, posts, obj_id, posts_db, users_db,
+                     reimport=False):
+        """Create or update the users, posts and comments of expanded posts,
+        flushing new users, then new posts, at once."""
+        from ..tasks.translate import translate_content
+        parser = self.parser
+        # (json, parent json, expanded attachment getter), parents first
+        entries = []
+        users = {}
+        for post in posts:
+            entries.append(
+                (post, None, parser.get_expanded_post_attachment))
+            for user in chain(
+                    [parser.get_user_post_creator(post)],
+                    parser.get_users_post_to_sans_self(post, obj_id)):
+                users[user['id']] = user
+            for comment in parser.get_comments_expanded(post):
+                entries.append(
+                    (comment, post, parser.get_expanded_comment_attachment))
+                for sub_comment in parser.get_comments_expanded(comment):
+                    entries.append((sub_comment, comment,
+                                    parser.get_expanded_comment_attachment))
+        for data, parent, getter in entries:
+            if parent is not None:
+                for user in chain([parser.get_user_from_comment(data)],
+                                  parser.get_users_from_mention(data)):
+                    users[user['id']] = user
+
+        new_users = []
+        for user_id, user in users.iteritems():
+            account = users_db.get(user_id, None)
+            if account is None:
+                account = self._new_fb_user(user)
+                new_users.append(account)
+                users_db[user_id] = account
+            elif reimport:
+                account.update_fields(user)
+        self.db.add_all(new_users)
+        self.db.flush()
+
+        new_posts = []
+        assembl_posts = []
+        for data, parent, getter in entries:
+            post_id = data.get('id')
+            creator = users_db.get(data.get('from', {}).get('id'))
+            # The expanded comments are imported as posts of their own
+            imported = dict(data)
+            imported.pop('comments', None)
+            assembl_post = posts_db.get(post_id, None)
+            if assembl_post is None:
+                assembl_post = FacebookPost.create(self, imported, creator)
+                if not assembl_post:
+                    continue
+                new_posts.append(assembl_post)
+                posts_db[post_id] = assembl_post
+            elif reimport:
+                assembl_post.update_fields(imported, creator)
+            assembl_posts.append((data, parent, getter, assembl_post))
+        self.db.add_all(new_posts)
+        self.db.flush()
+
+        for data, parent, getter, assembl_post in assembl_posts:
+            if parent is not None:
+                parent_post = posts_db.get(parent.get('id'), None)
+                if parent_post is not None:
+                    assembl_post.set_parent(parent_post)
+            self._create_or_update_attachment(
+                data, assembl_post, reimport,
+                lambda post_id, data=data, getter=getter: getter(data))
+            translate_content(assembl_post)  # should delay
+        self.db.commit()
+        # Refresh the instance
+        self.db.query(self.__class__).populate_existing().get(self.id)
+
     def feed(self, upper_bound=None, lower_bound=None, reimport=False):
         users_db = self._get_current_users()
         posts_db = self._get_current_posts()
@@ -886,56 +1132,19 @@ class FacebookGenericSource(PostSource):
             reimport
         )
 
-        for post in self.parser.get_feed_paginated(self.fb_source_id):
-            assembl_post, cont = self._manage_post(post, self.fb_source_id,
-                                                   posts_db, users_db,
-                                                   upper_bound,
-                                                   lower_bound,
-                                                   reimport=reimport
-                                                   )
-
-            if not assembl_post:
-                # If a bound is reached, there is no post created, so do
-                # not continue any further
-                if not cont:
-                    break
-                continue
+        self._import_expanded_pages(
+            self.parser.get_expanded_pages(self.fb_source_id, 'feed'),
+            self.fb_source_id, posts_db, users_db,
+            upper_bound, lower_bound, reimport=reimport)
 
-            if self.read_status == ReaderStatus.SHUTDOWN:
-                break
-            for comment in self.parser.get_comments_paginated(post):
-                self._manage_comment_subcomments(comment, assembl_post,
-                                                 posts_db, users_db,
-                                                 reimport=reimport,
-                                                 sub_comments=True)
-                if self.read_status == ReaderStatus.SHUTDOWN:
-                    return
-
-    def posts(self, upper=None, lower=None, reimport=False):
+    def posts(self, upper_bound=None, lower_bound=None, reimport=False):
         users_db = self._get_current_users()
         posts_db = self._get_current_posts()
 
-        for post in self.parser.get_posts_paginated(self.fb_source_id):
-            assembl_post, cont = self._manage_post(post, self.fb_source_id,
-                                                   posts_db, users_db,
-                                                   upper, lower,
-                                                   reimport=reimport)
-            if not assembl_post:
-                # If a bound is reached, there is no post created, so do
-                # not continue any further
-                if not cont:
-                    break
-                continue
-
-            if self.read_status == ReaderStatus.SHUTDOWN:
-                break
-            for comment in self.parser.get_comments_paginated(post):
-                self._manage_comment_subcomments(comment, assembl_post,
-                                                 posts_db, users_db,
-                                                 reimport=reimport,
-                                                 sub_comments=True)
-                if self.read_status == ReaderStatus.SHUTDOWN:
-                    return
+        self._import_expanded_pages(
+            self.parser.get_expanded_pages(self.fb_source_id, 'posts'),
+            self.fb_source_id, posts_db, users_db,
+            upper_bound, lower_bound, reimport=reimport)
 
     def single_post(self, upper_bound=None, lower_bound=None,
                     reimport=False):
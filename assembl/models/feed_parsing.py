@@ -29,18 +29,47 @@ class FeedFetcher(object):
     web resource address, returning either as a string object (which is the
     preferred method for feedparser) or as a StringIO object (which is what
     speedparser likes)
+
+    Conditional requests use the ETag and Last-Modified validators of the
+    last conditional response, and return None if the feed is unchanged.
     """
 
-    def return_string(self, uri):
+    chunk_size = 1 << 16
+
+    def __init__(self, etag=None, last_modified=None):
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def get(self, uri, conditional=False):
+        headers = {}
+        if conditional:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+        resp = requests.get(uri, headers=headers, stream=True)
+        if resp.status_code == 304:
+            resp.close()
+            return None
+        if conditional:
+            self.etag = resp.headers.get('ETag', None)
+            self.last_modified = resp.headers.get('Last-Modified', None)
+        return resp
+
+    def return_string(self, uri, conditional=False):
         """Returns the string content with the xml inside"""
-        resp = requests.get(uri)
-        return resp.content
+        resp = self.get(uri, conditional)
+        if resp is not None:
+            return resp.content
 
-    def return_file(self, uri):
+    def return_file(self, uri, conditional=False):
         """Returns a StringIO with the xml inside"""
+        resp = self.get(uri, conditional)
+        if resp is None:
+            return None
         output = StringIO()
-        resp = requests.get(uri)
-        output.write(resp.content)
+        for chunk in resp.iter_content(self.chunk_size):
+            output.write(chunk)
         return output
 
 
@@ -55,11 +84,14 @@ class ParserWrapper(object):
         self.parser = parser
         self.parser_can_read_file = parser_can_read_file
 
-    def parse(self, uri):
+    def parse(self, uri, conditional=False):
+        """The parsed feed, or None if conditional and unchanged"""
         if self.parser_can_read_file:
-            return self.parser.parse(self.fetcher.return_file(uri))
+            data = self.fetcher.return_file(uri, conditional)
         else:
-            return self.parser.parse(self.fetcher.return_string(uri))
+            data = self.fetcher.return_string(uri, conditional)
+        if data is not None:
+            return self.parser.parse(data)
 
 
 class ParsedData(object):
@@ -108,6 +140,26 @@ class ParsedData(object):
         self._fetch_source()
         return iter(self.get_parsed_feed()['entries'])
 
+    @property
+    def validators(self):
+        """The (ETag, Last-Modified) of the last conditional fetch"""
+        fetcher = self._parse_agent.fetcher
+        return (fetcher.etag, fetcher.last_modified)
+
+    @validators.setter
+    def validators(self, validators):
+        fetcher = self._parse_agent.fetcher
+        (fetcher.etag, fetcher.last_modified) = validators
+
+    def get_entry_pages(self, conditional=False):
+        """The entries, as a list per page, newest first.
+
+        If conditional, nothing is fetched past an unchanged feed."""
+        feed = self._parse_agent.parse(self.url, conditional)
+        if feed is not None:
+            self._feed = feed
+            yield list(feed['entries'])
+
 
 class PaginatedParsedData(ParsedData):
     """
@@ -161,6 +213,18 @@ class PaginatedParsedData(ParsedData):
             for entry in self._get_entry_per_feed(feed):
                 yield entry
 
+    def get_entry_pages(self, conditional=False):
+        """The entries, as a list per page, fetched as they are consumed.
+
+        If conditional, only the first page is fetched conditionally;
+        pagination stops there if it is unchanged."""
+        for page, url in enumerate(self._update_url()):
+            feed = self._parse_agent.parse(url, conditional and page == 0)
+            if feed is None or feed['entries'] == []:
+                break
+            self._feed = feed
+            yield list(self._get_entry_per_feed(feed))
+
 
 class FeedPost(ImportedPost):
     """
@@ -235,6 +299,10 @@ class FeedPostSource(PostSource):
     # For parameter free calling to parse posts from this source.
     parser_full_class_name = Column(String(512), nullable=False)
 
+    # HTTP validators of the last read, for conditional requests
+    http_etag = Column(String(512))
+    http_last_modified = Column(String(64))
+
     __mapper_args__ = {
         'polymorphic_identity': 'feed_posts_source'
     }
@@ -352,19 +420,59 @@ class FeedSourceReader(PullSourceReader):
                 user_desc if not None else user.profile.description
 
     def _add_entries(self):
-        for post, account in self._generate_post_stream():
+        """Import the new entries, page by page.
+
+        Stops at the first page without new entries, as older pages are
+        known as well, and does not fetch anything past an unchanged feed.
+        """
+        self._check_parser_loaded()
+        self._parse_agent.validators = (
+            self.source.http_etag, self.source.http_last_modified)
+        for entries in self._parse_agent.get_entry_pages(conditional=True):
+            entries = self._new_entries(entries)
+            if not entries:
+                break
             try:
-                if not account.find_duplicate(True, True):
-                    self.source.db.add(account)
-                if not post.find_duplicate(True, True):
+                posts = []
+                for post, account in self._generate_post_stream(entries):
+                    if not account.find_duplicate(True, True):
+                        self.source.db.add(account)
+                        # so later entries by the same author find it
+                        self.source.db.flush()
                     self.source.db.add(post)
+                    posts.append(post)
                 self.source.db.commit()
-                self.handle_new_content(post)
+                for post in posts:
+                    self.handle_new_content(post)
             except Exception as e:
                 self.source.db.rollback()
                 raise ReaderError(e)
             finally:
                 self.source = FeedPostSource.get(self.source_id)
+            if self.status != ReaderStatus.READING:
+                return
+        # Only remember the validators once everything was imported
+        (self.source.http_etag, self.source.http_last_modified) = \
+            self._parse_agent.validators
+        self.source.db.commit()
+
+    def _new_entries(self, entries):
+        """The entries whose posts were not imported yet"""
+        entry_ids = list({self._get_entry_id(entry) for entry in entries})
+        cls = self.source.post_type
+        known = set()
+        for start in range(0, len(entry_ids), 500):
+            known.update(id for (id,) in self.source.db.query(
+                cls.source_post_id).filter(
+                cls.source_id == self.source_id,
+                cls.source_post_id.in_(entry_ids[start:start + 500])))
+        new_entries = []
+        for entry in entries:
+            entry_id = self._get_entry_id(entry)
+            if entry_id not in known:
+                known.add(entry_id)
+                new_entries.append(entry)
+        return new_entries
 
     def _check_parser_loaded(self):
         if not self._parse_agent:
@@ -380,9 +488,11 @@ class FeedSourceReader(PullSourceReader):
         agent_profile = AgentProfile(name=author_name)
         return self.source.user_type(user_link=author_link, profile=agent_profile)
 
-    def _generate_post_stream(self):
+    def _generate_post_stream(self, entries=None):
         self._check_parser_loaded()
-        for entry in self._parse_agent.get_entries():
+        if entries is None:
+            entries = self._parse_agent.get_entries()
+        for entry in entries:
             account = self._create_account_from_entry(entry)
             account = account.get_unique_from_db()
             yield self._convert_to_post(entry, account), account
@@ -13,7 +13,6 @@ from sqlalchemy.orm import (
     relationship, backref, aliased, contains_eager, joinedload, deferred,
     column_property, with_polymorphic)
 from sqlalchemy.orm.attributes import NO_VALUE
-from sqlalchemy.sql import text, column
 from sqlalchemy.sql.expression import union, bindparam, literal_column
 
 from sqlalchemy import (
@@ -29,6 +28,7 @@ from sqlalchemy import (
     inspect,
     select,
     func,
+    event,
 )
 from sqlalchemy.ext.associationproxy import association_proxy
 from virtuoso.vmapping import IriClass, PatternIriClass
@@ -43,7 +43,9 @@ from ..auth import (
     P_ADD_IDEA)
 from ..semantic.namespaces import (
     SIOC, IDEA, ASSEMBL, DCTERMS, QUADNAMES, FOAF, RDF, VirtRDF)
-from ..lib.sqla import (CrudOperation, get_model_watcher)
+from ..lib.sqla import (
+    CrudOperation, get_model_watcher, get_session_maker, Base,
+    transient_connection_info_keys)
 from assembl.views.traversal import (
     AbstractCollectionDefinition, CollectionDefinition)
 
@@ -295,39 +297,13 @@ class Idea(HistoryMixin, DiscussionBoundBase):
     def get_ancestors_query(
             cls, target_id=bindparam('root_id', type_=Integer),
             inclusive=True):
-        if cls.using_virtuoso:
-            if isinstance(target_id, list):
-                raise NotImplemented()
-            sql = text(
-                """SELECT transitive t_in (1) t_out (2) T_DISTINCT T_NO_CYCLES
-                    source_id, target_id FROM idea_idea_link
-                    WHERE tombstone_date IS NULL"""
-                ).columns(column('source_id'), column('target_id')).alias()
-            select_exp = select([sql.c.source_id.label('id')]
-                ).select_from(sql).where(sql.c.target_id==target_id)
+        closure = IdeaClosure.__table__
+        if isinstance(target_id, list):
+            select_exp = select([closure.c.ancestor_id.label('id')]).where(
+                closure.c.descendant_id.in_(target_id)).distinct()
         else:
-            if isinstance(target_id, list):
-                root_condition = IdeaLink.target_id.in_(target_id)
-            else:
-                root_condition = (IdeaLink.target_id == target_id)
-            link = select(
-                    [IdeaLink.source_id, IdeaLink.target_id]
-                ).select_from(
-                    IdeaLink
-                ).where(
-                    (IdeaLink.tombstone_date == None) &
-                    (root_condition)
-                ).cte(recursive=True)
-            target_alias = aliased(link)
-            sources_alias = aliased(IdeaLink)
-            parent_link = sources_alias.target_id == target_alias.c.source_id
-            parents = select(
-                    [sources_alias.source_id, sources_alias.target_id]
-                ).select_from(sources_alias).where(parent_link
-                    & (sources_alias.tombstone_date == None))
-            with_parents = link.union(parents)
-            select_exp = select([with_parents.c.source_id.label('id')]
-                ).select_from(with_parents)
+            select_exp = select([closure.c.ancestor_id.label('id')]).where(
+                closure.c.descendant_id == target_id)
         if inclusive:
             if isinstance(target_id, int):
                 target_id = literal_column(str(target_id), Integer)
@@ -350,33 +326,9 @@ class Idea(HistoryMixin, DiscussionBoundBase):
     def get_descendants_query(
             cls, root_idea_id=bindparam('root_idea_id', type_=Integer),
             inclusive=True):
-        if cls.using_virtuoso:
-            sql = text(
-                """SELECT transitive t_in (1) t_out (2) T_DISTINCT T_NO_CYCLES
-                    source_id, target_id FROM idea_idea_link
-                    WHERE tombstone_date IS NULL"""
-                ).columns(column('source_id'), column('target_id')).alias()
-            select_exp = select([sql.c.target_id.label('id')]
-                ).select_from(sql).where(sql.c.source_id==root_idea_id)
-        else:
-            link = select(
-                    [IdeaLink.source_id, IdeaLink.target_id]
-                ).select_from(
-                    IdeaLink
-                ).where(
-                    (IdeaLink.tombstone_date == None) &
-                    (IdeaLink.source_id == root_idea_id)
-                ).cte(recursive=True)
-            source_alias = aliased(link)
-            targets_alias = aliased(IdeaLink)
-            parent_link = targets_alias.source_id == source_alias.c.target_id
-            children = select(
-                    [targets_alias.source_id, targets_alias.target_id]
-                ).select_from(targets_alias).where(parent_link
-                    & (targets_alias.tombstone_date == None))
-            with_children = link.union(children)
-            select_exp = select([with_children.c.target_id.label('id')]
-                ).select_from(with_children)
+        closure = IdeaClosure.__table__
+        select_exp = select([closure.c.descendant_id.label('id')]).where(
+            closure.c.ancestor_id == root_idea_id)
         if inclusive:
             if isinstance(root_idea_id, int):
                 root_idea_id = literal_column(str(root_idea_id), Integer)
@@ -1033,19 +985,19 @@ class RootIdea(Idea):
     def num_read_posts(self):
         """ In the root idea, num_posts is the count of all non-deleted read mesages in the discussion """
         from .post import Post
-        from .action import ViewPost
+        from .action import PostReadState
         discussion_data = self.get_discussion_data(self.discussion_id)
-        result = self.db.query(Post).filter(
+        if not discussion_data.user_id:
+            return 0
+        read_posts = PostReadState.get_bitmap(
+            self.db, self.discussion_id, discussion_data.user_id)
+        if not read_posts:
+            return 0
+        posts = self.db.query(Post.id).filter(
             Post.discussion_id == self.discussion_id,
             Post.hidden==False,
-            Post.tombstone_condition()
-        ).join(
-            ViewPost,
-            (ViewPost.post_id == Post.id)
-            & (ViewPost.tombstone_date == None)
-            & (ViewPost.actor_id == discussion_data.user_id)
-        ).count()
-        return int(result)
+            Post.tombstone_condition())
+        return PostReadState.count_read(posts, Post.id, read_posts)
 
     @property
     def num_total_and_read_posts(self):
@@ -1218,3 +1170,114 @@ Idea.num_children = column_property(
         & (_it.c.tombstone_date == None)
         ).correlate_except(_ilt),
     deferred=True)
+
+
+class IdeaClosure(Base):
+    """The transitive closure of live :py:class:`IdeaLink`, for ancestor
+    and descendant queries without recursion.
+
+    ``depth`` is the length of the shortest path between the ideas; an idea
+    is not its own ancestor. Maintained by flush listeners on IdeaLink."""
+    __tablename__ = 'idea_closure'
+
+    ancestor_id = Column(Integer, ForeignKey(
+        'idea.id', ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True)
+    descendant_id = Column(Integer, ForeignKey(
+        'idea.id', ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True, index=True)
+    depth = Column(Integer, nullable=False)
+
+    @classmethod
+    def refresh(cls, connection, idea_ids):
+        """Recompute the ancestors of the given ideas and their descendants.
+
+        Works on the connection, as it runs at the end of a flush."""
+        t = cls.__table__
+        idea_ids = list(idea_ids)
+        ideas_by_discussion = defaultdict(set)
+        for start in range(0, len(idea_ids), 500):
+            for (idea_id, discussion_id) in connection.execute(
+                    select([_it.c.id, _it.c.discussion_id]).where(
+                        _it.c.id.in_(idea_ids[start:start + 500]))):
+                ideas_by_discussion[discussion_id].add(idea_id)
+        for discussion_id, discussion_idea_ids in \
+                ideas_by_discussion.iteritems():
+            parents = defaultdict(list)
+            children = defaultdict(list)
+            for (source_id, target_id) in connection.execute(
+                    select([_ilt.c.source_id, _ilt.c.target_id]).where(
+                        (_ilt.c.source_id == _it.c.id)
+                        & (_it.c.discussion_id == discussion_id)
+                        & (_ilt.c.tombstone_date == None))):
+                parents[target_id].append(source_id)
+                children[source_id].append(target_id)
+            # Only the closure below the changed ideas can be affected
+            affected = set(discussion_idea_ids)
+            to_visit = list(affected)
+            while to_visit:
+                for child_id in children[to_visit.pop()]:
+                    if child_id not in affected:
+                        affected.add(child_id)
+                        to_visit.append(child_id)
+            affected = list(affected)
+            for start in range(0, len(affected), 500):
+                connection.execute(t.delete().where(
+                    t.c.descendant_id.in_(affected[start:start + 500])))
+            rows = []
+            for idea_id in affected:
+                depths = {}
+                level = parents[idea_id]
+                depth = 1
+                while level:
+                    next_level = []
+                    for ancestor_id in level:
+                        if ancestor_id not in depths and ancestor_id != idea_id:
+                            depths[ancestor_id] = depth
+                            next_level.extend(parents[ancestor_id])
+                    level = next_level
+                    depth += 1
+                rows.extend(dict(
+                    ancestor_id=ancestor_id, descendant_id=idea_id,
+                    depth=depth) for (ancestor_id, depth) in depths.iteritems())
+            if rows:
+                connection.execute(t.insert(), rows)
+
+    @classmethod
+    def rebuild(cls, db, discussion_id=None):
+        "Recompute the closure of one or all discussions."
+        query = db.query(Idea.id)
+        if discussion_id:
+            query = query.filter(Idea.discussion_id == discussion_id)
+        idea_ids = [id for (id,) in query]
+        if idea_ids:
+            cls.refresh(db.connection(), idea_ids)
+
+
+def _mark_idea_closure_dirty(connection, *idea_ids):
+    connection.info.setdefault('idea_closure_dirty', set()).update(
+        id for id in idea_ids if id is not None)
+
+
+@event.listens_for(IdeaLink, 'after_insert', propagate=True)
+@event.listens_for(IdeaLink, 'after_delete', propagate=True)
+def idea_link_changed(mapper, connection, target):
+    _mark_idea_closure_dirty(connection, target.target_id)
+
+
+@event.listens_for(IdeaLink, 'after_update', propagate=True)
+def idea_link_updated(mapper, connection, target):
+    state = inspect(target)
+    old_target_ids = state.attrs.target_id.history.deleted or ()
+    _mark_idea_closure_dirty(connection, target.target_id, *old_target_ids)
+
+
+@event.listens_for(get_session_maker(), "after_flush")
+def refresh_idea_closure(session, flush_context):
+    connection = session.connection()
+    dirty = connection.info.pop('idea_closure_dirty', None)
+    if dirty:
+        IdeaClosure.refresh(connection, dirty)
+
+
+transient_connection_info_keys.add('idea_closure_dirty')
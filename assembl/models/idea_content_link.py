@@ -23,6 +23,7 @@ from ..semantic.virtuoso_mapping import QuadMapPatternS
 from ..lib.sqla import (CrudOperation, get_model_watcher)
 from ..lib.utils import get_global_base_url
 from .discussion import Discussion
+from .auth import DiscussionParticipant
 from .idea import Idea
 from .generic import Content
 from .post import Post
@@ -408,6 +409,14 @@ class Extract(IdeaContentPositiveLink):
             P_ADD_EXTRACT, P_READ, P_EDIT_EXTRACT, P_EDIT_EXTRACT,
             P_EDIT_MY_EXTRACT, P_EDIT_MY_EXTRACT)
 
+
+@event.listens_for(Extract, 'after_insert', propagate=True)
+def record_participation_for_extract(mapper, connection, target):
+    DiscussionParticipant.record_activity(
+        connection, target.discussion_id, target.creator_id,
+        'has_extracted', target.creation_date)
+
+
 class IdeaContentNegativeLink(IdeaContentLink):
     """
     A negative link between an idea and a Content.  Such links mean that
@@ -1,6 +1,8 @@
 """Classes for multilingual strings, using automatic or manual translation"""
 from collections import defaultdict
 from datetime import datetime
+from threading import RLock
+from time import time
 
 from sqlalchemy import (
     Column, ForeignKey, Integer, Boolean, String, SmallInteger,
@@ -8,7 +10,7 @@ from sqlalchemy import (
 from sqlalchemy.sql.expression import case
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import (
-    relationship, backref, subqueryload, joinedload, aliased)
+    relationship, backref, subqueryload, joinedload, aliased, object_session)
 from sqlalchemy.orm.query import Query
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
@@ -18,6 +20,8 @@ import simplejson as json
 from . import Base, TombstonableMixin
 from ..lib import config
 from ..lib.abc import classproperty
+from ..lib.raven_client import capture_exception
+from ..lib.sqla import record_content_versions, get_session_maker
 from ..auth import CrudPermissions, P_READ, P_ADMIN_DISC, P_SYSADMIN
 
 
@@ -30,10 +34,6 @@ class Locale(Base):
     id = Column(Integer, primary_key=True)
     code = Column(String(32), unique=True)
     rtl = Column(Boolean, server_default="0", doc="right-to-left")
-    _locale_collection = None
-    _locale_collection_byid = None
-    _locale_collection_subsets = None
-    _locale_uncommitted = []
     UNDEFINED = "und"
     NON_LINGUISTIC = "zxx"
     MULTILINGUAL = "mul"
@@ -171,9 +171,7 @@ class Locale(Base):
 
     @classmethod
     def reset_cache(cls):
-        cls._locale_collection_byid = None
-        cls._locale_collection = None
-        cls._locale_collection_subsets = None
+        cls.registry.clear()
 
     @classmethod
     def get_locale_object_cache(cls):
@@ -189,59 +187,35 @@ class Locale(Base):
     @classproperty
     def locale_collection_byid(cls):
         "A collection of all known locales, as a dictionary of id->strings"
-        if cls._locale_collection_byid is None:
-            cls._locale_collection_byid = dict(
-                cls.default_db.query(cls.id, cls.code))
-            # Add locales that were created, flushed but not yet committed,
-            # And will not show up in the query
-            uncommitted = [
-                l for l in cls._locale_uncommitted
-                if not (inspect(l).expired or inspect(l).deleted)]
-            cls._locale_uncommitted = uncommitted
-            if uncommitted:
-                cls._locale_collection_byid.update(
-                    {l.id: l.code for l in uncommitted})
-        return cls._locale_collection_byid
+        return cls.registry.check(cls.default_db).by_id
 
     @classmethod
     def code_for_id(cls, id):
-        if (cls._locale_collection_byid is not None
-                and id not in cls._locale_collection_byid):
+        registry = cls.registry
+        if id not in registry.by_id:
             # may have been created in another process
-            cls.reset_cache()
-        return cls.locale_collection_byid[id]
+            registry.find_id(cls.default_db, id)
+        return registry.by_id[id]
 
     @classproperty
     def locale_collection(cls):
         "A collection of all known locales, as a dictionary of string->id"
-        if cls._locale_collection is None:
-            cls._locale_collection = {
-                name: id for (id, name)
-                in cls.locale_collection_byid.iteritems()}
-        return cls._locale_collection
+        return cls.registry.check(cls.default_db).by_code
 
     @classmethod
     def get_id_of(cls, code, create=True):
-        if (cls._locale_collection is not None
-                and code not in cls._locale_collection):
+        registry = cls.registry
+        if code not in registry.by_code:
             # may have been created in another process
             if create:
                 return cls.get_or_create(code).id
-            else:
-                cls.reset_cache()
-        return cls.locale_collection.get(code, None)
+            registry.find_code(cls.default_db, code)
+        return registry.by_code.get(code, None)
 
     @classproperty
     def locale_collection_subsets(cls):
         "A dictionary giving all the know locale variants for a base locale"
-        if cls._locale_collection_subsets is None:
-            # This is used often enough to be worth caching
-            collections = cls.locale_collection
-            collection_subsets = defaultdict(set)
-            for locale_code in collections.iterkeys():
-                collection_subsets[cls.extract_root_locale(locale_code)].add(locale_code)
-            cls._locale_collection_subsets = collection_subsets
-        return cls._locale_collection_subsets
+        return cls.registry.check(cls.default_db).subsets
 
     @classmethod
     def get_or_create(cls, locale_code, db=None):
@@ -249,23 +223,25 @@ class Locale(Base):
         locale = locale_object_cache.get(locale_code, None)
         if locale:
             return locale
-        locale_id = cls.locale_collection.get(locale_code, None)
-        if locale_id:
-            locale_object_cache[locale_code] = locale = Locale.get(locale_id)
-            return locale
         db = db or cls.default_db
-        # Maybe exists despite not in cache
-        locale = db.query(cls).filter_by(code=locale_code).first()
-        if locale:
-            cls.reset_cache()
-            locale_object_cache[locale_code] = locale
-            return locale
-        # create it.
+        locale_id = cls.registry.find_code(db, locale_code)
+        if locale_id:
+            locale = Locale.get(locale_id)
+            if locale:
+                locale_object_cache[locale_code] = locale
+                return locale
+            # Created in a transaction that was rolled back
+            cls.registry.discard(locale_id)
+            # Maybe exists despite the rolled back creation
+            locale = db.query(cls).filter_by(code=locale_code).first()
+            if locale:
+                cls.registry.add(locale.id, locale.code)
+                locale_object_cache[locale_code] = locale
+                return locale
+        # create it. The registry learns of it when it is committed.
         locale = Locale(code=locale_code)
         db.add(locale)
         db.flush()
-        cls._locale_uncommitted.append(locale)
-        cls.reset_cache()
         locale_object_cache[locale_code] = locale
         return locale
 
@@ -286,13 +262,160 @@ class Locale(Base):
             cls.get_or_create(loc_code, db=db)
 
 
+# The content version that counts creations and deletions of locales
+LOCALES_VERSION_KEY = "locales"
+# Recorded in the changes of that content version when a locale is deleted
+LOCALE_DELETED = "deleted"
+
+
+class LocaleRegistry(object):
+    """The known locales, shared by all the threads of a process.
+
+    Locales are seldom deleted, so the registry fetches new locales
+    incrementally (those with an id beyond the last one it knows.)
+    Other processes signal locale creations and deletions through the
+    ``"locales"`` :py:mod:`assembl.lib.content_version`, which is checked
+    at most every :py:attr:`check_interval` seconds, or when a code or id
+    is unknown. A deletion forces a full reload."""
+
+    "How often (in seconds) to check whether other processes changed locales"
+    check_interval = 10
+
+    def __init__(self):
+        self.lock = RLock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.by_id = {}
+            self.by_code = {}
+            self.subsets = defaultdict(set)
+            self.last_id = 0
+            self.version = None
+            self.loaded = False
+            self.last_check = 0
+
+    def add(self, id, code):
+        with self.lock:
+            self.by_id[id] = code
+            self.by_code[code] = id
+            self.subsets[Locale.extract_root_locale(code)].add(code)
+
+    def discard(self, id):
+        with self.lock:
+            code = self.by_id.pop(id, None)
+            if code is not None:
+                self.by_code.pop(code, None)
+                self.subsets[Locale.extract_root_locale(code)].discard(code)
+
+    def current_version(self):
+        from ..lib.content_version import get_version
+        try:
+            return get_version(LOCALES_VERSION_KEY)
+        except Exception:
+            # Without the signal, always query the database.
+            capture_exception()
+            return None
+
+    def refresh(self, db, version=None):
+        """Fetch the locales created since the last refresh, or all locales
+        if some were deleted since."""
+        if version is None:
+            version = self.current_version()
+        with self.lock:
+            full = not self.loaded
+            if not full and version is not None and self.version is not None:
+                changes = version.changed_since(self.version)
+                full = changes is None or LOCALE_DELETED in changes
+            if full:
+                self.clear()
+            # The version is read before the query, so changes made during
+            # the query will be seen at the next refresh.
+            if version is not None:
+                self.version = version.version
+            for (id, code) in db.query(Locale.id, Locale.code).filter(
+                    Locale.id > self.last_id):
+                self.add(id, code)
+                self.last_id = max(self.last_id, id)
+            self.loaded = True
+            self.last_check = time()
+        return self
+
+    def check(self, db):
+        """Refresh the registry if it is not loaded, or if another process
+        signaled a change since the last check."""
+        if not self.loaded:
+            return self.refresh(db)
+        if time() - self.last_check > self.check_interval:
+            version = self.current_version()
+            if version is None or version.version != self.version:
+                return self.refresh(db, version)
+            self.last_check = time()
+        return self
+
+    def find_code(self, db, code):
+        """The id of a locale code, looked up in the database if unknown."""
+        if code not in self.by_code:
+            self.refresh(db)
+            if code not in self.by_code:
+                # A locale committed out of id order
+                for (locale_id, locale_code) in db.query(
+                        Locale.id, Locale.code).filter_by(code=code):
+                    self.add(locale_id, locale_code)
+        return self.by_code.get(code, None)
+
+    def find_id(self, db, id):
+        """The code of a locale id, looked up in the database if unknown."""
+        if id not in self.by_id:
+            self.refresh(db)
+            if id not in self.by_id:
+                # A locale committed out of id order
+                for (locale_id, locale_code) in db.query(
+                        Locale.id, Locale.code).filter_by(id=id):
+                    self.add(locale_id, locale_code)
+        return self.by_id.get(id, None)
+
+
+Locale.registry = LocaleRegistry()
+
+
 @event.listens_for(Locale, 'after_insert', propagate=True)
+def locale_created(mapper, connection, target):
+    # Only registered once committed, so other threads never use an id
+    # which may be rolled back
+    object_session(target).info.setdefault(
+        'locales_created', []).append((target.id, target.code))
+
+
 @event.listens_for(Locale, 'after_delete', propagate=True)
-def locale_collection_changed(target, value, oldvalue):
-    # Reset the collections
-    Locale._locale_collection_subsets = None
-    Locale._locale_collection = None
-    Locale._locale_collection_byid = None
+def locale_deleted(mapper, connection, target):
+    # Only forgotten once committed, as the deletion may be rolled back
+    object_session(target).info.setdefault(
+        'locales_deleted', []).append(target.id)
+
+
+@event.listens_for(get_session_maker(), "after_commit")
+def apply_locale_changes(session):
+    created = session.info.pop('locales_created', None)
+    deleted = session.info.pop('locales_deleted', None)
+    if created:
+        for (id, code) in created:
+            Locale.registry.add(id, code)
+    if deleted:
+        for id in deleted:
+            Locale.registry.discard(id)
+        record_content_versions(
+            {LOCALES_VERSION_KEY: [{'@id': LOCALE_DELETED}]})
+    elif created:
+        record_content_versions({LOCALES_VERSION_KEY: ()})
+
+
+@event.listens_for(get_session_maker(), "after_rollback")
+def forget_locale_changes(session):
+    # A lookup within the transaction may have registered them
+    for (id, code) in session.info.pop('locales_created', ()):
+        Locale.registry.discard(id)
+    session.info.pop('locales_deleted', None)
 
 
 class LocaleLabel(Base):
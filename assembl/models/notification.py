@@ -2,6 +2,7 @@
 """Allow users to be notified of certain events happening in a discussion. Depends on subscribing to those events."""
 from datetime import datetime
 from collections import defaultdict
+from itertools import chain
 from abc import abstractmethod
 import transaction
 import os
@@ -10,7 +11,9 @@ import email
 from email import (charset as Charset)
 from email.mime.text import MIMEText
 from functools import partial
-import threading
+from contextlib import contextmanager
+from threading import local
+import logging
 
 from sqlalchemy import (
     Column,
@@ -21,7 +24,10 @@ from sqlalchemy import (
     UnicodeText,
     DateTime,
     ForeignKey,
+    Index,
     event,
+    exists,
+    func,
     inspect
 )
 from sqlalchemy.orm import (
@@ -36,7 +42,8 @@ from jinja2 import Environment, PackageLoader
 from . import Base, DiscussionBoundBase
 from ..lib.model_watcher import IModelEventWatcher
 from ..lib.decl_enums import DeclEnum
-from ..lib.utils import waiting_get
+from ..lib.utils import waiting_get, get_subclasses_recursive
+from ..lib.raven_client import capture_exception
 from ..lib import config
 from .auth import (
     User, Everyone, P_ADMIN_DISC, CrudPermissions, P_READ, UserTemplate)
@@ -47,6 +54,7 @@ from assembl.semantic.namespaces import ASSEMBL
 
 
 _ = TranslationStringFactory('assembl')
+log = logging.getLogger('assembl')
 
 # Don't BASE64-encode UTF-8 messages so that we avoid unwanted attention from
 # some spam filters.
@@ -118,6 +126,11 @@ class NotificationSubscriptionStatus(DeclEnum):
     INACTIVE_DFT = "INACTIVE_DFT", "This subscription is defined in the template, but not subscribed by default."
 
 
+class NotificationDeliveryMode(DeclEnum):
+    IMMEDIATE = "IMMEDIATE", "Each notification is sent as soon as it is created"
+    DIGEST = "DIGEST", "Notifications are sent together, in a periodic digest"
+
+
 class NotificationSubscription(DiscussionBoundBase):
     """A subscription to a specific type of notification.
 
@@ -172,6 +185,11 @@ class NotificationSubscription(DiscussionBoundBase):
         DateTime,
         nullable = False,
         default = datetime.utcnow)
+    delivery_mode = Column(
+        NotificationDeliveryMode.db_type(),
+        nullable = False,
+        default = NotificationDeliveryMode.IMMEDIATE,
+        server_default = NotificationDeliveryMode.IMMEDIATE.name)
     user_id = Column(
         Integer,
         ForeignKey(
@@ -197,6 +215,10 @@ class NotificationSubscription(DiscussionBoundBase):
         'with_polymorphic': '*'
     }
 
+    __table_args__ = (
+        Index('ix_notification_subscription_discussion_type_status',
+              'discussion_id', 'type', 'status'),)
+
     def get_discussion_id(self):
         return self.discussion_id
 
@@ -216,31 +238,102 @@ class NotificationSubscription(DiscussionBoundBase):
         return discussion_id == object.get_discussion_id() and discussion in self.user.participant_in_discussion
 
     @classmethod
-    def findApplicableInstances(cls, discussion_id, verb, object, user=None):
+    def applicable_conditions(cls, discussion_id, verb, object):
+        """SQL conditions equivalent to :py:meth:`wouldCreateNotification`
+        for the subscriptions of this class.
+
+        Returns None if no subscription of this class can fire on this event,
+        and NotImplemented if the conditions cannot be expressed in SQL,
+        in which case each subscription is loaded and asked in turn."""
+        return NotImplemented
+
+    @classmethod
+    def participant_conditions(cls, discussion_id, object):
+        """The SQL conditions of the base :py:meth:`wouldCreateNotification`:
+        the subscription is active, and its user participates in the
+        discussion of the object."""
+        if discussion_id != object.get_discussion_id():
+            return None
+        from .auth import LocalUserRole, Role
+        from ..auth import R_PARTICIPANT
+        is_participant = exists().where(
+            (LocalUserRole.user_id == cls.user_id)
+            & (LocalUserRole.discussion_id == discussion_id)
+            & (LocalUserRole.requested == False)
+            & (LocalUserRole.role_id == Role.id)
+            & (Role.name == R_PARTICIPANT))
+        return [cls.status == NotificationSubscriptionStatus.ACTIVE,
+                cls.discussion_id == discussion_id,
+                is_participant]
+
+    @classmethod
+    def findApplicableIds(cls, discussion_id, verb, object, user_id=None):
+        """
+        Returns (id, user_id) of the subscriptions that would fire on the
+        object and verb given, among those of exactly this class
+        (not its subclasses.)
+
+        The whole match is done in SQL when the class defines
+        :py:meth:`applicable_conditions`; otherwise, this naive
+        implementation instanciates every ACTIVE subscription of the class,
+        and calls "would fire" for each.
         """
-        Returns all subscriptions that would fire on the object, and verb given
+        conditions = cls.applicable_conditions(discussion_id, verb, object)
+        if conditions is None:
+            return []
+        identity = inspect(cls).polymorphic_identity
+        if conditions is not NotImplemented:
+            query = cls.default_db.query(cls.id, cls.user_id).filter(
+                cls.type == identity, *conditions)
+            if user_id:
+                query = query.filter(cls.user_id == user_id)
+            return query.all()
+        subscriptionsQuery = cls.default_db.query(cls).filter(
+            cls.type == identity,
+            cls.status == NotificationSubscriptionStatus.ACTIVE,
+            cls.discussion_id == discussion_id)
+        if user_id:
+            subscriptionsQuery = subscriptionsQuery.filter(
+                cls.user_id == user_id)
+        return [(subscription.id, subscription.user_id)
+                for subscription in subscriptionsQuery
+                if subscription.wouldCreateNotification(
+                    object.get_discussion_id(), verb, object)]
 
-        This naive implementation instanciates every ACTIVE subscription for every user,
-        and calls "would fire" for each.  It is expected that most subclasses will
-        override this with a more optimal implementation
+    @classmethod
+    def findApplicableInstances(cls, discussion_id, verb, object, user=None):
         """
-        applicable_subscriptions = []
-        subscriptionsQuery = cls.default_db.query(cls)
-        subscriptionsQuery = subscriptionsQuery.filter(cls.status==NotificationSubscriptionStatus.ACTIVE);
-        subscriptionsQuery = subscriptionsQuery.filter(cls.discussion_id==discussion_id);
-        if user:
-            subscriptionsQuery = subscriptionsQuery.filter(cls.user==user)
-        #print "findApplicableInstances(called) with discussion_id=%s, verb=%s, object=%s, user=%s"%(discussion_id, verb, object, user)
-        #print repr(subscriptionsQuery.all())
-        for subscription in subscriptionsQuery:
-            if(subscription.wouldCreateNotification(object.get_discussion_id(), verb, object)):
-                applicable_subscriptions.append(subscription)
-        return applicable_subscriptions
+        Returns all subscriptions of this class and its subclasses
+        that would fire on the object, and verb given
+        """
+        user_id = user.id if user else None
+        ids = set(chain.from_iterable(
+            (id for (id, _) in subclass.findApplicableIds(
+                discussion_id, verb, object, user_id))
+            for subclass in [cls] + get_subclasses_recursive(cls)))
+        if not ids:
+            return []
+        return cls.default_db.query(cls).filter(cls.id.in_(ids)).all()
+
+    def create_notification(self, discussion_id, verb, objectInstance):
+        """The :py:class:`Notification` of a CRUD event on a model, not yet
+        added to the session, if this subscription creates a single one.
+
+        This allows the dispatcher to insert notifications in bulk."""
+        return None
 
-    @abstractmethod
     def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
         """Process a CRUD event on a model, creating :py:class:`Notification` as appropriate"""
-        pass
+        from ..tasks.notify import notify
+        assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
+        notification = self.create_notification(
+            discussion_id, verb, objectInstance)
+        if notification is None:
+            return
+        self.db.add(notification)
+        self.db.flush()
+        if self.delivery_mode == NotificationDeliveryMode.IMMEDIATE:
+            notify.delay(notification.id)
 
     def get_human_readable_description(self):
         """ A human readable description of this notification subscription
@@ -300,6 +393,10 @@ class NotificationSubscription(DiscussionBoundBase):
             if status != self.status:
                 self.status = status
                 self.last_status_change_date = datetime.utcnow()
+        delivery_mode = json.get('delivery_mode', None)
+        if delivery_mode:
+            self.delivery_mode = NotificationDeliveryMode.from_string(
+                delivery_mode)
         return self.handle_duplication(
                 json, parse_def, aliases, ctx, permissions, user_id,
                 duplicate_handling, jsonld)
@@ -372,7 +469,7 @@ class NotificationSubscription(DiscussionBoundBase):
 def update_last_status_change_date(target, value, oldvalue, initiator):
     target.last_status_change_date = datetime.utcnow()
 
-from ..lib.sqla import get_session_maker
+from ..lib.sqla import get_session_maker, reserve_ids
 
 @event.listens_for(get_session_maker(), "after_flush")
 def after_flush_list(session, flush_context):
@@ -427,7 +524,8 @@ class NotificationSubscriptionOnPost(NotificationSubscriptionOnObject):
 
     post_id = Column(
         Integer, ForeignKey("post.id",
-            ondelete='CASCADE', onupdate='CASCADE'), nullable=False)
+            ondelete='CASCADE', onupdate='CASCADE'),
+        nullable=False, index=True)
 
     post = relationship("Post", backref=backref(
         "subscriptions_on_post", cascade="all, delete-orphan"))
@@ -592,18 +690,19 @@ class NotificationSubscriptionFollowSyntheses(NotificationSubscriptionGlobal):
         parentWouldCreate = super(NotificationSubscriptionFollowSyntheses, self).wouldCreateNotification(discussion_id, verb, object)
         return parentWouldCreate and (verb == CrudVerbs.CREATE) and isinstance(object, SynthesisPost) and discussion_id == object.get_discussion_id()
 
-    def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
-        from ..tasks.notify import notify
-        assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
-        notification = NotificationOnPostCreated(
+    @classmethod
+    def applicable_conditions(cls, discussion_id, verb, object):
+        if verb != CrudVerbs.CREATE or not isinstance(object, SynthesisPost):
+            return None
+        return cls.participant_conditions(discussion_id, object)
+
+    def create_notification(self, discussion_id, verb, objectInstance):
+        return NotificationOnPostCreated(
             post = objectInstance,
             first_matching_subscription = self,
             push_method = NotificationPushMethodType.EMAIL,
             #push_address = TODO
             )
-        self.db.add(notification)
-        self.db.flush()
-        notify.delay(notification.id)
 
     __mapper_args__ = {
         'polymorphic_identity': NotificationSubscriptionClasses.FOLLOW_SYNTHESES
@@ -620,18 +719,19 @@ class NotificationSubscriptionFollowAllMessages(NotificationSubscriptionGlobal):
         parentWouldCreate = super(NotificationSubscriptionFollowAllMessages, self).wouldCreateNotification(discussion_id, verb, object)
         return parentWouldCreate and (verb == CrudVerbs.CREATE) and isinstance(object, Post) and discussion_id == object.get_discussion_id()
 
-    def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
-        assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
-        from ..tasks.notify import notify
-        notification = NotificationOnPostCreated(
+    @classmethod
+    def applicable_conditions(cls, discussion_id, verb, object):
+        if verb != CrudVerbs.CREATE or not isinstance(object, Post):
+            return None
+        return cls.participant_conditions(discussion_id, object)
+
+    def create_notification(self, discussion_id, verb, objectInstance):
+        return NotificationOnPostCreated(
             post_id = objectInstance.id,
             first_matching_subscription = self,
             push_method = NotificationPushMethodType.EMAIL,
             #push_address = TODO
             )
-        self.db.add(notification)
-        self.db.flush()
-        notify.delay(notification.id)
 
     __mapper_args__ = {
         'polymorphic_identity': NotificationSubscriptionClasses.FOLLOW_ALL_MESSAGES
@@ -654,18 +754,23 @@ class NotificationSubscriptionFollowOwnMessageDirectReplies(NotificationSubscrip
                  and object.parent.creator == self.user
                  )
 
-    def process(self, discussion_id, verb, objectInstance, otherApplicableSubscriptions):
-        assert self.wouldCreateNotification(discussion_id, verb, objectInstance)
-        from ..tasks.notify import notify
-        notification = NotificationOnPostCreated(
+    @classmethod
+    def applicable_conditions(cls, discussion_id, verb, object):
+        if (verb != CrudVerbs.CREATE or not isinstance(object, Post)
+                or object.parent is None):
+            return None
+        conditions = cls.participant_conditions(discussion_id, object)
+        if conditions is not None:
+            conditions.append(cls.user_id == object.parent.creator_id)
+        return conditions
+
+    def create_notification(self, discussion_id, verb, objectInstance):
+        return NotificationOnPostCreated(
             post = objectInstance,
             first_matching_subscription = self,
             push_method = NotificationPushMethodType.EMAIL,
             #push_address = TODO
             )
-        self.db.add(notification)
-        self.db.flush()
-        notify.delay(notification.id)
 
     __mapper_args__ = {
         'polymorphic_identity': NotificationSubscriptionClasses.FOLLOW_OWN_MESSAGES_DIRECT_REPLIES
@@ -680,36 +785,123 @@ class ModelEventWatcherNotificationSubscriptionDispatcher(object):
     interface.implements(IModelEventWatcher)
 
     def processEvent(self, verb, objectClass, objectId):
-        from ..lib.utils import get_concrete_subclasses_recursive
         assert objectId
         objectInstance = waiting_get(objectClass, objectId)
+        if objectInstance is None:
+            log.warning("processEvent: %s %d not found",
+                        objectClass.__name__, objectId)
+            return
+        self.processInstances(verb, [objectInstance])
+
+    def processEventBatch(self, verb, objectClass, objectIds):
+        """Process the events of many objects of a class, loaded together,
+        in a single transaction. If it fails, the events are processed
+        again one at a time, so one object does not lose the others."""
+        assert all(objectIds)
+        objectInstances = objectClass.default_db.query(objectClass).filter(
+            objectClass.id.in_(objectIds)).all()
+        found = {o.id for o in objectInstances}
+        for objectId in objectIds:
+            if objectId in found:
+                continue
+            objectInstance = waiting_get(objectClass, objectId)
+            if objectInstance is None:
+                # Do not lose the rest of the batch for it
+                log.warning("processEventBatch: %s %d not found",
+                            objectClass.__name__, objectId)
+                continue
+            objectInstances.append(objectInstance)
+        if len(objectInstances) < 2:
+            if objectInstances:
+                self.processInstances(verb, objectInstances)
+            return
+        objectIds = [o.id for o in objectInstances]
+        try:
+            self.processInstances(verb, objectInstances)
+        except Exception:
+            # Do not lose the notifications of the whole batch for one
+            # object: retry them one at a time.
+            capture_exception()
+            for objectId in objectIds:
+                try:
+                    self.processEvent(verb, objectClass, objectId)
+                except Exception:
+                    capture_exception()
+
+    def processInstances(self, verb, objectInstances):
+        notification_ids = []
+        with transaction.manager:
+            notifications = []
+            for objectInstance in objectInstances:
+                notifications.extend(
+                    self.createNotifications(verb, objectInstance))
+            if notifications:
+                Notification.add_all(objectInstances[0].db, notifications)
+                # Digest notifications wait for the digest task
+                notification_ids = [
+                    n.id for n in notifications
+                    if n.first_matching_subscription.delivery_mode
+                    == NotificationDeliveryMode.IMMEDIATE]
+        if bool(current_task):
+            # In a celery task, there's no one else to commit
+            objectInstances[0].db.commit()
+        if notification_ids:
+            # Only enqueue once committed, so workers find the notifications
+            from ..tasks.notify import enqueue_notifications
+            enqueue_notifications(notification_ids)
+
+    def createNotifications(self, verb, objectInstance):
+        """The new notifications for the event of an object, to be added to
+        the session. Subscriptions that cannot create their notification
+        separately process the event directly."""
+        from ..lib.utils import get_concrete_subclasses_recursive
         assert objectInstance
         assert objectInstance.id
         # We need the discussion id
         assert isinstance(objectInstance, DiscussionBoundBase)
-        applicableInstancesByUser = defaultdict(list)
+        discussion_id = objectInstance.get_discussion_id()
+        # Match in bulk, and only load the subscriptions that fire
+        applicableIdsByUser = defaultdict(set)
         subscriptionClasses = get_concrete_subclasses_recursive(NotificationSubscription)
         for subscriptionClass in subscriptionClasses:
-            applicableInstances = subscriptionClass.findApplicableInstances(objectInstance.get_discussion_id(), CrudVerbs.CREATE, objectInstance)
-            for subscription in applicableInstances:
-                applicableInstancesByUser[subscription.user_id].append(subscription)
+            for id, user_id in subscriptionClass.findApplicableIds(
+                    discussion_id, CrudVerbs.CREATE, objectInstance):
+                applicableIdsByUser[user_id].add(id)
+        applicableIds = set(chain.from_iterable(
+            applicableIdsByUser.itervalues()))
+        subscriptionsById = {}
+        if applicableIds:
+            subscriptionsById = {
+                s.id: s for s in objectInstance.db.query(
+                    NotificationSubscription).filter(
+                    NotificationSubscription.id.in_(applicableIds))}
+        applicableInstancesByUser = {
+            userId: [subscriptionsById[id] for id in sorted(ids)]
+            for userId, ids in applicableIdsByUser.iteritems()}
         num_instances = len([v for v in applicableInstancesByUser.itervalues() if v])
         print "processEvent: %d notifications created for %s %s %d" % (
-            num_instances, verb, objectClass.__name__, objectId)
-        with transaction.manager:
-            for userId, applicableInstances in applicableInstancesByUser.iteritems():
-                if(len(applicableInstances) > 0):
-                    applicableInstances.sort(cmp=lambda x,y: cmp(x.priority, y.priority))
-                    applicableInstances[0].process(objectInstance.get_discussion_id(), verb, objectInstance, applicableInstances[1:])
-        if bool(current_task):
-            # In a celery task, there's no one else to commit
-            objectInstance.db.commit()
-
+            num_instances, verb, objectInstance.__class__.__name__,
+            objectInstance.id)
+        notifications = []
+        for userId, applicableInstances in applicableInstancesByUser.iteritems():
+            if(len(applicableInstances) > 0):
+                applicableInstances.sort(cmp=lambda x,y: cmp(x.priority, y.priority))
+                notification = applicableInstances[0].create_notification(
+                    discussion_id, verb, objectInstance)
+                if notification is None:
+                    applicableInstances[0].process(discussion_id, verb, objectInstance, applicableInstances[1:])
+                else:
+                    notifications.append(notification)
+        return notifications
 
     def processPostCreated(self, id):
-        print "processPostCreated", id
+        log.debug("processPostCreated %d", id)
         self.processEvent(CrudVerbs.CREATE, Post, id)
 
+    def processPostCreatedBatch(self, ids):
+        log.debug("processPostCreatedBatch %d", len(ids))
+        self.processEventBatch(CrudVerbs.CREATE, Post, ids)
+
     def processIdeaCreated(self, id):
         print "processIdeaCreated", id
 
@@ -857,7 +1049,24 @@ class Notification(Base):
         DateTime,
         nullable = True)
 
-    threadlocals = threading.local()
+    # Localizers and jinja environments, by locale
+    _localizers = {}
+    _jinja_envs = {}
+    # Contents of css files, by path
+    _css_contents = {}
+
+    @classmethod
+    def add_all(cls, db, notifications):
+        """Insert new notifications in bulk.
+
+        On postgres, ids are drawn from the sequence beforehand, so the
+        flush can insert them with one statement per table."""
+        if not cls.using_virtuoso:
+            for notification, id in zip(notifications, reserve_ids(
+                    db, cls.id, len(notifications))):
+                notification.id = id
+        db.add_all(notifications)
+        db.flush()
 
     @abstractmethod
     def event_source_object(self):
@@ -910,24 +1119,45 @@ class Notification(Base):
         cls.setup_localizer(jinja_env, user)
         return jinja_env
 
+    @classmethod
+    def get_locale_jinja_env(cls, locale):
+        """A jinja environment translating to this locale, shared by all
+        notifications in that locale, so templates are compiled once."""
+        jinja_env = cls._jinja_envs.get(locale, None)
+        if jinja_env is None:
+            localizer = cls.get_locale_localizer(locale)
+            jinja_env = cls.make_unlocalized_jinja_env()
+            jinja_env.install_gettext_callables(
+                partial(localizer.translate, domain='assembl'),
+                partial(localizer.pluralize, domain='assembl'),
+                newstyle=True)
+            cls._jinja_envs[locale] = jinja_env
+        return jinja_env
+
     def get_jinja_env(self):
-        threadlocals = self.threadlocals
-        if getattr(threadlocals, 'jinja_env', None) is None:
-            threadlocals.jinja_env = self.make_unlocalized_jinja_env()
-        self.setup_localizer(
-            threadlocals.jinja_env, self.first_matching_subscription.user)
-        return threadlocals.jinja_env
+        return self.get_locale_jinja_env(
+            self.get_locale(self.first_matching_subscription.user))
 
     @classmethod
-    def get_localizer(cls, user=None):
+    def get_locale(cls, user=None):
         if user:
-            locale = user.get_preferred_locale()
-        else:
-            locale = config.get(
-                'available_languages', 'fr_CA en_CA').split()[0]
-        # TODO: if locale has country code, make sure we fallback properly.
-        path = os.path.abspath(join(dirname(__file__), os.path.pardir, 'locale'))
-        return make_localizer(locale, [path])
+            return user.get_preferred_locale()
+        return config.get(
+            'available_languages', 'fr_CA en_CA').split()[0]
+
+    @classmethod
+    def get_locale_localizer(cls, locale):
+        localizer = cls._localizers.get(locale, None)
+        if localizer is None:
+            # TODO: if locale has country code, make sure we fallback properly.
+            path = os.path.abspath(join(dirname(__file__), os.path.pardir, 'locale'))
+            localizer = cls._localizers[locale] = make_localizer(
+                locale, [path])
+        return localizer
+
+    @classmethod
+    def get_localizer(cls, user=None):
+        return cls.get_locale_localizer(cls.get_locale(user))
 
     @classmethod
     def setup_localizer(cls, jinja_env=None, user=None):
@@ -939,17 +1169,36 @@ class Notification(Base):
             newstyle=True)
 
     @classmethod
-    def get_css_paths(cls, discussion):
+    def get_css_file_paths(cls, discussion):
         from ..views import get_theme_info, get_theme_base_path
         (theme_name, theme_relative_path) = get_theme_info(discussion)
         assembl_css_path = os.path.normpath(os.path.join(get_theme_base_path(), theme_relative_path, 'assembl_notifications.css'))
+        ink_css_path = os.path.normpath(os.path.join(os.path.abspath(__file__), '..' , '..', 'static', 'js', 'bower', 'ink', 'css', 'ink.css'))
+        return (assembl_css_path, ink_css_path)
+
+    @classmethod
+    def get_css_paths(cls, discussion):
+        (assembl_css_path, ink_css_path) = cls.get_css_file_paths(discussion)
         assembl_css = open(assembl_css_path)
         assert assembl_css
-        ink_css_path = os.path.normpath(os.path.join(os.path.abspath(__file__), '..' , '..', 'static', 'js', 'bower', 'ink', 'css', 'ink.css'))
         ink_css = open(ink_css_path)
         assert ink_css
         return (assembl_css, ink_css)
 
+    @classmethod
+    def get_css_contents(cls, discussion):
+        """The contents of the css files of :py:meth:`get_css_paths`,
+        read again only when a file changes."""
+        contents = []
+        for path in cls.get_css_file_paths(discussion):
+            mtime = os.path.getmtime(path)
+            cached = cls._css_contents.get(path, None)
+            if cached is None or cached[0] != mtime:
+                with open(path) as f:
+                    cached = cls._css_contents[path] = (mtime, f.read())
+            contents.append(cached[1])
+        return tuple(contents)
+
     def get_from_email_address(self):
         from_email = self.first_matching_subscription.discussion.admin_source.admin_sender
         assert from_email
@@ -1057,18 +1306,57 @@ class NotificationOnPostCreated(NotificationOnPost):
             subject += (self.post.subject.first_original().value or "")
         return subject
 
+    # Rendered html parts, shared by the recipients of a post who have the
+    # same locale and applicable subscriptions. Only kept while sending a
+    # batch (see :py:meth:`sharing_html_parts`), so that edits and
+    # moderation of the post are seen by later batches and retries.
+    _html_parts = local()
+
+    @classmethod
+    @contextmanager
+    def sharing_html_parts(cls):
+        """Share the rendered html parts within this block"""
+        if getattr(cls._html_parts, 'cache', None) is not None:
+            yield
+            return
+        cls._html_parts.cache = {}
+        try:
+            yield
+        finally:
+            cls._html_parts.cache = None
+
     def render_to_email_html_part(self):
+        from ..lib.frontend_urls import FrontendUrls
+        cache = getattr(self._html_parts, 'cache', None)
+        if cache is None:
+            return self.make_email_html_part()
+        discussion = self.first_matching_subscription.discussion
+        frontendUrls = FrontendUrls(discussion)
+        # Those are all that vary between recipients in the templates
+        key = (
+            self.sqla_type, self.post_id,
+            self.get_locale(self.first_matching_subscription.user),
+            tuple((subscription.type,
+                   frontendUrls.getUserNotificationSubscriptionUnsubscribeUrl(
+                    subscription))
+                  for subscription in self.get_applicable_subscriptions()))
+        html = cache.get(key, None)
+        if html is None:
+            html = cache[key] = self.make_email_html_part()
+        return html
+
+    def make_email_html_part(self):
         from ..lib.frontend_urls import FrontendUrls, URL_DISCRIMINANTS, SOURCE_DISCRIMINANTS
         from premailer import Premailer
         discussion = self.first_matching_subscription.discussion
-        (assembl_css, ink_css) = self.get_css_paths(discussion)
+        (assembl_css, ink_css) = self.get_css_contents(discussion)
         jinja_env = self.get_jinja_env()
         template_data={'subscription': self.first_matching_subscription,
                        'discussion': discussion,
                        'notification': self,
                        'frontendUrls': FrontendUrls(discussion),
-                       'ink_css': ink_css.read(),
-                       'assembl_notification_css': assembl_css.read().decode('utf_8'),
+                       'ink_css': ink_css,
+                       'assembl_notification_css': assembl_css.decode('utf_8'),
                        'discriminants': {
                                             'url': URL_DISCRIMINANTS,
                                             'source': SOURCE_DISCRIMINANTS
@@ -1082,3 +1370,120 @@ class NotificationOnPostCreated(NotificationOnPost):
             template = jinja_env.get_template('notifications/html_mail_post.jinja2')
         html = template.render(**template_data)
         return Premailer(html, disable_leftover_css=True).transform()
+
+
+class NotificationDigest(object):
+    """The pending notifications of a user in a discussion, from
+    subscriptions in digest :py:class:`NotificationDeliveryMode`,
+    sent together as a single email."""
+
+    def __init__(self, notifications, posts=()):
+        assert notifications
+        self.notifications = notifications
+        # Keep the posts in the session's identity map
+        self.posts = posts
+        subscription = notifications[0].first_matching_subscription
+        self.user = subscription.user
+        self.discussion = subscription.discussion
+
+    @staticmethod
+    def pending_query(db, *columns):
+        """Notifications that wait for a digest"""
+        if columns:
+            query = db.query(*columns).select_from(Notification)
+        else:
+            query = db.query(Notification)
+        return query.join(Notification.first_matching_subscription).filter(
+            NotificationSubscription.delivery_mode ==
+            NotificationDeliveryMode.DIGEST,
+            Notification.delivery_state.in_(
+                NotificationDeliveryStateType.getRetryableDeliveryStates()))
+
+    @classmethod
+    def due_digests(cls, db, window):
+        """(user_id, discussion_id) of the digests whose oldest notification
+        has waited longer than the window"""
+        return cls.pending_query(
+            db, NotificationSubscription.user_id,
+            NotificationSubscription.discussion_id).group_by(
+            NotificationSubscription.user_id,
+            NotificationSubscription.discussion_id).having(
+            func.min(Notification.creation_date) <=
+            datetime.utcnow() - window).all()
+
+    @classmethod
+    def load(cls, db, user_id, discussion_id):
+        from .langstrings import LangString
+        notifications = cls.pending_query(db).filter(
+            NotificationSubscription.user_id == user_id,
+            NotificationSubscription.discussion_id == discussion_id
+            ).options(contains_eager(Notification.first_matching_subscription)
+            ).order_by(Notification.creation_date).all()
+        if not notifications:
+            return None
+        # Load the underlying posts in a single query
+        post_ids = [n.post_id for n in notifications
+                    if isinstance(n, NotificationOnPost)]
+        posts = db.query(Post).filter(Post.id.in_(post_ids)).options(
+            joinedload(Post.creator),
+            LangString.subqueryload_option(Post.subject),
+            LangString.subqueryload_option(Post.body)).all()
+        return cls(notifications, posts)
+
+    def get_from_email_address(self):
+        return self.notifications[0].get_from_email_address()
+
+    def get_to_email_address(self):
+        return self.notifications[0].get_to_email_address()
+
+    def get_notification_subject(self):
+        loc = Notification.get_localizer(self.user)
+        return "[" + self.discussion.topic + "] " + loc.translate(_(
+            "${count} new messages",
+            mapping={'count': len(self.notifications)}))
+
+    def render_to_email_html_part(self):
+        from ..lib.frontend_urls import FrontendUrls, URL_DISCRIMINANTS, SOURCE_DISCRIMINANTS
+        from premailer import Premailer
+        (assembl_css, ink_css) = Notification.get_css_contents(self.discussion)
+        jinja_env = Notification.get_locale_jinja_env(
+            Notification.get_locale(self.user))
+        subscriptions = []
+        for notification in self.notifications:
+            if notification.first_matching_subscription not in subscriptions:
+                subscriptions.append(notification.first_matching_subscription)
+        template = jinja_env.get_template(
+            'notifications/html_mail_digest.jinja2')
+        html = template.render(
+            subscriptions=subscriptions,
+            discussion=self.discussion,
+            notifications=self.notifications,
+            frontendUrls=FrontendUrls(self.discussion),
+            ink_css=ink_css,
+            assembl_notification_css=assembl_css.decode('utf_8'),
+            discriminants={
+                'url': URL_DISCRIMINANTS,
+                'source': SOURCE_DISCRIMINANTS
+            },
+            jinja_env=jinja_env)
+        return Premailer(html, disable_leftover_css=True).transform()
+
+    def render_to_email(self):
+        from ..lib.frontend_urls import FrontendUrls
+        from email.header import Header
+        frontendUrls = FrontendUrls(self.discussion)
+        msg = email.mime.Multipart.MIMEMultipart('alternative')
+        msg['Precedence'] = 'list'
+        msg['List-ID'] = self.discussion.uri()
+        msg['Date'] = email.Utils.formatdate()
+        msg['Message-ID'] = email.Utils.make_msgid()
+        msg['List-Subscribe'] = frontendUrls.getUserNotificationSubscriptionsConfigurationUrl()
+        msg['List-Unsubscribe'] = frontendUrls.getUserNotificationSubscriptionsConfigurationUrl()
+        msg['Subject'] = Header(self.get_notification_subject(), 'utf-8')
+        from_header = Header(self.discussion.topic, 'utf-8')
+        from_header.append(" <" + self.get_from_email_address() + ">", 'ascii')
+        msg['From'] = from_header
+        msg['To'] = self.get_to_email_address()
+        msg.attach(SafeMIMEText(
+            self.render_to_email_html_part().encode('utf-8'), 'html', 'utf-8'))
+        return msg.as_string()
@@ -18,7 +18,7 @@ from .post import (
 from .annotation import Webpage
 from .idea import IdeaVisitor, Idea, IdeaLink, RootIdea
 from .discussion import Discussion
-from .action import ViewPost
+from .action import ViewPost, PostReadState
 
 # TODO: Write a discussion structure cache manager.
 # This will have caches of parent, children, counts, etc. at need
@@ -490,6 +490,15 @@ class PostPathCounter(PostPathCombiner):
         self.read_counts = {}
         self.user_id = user_id
         self.calc_subset = calc_subset
+        self._read_posts = None
+
+    @property
+    def read_posts(self):
+        "Bitmap of the ids of posts read by the user"
+        if self._read_posts is None:
+            self._read_posts = PostReadState.get_bitmap(
+                self.discussion.db, self.discussion.id, self.user_id)
+        return self._read_posts
 
     def copy_result(self, idea_id, parent_result, child_result):
         # When the parent has no information, and can get it from a single child
@@ -516,14 +525,12 @@ class PostPathCounter(PostPathCombiner):
             post, (content_entity.id == post.id) &
                   (post.publication_state.in_(countable_publication_states)))
 
-        if self.user_id:
-            action_entity = entities['action']
-            return q.with_entities(
-                count(content_entity.id), count(action_entity.id)).first()
-        else:
-            (post_count,) = q.with_entities(
-                count(content_entity.id)).first()
-            return (post_count, 0)
+        (post_count,) = q.with_entities(count(content_entity.id)).first()
+        if self.user_id and post_count and self.read_posts:
+            # Filter on the read state rather than joining on ViewPost
+            return (post_count, PostReadState.count_read(
+                q, content_entity.id, self.read_posts))
+        return (post_count, 0)
 
     def get_counts(self, idea_id):
         if self.counts.get(idea_id, None) is not None:
@@ -535,8 +542,7 @@ class PostPathCounter(PostPathCombiner):
             self.viewed_counts[idea_id] = 0
             return (0, 0)
         q = path_collection.as_clause(
-            self.discussion.db, self.discussion.id, user_id=self.user_id,
-            include_deleted=None)
+            self.discussion.db, self.discussion.id, include_deleted=None)
         (post_count, viewed_count) = self.get_counts_for_query(q)
         (path_collection.count, path_collection.viewed_count) = (
             post_count, viewed_count)
@@ -546,7 +552,7 @@ class PostPathCounter(PostPathCombiner):
 
     def get_orphan_counts(self, include_deleted=False):
         return self.get_counts_for_query(
-            self.orphan_clause(self.user_id, include_deleted=include_deleted))
+            self.orphan_clause(include_deleted=include_deleted))
 
     def end_visit(self, idea, level, result, child_results):
         if isinstance(idea, Idea):
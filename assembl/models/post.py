@@ -29,7 +29,7 @@ from ..lib.decl_enums import DeclEnum
 from ..semantic.virtuoso_mapping import QuadMapPatternS
 from ..lib.sqla_types import CoerceUnicode
 from .generic import Content, ContentSource
-from .auth import AgentProfile
+from .auth import AgentProfile, DiscussionParticipant
 from ..semantic.namespaces import SIOC, ASSEMBL, QUADNAMES
 from ..lib import config
 from .langstrings import LangString, LangStringEntry
@@ -566,9 +566,9 @@ def orm_insert_listener(mapper, connection, target):
     # Check if this is the first post by this user in the discussion.
     # In which case, tell the discussion about this new participant,
     # which was not in Discussion.get_participants_query originally.
-    if target.db.query(Post).filter_by(
-            creator_id=target.creator_id,
-            discussion_id=target.discussion_id).count() <= 1:
+    if DiscussionParticipant.record_activity(
+            connection, target.discussion_id, target.creator_id,
+            'has_posted', target.creation_date):
         creator = target.creator or AgentProfile.get(target.creator_id)
         creator.send_to_changes(connection, CrudOperation.UPDATE, target.discussion_id)
     # Eagerly translate the post
@@ -3,7 +3,8 @@
 
 May be defined at the user, Discussion or server level."""
 from itertools import chain
-from collections import MutableMapping
+from collections import Mapping, MutableMapping
+from copy import deepcopy
 
 import simplejson as json
 from sqlalchemy import (
@@ -37,6 +38,117 @@ def merge_json(base, patch):
     return base
 
 
+class FrozenDict(dict):
+    """A dict that cannot be modified, for values shared by snapshots.
+    Copies of it are plain dicts."""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Shared preference values cannot be modified")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _immutable
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return {k: deepcopy(v, memo) for (k, v) in self.iteritems()}
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class FrozenList(list):
+    """A list that cannot be modified, for values shared by snapshots.
+    Copies of it are plain lists."""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Shared preference values cannot be modified")
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = \
+        __imul__ = append = extend = insert = pop = remove = reverse = \
+        sort = _immutable
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return [deepcopy(v, memo) for v in self]
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def freeze_json(value):
+    """The JSON value, with its dicts and lists made unmodifiable"""
+    if isinstance(value, dict):
+        return FrozenDict(
+            (k, freeze_json(v)) for (k, v) in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return FrozenList(freeze_json(v) for v in value)
+    return value
+
+
+class PreferencesSnapshot(Mapping):
+    """The values of a :py:class:`Preferences` and its cascade, resolved
+    once from their JSON. Snapshots are shared, so their lists and dicts
+    are frozen; callers that modify them must copy them first."""
+
+    def __init__(self, preferences):
+        cascade = []
+        prefs = preferences
+        while prefs is not None:
+            cascade.append(prefs)
+            prefs = prefs.cascade_preferences
+        local_values = [level.local_values_json for level in cascade]
+        # Defaults come from the end of the cascade, as in __getitem__
+        data = preferences.preference_data
+        if 'preference_data' in local_values[-1]:
+            data = merge_json(data, local_values[-1]['preference_data'])
+        base_data = data
+        for values in reversed(local_values[:-1]):
+            if 'preference_data' in values:
+                data = merge_json(data, values['preference_data'])
+        self.preference_data = freeze_json(data)
+        resolved = {}
+        for key in preferences.preference_data_key_list:
+            for values in local_values:
+                if key in values:
+                    resolved[key] = values[key]
+                    break
+            else:
+                if key == "preference_data":
+                    resolved[key] = [
+                        base_data[k] for k in
+                        preferences.preference_data_key_list]
+                else:
+                    resolved[key] = base_data[key].get("default", None)
+        resolved['name'] = preferences.name
+        resolved['@extends'] = (
+            preferences.uri_generic(preferences.cascade_id)
+            if preferences.cascade_id else None)
+        self._values = freeze_json(resolved)
+        self._json = None
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            raise RuntimeError("Unknown preference: " + key)
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    @property
+    def json(self):
+        "All the values, serialized once"
+        if self._json is None:
+            self._json = json.dumps(self._values)
+        return self._json
+
+
 class Preferences(MutableMapping, Base, NamedClassMixin):
     """
     Cascading preferences
@@ -83,8 +195,40 @@ class Preferences(MutableMapping, Base, NamedClassMixin):
     @local_values_json.setter
     def local_values_json(self, val):
         assert isinstance(val, dict)
+        self.invalidate_snapshot()
         self.pref_json = json.dumps(val)
 
+    # Snapshots, by the (id, name, cascade_id, pref_json) of each row of the
+    # cascade; pref_json acts as the version of a row.
+    _snapshots = {}
+    MAX_SNAPSHOTS = 1000
+
+    def _snapshot_key(self):
+        key = []
+        prefs = self
+        while prefs is not None:
+            key.append(
+                (prefs.id, prefs.name, prefs.cascade_id, prefs.pref_json))
+            prefs = prefs.cascade_preferences
+        return tuple(key)
+
+    @property
+    def snapshot(self):
+        """The resolved values, as a :py:class:`PreferencesSnapshot`,
+        memoized for the current state of the cascade"""
+        key = self._snapshot_key()
+        snapshot = self._snapshots.get(key, None)
+        if snapshot is None:
+            if len(self._snapshots) >= self.MAX_SNAPSHOTS:
+                self._snapshots.clear()
+            snapshot = self._snapshots[key] = PreferencesSnapshot(self)
+        return snapshot
+
+    def invalidate_snapshot(self):
+        """Forget the snapshot of the current state, which is being
+        modified. Snapshots of other states are keyed out anyway."""
+        self._snapshots.pop(self._snapshot_key(), None)
+
     @property
     def values_json(self):
         if not self.cascade_preferences:
@@ -113,14 +257,7 @@ class Preferences(MutableMapping, Base, NamedClassMixin):
         if key == '@extends':
             return (self.uri_generic(self.cascade_id)
                     if self.cascade_id else None)
-        exists, value = self._get_local(key)
-        if exists:
-            return value
-        elif self.cascade_id:
-            return self.cascade_preferences[key]
-        if key == "preference_data":
-            return self.get_preference_data_list()
-        return self.get_preference_data()[key].get("default", None)
+        return self.snapshot[key]
 
     def __len__(self):
         return len(self.preference_data_list) + 2
@@ -143,6 +280,7 @@ class Preferences(MutableMapping, Base, NamedClassMixin):
     def __setitem__(self, key, value):
         if key == 'name':
             old_value = self.name
+            self.invalidate_snapshot()
             self.name = unicode(value)
             return old_value
         elif key == '@extends':
@@ -150,6 +288,7 @@ class Preferences(MutableMapping, Base, NamedClassMixin):
             new_pref = self.get_instance(value)
             if new_pref is None:
                 raise KeyError("Does not exist:" + value)
+            self.invalidate_snapshot()
             self.cascade_preferences = new_pref
             return old_value
         if key not in self.preference_data_key_set:
@@ -301,15 +440,7 @@ class Preferences(MutableMapping, Base, NamedClassMixin):
                 for p in cls.preference_data_list}
 
     def get_preference_data(self):
-        if self.cascade_id:
-            base = self.cascade_preferences.get_preference_data()
-        else:
-            base = self.preference_data
-        exists, patch = self._get_local("preference_data")
-        if exists:
-            return merge_json(base, patch)
-        else:
-            return base
+        return self.snapshot.preference_data
 
     def get_preference_data_list(self):
         data = self.get_preference_data()
@@ -1,5 +1,6 @@
 """Models for arbitrary key-values storage, bound to a namespace, a user, and some other object (currently only the discussion)."""
-from collections import Mapping, MutableMapping
+from abc import abstractproperty
+from collections import Mapping, MutableMapping, defaultdict
 
 import simplejson as json
 from sqlalchemy import (
@@ -15,6 +16,7 @@ from sqlalchemy import (
     select,
     func,
     UniqueConstraint,
+    Index,
     event,
 )
 from sqlalchemy.orm import (relationship)
@@ -25,7 +27,7 @@ from ..lib.abc import abstractclassmethod
 from . import DiscussionBoundBase
 from assembl.lib import config
 from auth import User
-from ..auth.util import user_has_permission
+from ..auth.util import get_permissions, user_has_permission
 from discussion import Discussion
 from .preferences import Preferences
 from .idea import Idea
@@ -120,7 +122,13 @@ class AbstractPerUserNamespacedKeyValue(
             cls.key,
             cls.user_id,
             name="%s_%s_%s_unique_constraint" % (
-                schema, user, cls.__tablename__)),)
+                schema, user, cls.__tablename__)),
+            # The unique constraint also indexes the target's namespaces,
+            # but its user_id comes too late for per-user lookups.
+            Index("ix_%s_user_namespace" % (cls.__tablename__,),
+                  getattr(cls, cls.target_id_name),
+                  cls.user_id,
+                  cls.namespace))
 
     @classmethod
     def add_nukv(cls, target, user, namespace, key, value):
@@ -160,175 +168,141 @@ class AbstractPerUserNamespacedKeyValue(
         db.query(cls).filter_by(**args).delete()
 
 
-class NamespacedUserKVCollection(MutableMapping):
-    """View of the :py:class:`AbstractPerUserNamespacedKeyValue` for a given namespace as a python dict"""
+def get_kv_rows_cache():
+    """Maintain a per-request cache of the key-value rows of a namespace,
+    by (key-value class, target id, user id, namespace)"""
+    from pyramid.threadlocal import get_current_request
+    req = get_current_request()
+    if not req:
+        return {}
+    if getattr(req, "kv_rows_cache", None) is None:
+        req.kv_rows_cache = {}
+    return req.kv_rows_cache
+
+
+class KVCollection(MutableMapping):
+    """Common behaviour of the namespaced key-value collections.
+
+    The rows of the namespace are loaded in a single query when first
+    needed, and shared with the other collections of the same request
+    for the same namespace. Updates are written through to the rows."""
 
-    def __init__(self, target, user_id, namespace):
+    def __init__(self, target, namespace, rows=None):
         self.target = target
-        self.user_id = user_id
         self.namespace = namespace
+        self._rows = rows
+
+    @abstractproperty
+    def kv_class(self):
+        "The key-value model of the rows"
+
+    def filter_args(self):
+        "The arguments that select the rows of this collection's target"
+        return {self.kv_class.target_name: self.target}
+
+    def cache_key(self):
+        return (self.kv_class.__name__, self.target.id, None, self.namespace)
+
+    def load_rows(self):
+        kvpairs = self.target.db.query(self.kv_class).filter_by(
+            namespace=self.namespace, **self.filter_args())
+        return {kvpair.key: kvpair for kvpair in kvpairs}
+
+    @property
+    def rows(self):
+        "The key-value rows of the namespace, by key"
+        if self._rows is None:
+            cache = get_kv_rows_cache()
+            cache_key = self.cache_key()
+            rows = cache.get(cache_key, None)
+            if rows is None:
+                rows = cache[cache_key] = self.load_rows()
+            self._rows = rows
+        return self._rows
 
     def __len__(self):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        return self.target.db.query(
-            ukv_cls.key).filter_by(
-                user_id=self.user_id,
-                namespace=self.namespace,
-                **{ukv_cls.target_name: self.target}).count()
+        return len(self.rows)
 
     def __iter__(self):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        ns = self.target.db.query(
-            ukv_cls.key).filter_by(
-                user_id=self.user_id,
-                namespace=self.namespace,
-                **{ukv_cls.target_name: self.target})
-        return (x for (x,) in ns)
+        # Copy the keys, so items can be deleted while iterating
+        return iter(list(self.rows))
 
     iterkeys = __iter__
 
     def iteritems(self):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        kvpairs = self.target.db.query(
-            ukv_cls).filter_by(
-                user_id=self.user_id,
-                namespace=self.namespace,
-                **{ukv_cls.target_name: self.target})
-        return ((kvpair.key, json.loads(kvpair.value)) for kvpair in kvpairs)
+        return ((key, json.loads(kvpair.value))
+                for (key, kvpair) in self.rows.items())
 
     def __getitem__(self, key):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        value = self.target.db.query(
-            ukv_cls.value).filter_by(
-                user_id=self.user_id,
-                namespace=self.namespace,
-                key=key,
-                **{ukv_cls.target_name: self.target}).first()
-        if not value:
+        kvpair = self.rows.get(key, None)
+        if kvpair is None:
             raise IndexError()
-        (value,) = value
-        return json.loads(value)
+        return json.loads(kvpair.value)
 
     def __setitem__(self, key, value):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        kvpair = self.target.db.query(
-            ukv_cls).filter_by(
-                user_id=self.user_id,
-                namespace=self.namespace,
-                key=key,
-                **{ukv_cls.target_name: self.target}).first()
-        if kvpair:
+        rows = self.rows
+        kvpair = rows.get(key, None)
+        if kvpair is not None:
             kvpair.value = json.dumps(value)
         else:
-            self.target.db.add(ukv_cls(
-                user_id=self.user_id,
+            rows[key] = kvpair = self.kv_class(
                 namespace=self.namespace,
                 key=key,
                 value=json.dumps(value),
-                **{ukv_cls.target_name: self.target}))
+                **self.filter_args())
+            self.target.db.add(kvpair)
 
     def __delitem__(self, key):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        kvpair = self.target.db.query(
-            ukv_cls).filter_by(
-                user_id=self.user_id,
-                namespace=self.namespace,
-                key=key,
-                **{ukv_cls.target_name: self.target}).first()
-        if not kvpair:
+        kvpair = self.rows.pop(key, None)
+        if kvpair is None:
             raise IndexError()
         kvpair.delete()
 
     def __contains__(self, key):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        value = self.target.db.query(
-            ukv_cls.id).filter_by(
-                user_id=self.user_id,
-                namespace=self.namespace,
-                key=key,
-                **{ukv_cls.target_name: self.target}).first()
-        return value is not None
+        return key in self.rows
 
+    def get_many(self, keys=None):
+        """The values of the given keys (or of all keys) as a dict.
+        Missing keys are left out."""
+        rows = self.rows
+        if keys is None:
+            keys = rows.keys()
+        return {key: json.loads(rows[key].value)
+                for key in keys if key in rows}
 
-class NamespacedKVCollection(MutableMapping):
-    """View of the :py:class:`AbstractNamespacedKeyValue` for a given namespace as a python dict"""
+    def set_many(self, values):
+        "Set the values of many keys, from a dict"
+        for key, value in values.iteritems():
+            self[key] = value
 
-    def __init__(self, target, namespace):
-        self.target = target
-        self.namespace = namespace
 
-    def __len__(self):
-        kv_cls = self.target.namespaced_kv_class
-        return self.target.db.query(
-            kv_cls.key).filter_by(
-                namespace=self.namespace,
-                **{kv_cls.target_name: self.target}).count()
+class NamespacedUserKVCollection(KVCollection):
+    """View of the :py:class:`AbstractPerUserNamespacedKeyValue` for a given namespace as a python dict"""
 
-    def __iter__(self):
-        kv_cls = self.target.namespaced_kv_class
-        ns = self.target.db.query(
-            kv_cls.key).filter_by(
-                namespace=self.namespace,
-                **{kv_cls.target_name: self.target})
-        return (x for (x,) in ns)
+    def __init__(self, target, user_id, namespace, rows=None):
+        self.user_id = user_id
+        super(NamespacedUserKVCollection, self).__init__(
+            target, namespace, rows)
 
-    iterkeys = __iter__
+    @property
+    def kv_class(self):
+        return self.target.per_user_namespaced_kv_class
 
-    def iteritems(self):
-        kv_cls = self.target.namespaced_kv_class
-        kvpairs = self.target.db.query(
-            kv_cls).filter_by(
-                namespace=self.namespace,
-                **{kv_cls.target_name: self.target})
-        return ((kvpair.key, json.loads(kvpair.value)) for kvpair in kvpairs)
+    def filter_args(self):
+        return {"user_id": self.user_id,
+                self.kv_class.target_name: self.target}
 
-    def __getitem__(self, key):
-        kv_cls = self.target.namespaced_kv_class
-        value = self.target.db.query(
-            kv_cls.value).filter_by(
-                namespace=self.namespace,
-                key=key,
-                **{kv_cls.target_name: self.target}).first()
-        if not value:
-            raise IndexError()
-        (value,) = value
-        return json.loads(value)
+    def cache_key(self):
+        return (self.kv_class.__name__, self.target.id,
+                self.user_id, self.namespace)
 
-    def __setitem__(self, key, value):
-        kv_cls = self.target.namespaced_kv_class
-        kvpair = self.target.db.query(
-            kv_cls).filter_by(
-                namespace=self.namespace,
-                key=key,
-                **{kv_cls.target_name: self.target}).first()
-        if kvpair:
-            kvpair.value = json.dumps(value)
-        else:
-            self.target.db.add(kv_cls(
-                namespace=self.namespace,
-                key=key,
-                value=json.dumps(value),
-                **{kv_cls.target_name: self.target}))
 
-    def __delitem__(self, key):
-        kv_cls = self.target.namespaced_kv_class
-        kvpair = self.target.db.query(
-            kv_cls).filter_by(
-                namespace=self.namespace,
-                key=key,
-                **{kv_cls.target_name: self.target}).first()
-        if not kvpair:
-            raise IndexError()
-        kvpair.delete()
+class NamespacedKVCollection(KVCollection):
+    """View of the :py:class:`AbstractNamespacedKeyValue` for a given namespace as a python dict"""
 
-    def __contains__(self, key):
-        kv_cls = self.target.namespaced_kv_class
-        value = self.target.db.query(
-            kv_cls.id).filter_by(
-                namespace=self.namespace,
-                key=key,
-                **{kv_cls.target_name: self.target}).first()
-        return value is not None
+    @property
+    def kv_class(self):
+        return self.target.namespaced_kv_class
 
 
 class UserPreferenceCollection(NamespacedUserKVCollection):
@@ -350,18 +324,49 @@ class UserPreferenceCollection(NamespacedUserKVCollection):
         return len(self.dprefs.property_defaults)
 
     def __setitem__(self, key, value):
+        self.set_checked(key, value)
+
+    def set_checked(self, key, value, user_permissions=None):
+        """Set a value if the user can override it.
+
+        user_permissions are the user's permissions in the discussion,
+        if already known."""
         if key not in Preferences.preference_data_key_set:
             raise KeyError("Unknown property")
         pref_data = self.dprefs.get_preference_data()
         req_permission = pref_data.get(key, {}).get(
             self.ALLOW_OVERRIDE, False)
-        if (not req_permission) or not user_has_permission(
+        if not req_permission:
+            raise HTTPUnauthorized("Cannot edit")
+        if user_permissions is None:
+            allowed = user_has_permission(
                 self.target.id if self.target else None,
-                self.user_id, req_permission):
+                self.user_id, req_permission)
+        else:
+            allowed = req_permission in user_permissions
+        if not allowed:
             raise HTTPUnauthorized("Cannot edit")
         self.dprefs.validate(key, value)
         super(UserPreferenceCollection, self).__setitem__(key, value)
 
+    def set_many(self, values):
+        user_permissions = get_permissions(
+            self.user_id, self.target.id if self.target else None)
+        for key, value in values.iteritems():
+            self.set_checked(key, value, user_permissions)
+
+    def get_many(self, keys=None):
+        """The values of the given keys (or of all keys) as a dict,
+        from the user's values or the discussion's preferences."""
+        if keys is None:
+            values = dict(self.dprefs.snapshot)
+        else:
+            values = {key: self.dprefs[key] for key in keys
+                      if key in self.dprefs}
+        values.update(
+            super(UserPreferenceCollection, self).get_many(keys))
+        return values
+
     def safe_del(self, key, permissions=None):
         # always safe to go back to default
         del self[key]
@@ -380,7 +385,7 @@ class UserPreferenceCollection(NamespacedUserKVCollection):
         for k, v in super(UserPreferenceCollection, self).iteritems():
             keys.add(k)
             yield k, v
-        for k, v in self.dprefs.items():
+        for k, v in self.dprefs.snapshot.iteritems():
             if k not in keys:
                 yield k, v
 
@@ -405,93 +410,94 @@ class UserPreferenceCollection(NamespacedUserKVCollection):
         return key in self.dprefs
 
 
-class UserNsDict(MutableMapping):
-    """The dictonary of :py:class:NamespacedUserKVCollection, indexed by namespace, as a python dict"""
-    def __init__(self, target, user_id):
+class NsDict(MutableMapping):
+    """The dictonary of :py:class:NamespacedKVCollection, indexed by namespace, as a python dict
+
+    All the rows of the target are loaded in a single query when first
+    needed, and shared with the namespace collections."""
+    def __init__(self, target):
         self.target = target
-        self.user_id = user_id
+        self._namespaces = None
+
+    @property
+    def kv_class(self):
+        return self.target.namespaced_kv_class
+
+    def filter_args(self):
+        return {self.kv_class.target_name: self.target}
+
+    def make_collection(self, namespace, rows=None):
+        return NamespacedKVCollection(self.target, namespace, rows)
+
+    @property
+    def namespaces(self):
+        "The key-value rows of the target, by namespace and key"
+        if self._namespaces is None:
+            kvpairs = self.target.db.query(self.kv_class).filter_by(
+                **self.filter_args())
+            by_namespace = defaultdict(dict)
+            for kvpair in kvpairs:
+                by_namespace[kvpair.namespace][kvpair.key] = kvpair
+            cache = get_kv_rows_cache()
+            self._namespaces = {}
+            for namespace, rows in by_namespace.iteritems():
+                collection = self.make_collection(namespace)
+                # Rows already loaded by this request may hold changes
+                self._namespaces[namespace] = cache.setdefault(
+                    collection.cache_key(), rows)
+        return self._namespaces
 
     def __len__(self):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        return self.target.db.query(
-            ukv_cls.namespace).filter_by(
-                user_id=self.user_id,
-                **{ukv_cls.target_name: self.target}).distinct().count()
+        return sum(1 for x in self)
 
     def __iter__(self):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        ns = self.target.db.query(
-            ukv_cls.namespace).filter_by(
-                user_id=self.user_id,
-                **{ukv_cls.target_name: self.target}).distinct()
-        return (x for (x,) in ns)
+        return (namespace for (namespace, rows)
+                in self.namespaces.items() if rows)
 
     iterkeys = __iter__
 
     def iteritems(self):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        ns = self.target.db.query(
-            ukv_cls.namespace).filter_by(
-                user_id=self.user_id,
-                **{ukv_cls.target_name: self.target}).distinct()
-        return {x: NamespacedUserKVCollection(self.target, self.user_id, x)
-                for (x,) in ns}
+        return ((namespace, self[namespace]) for namespace in self)
 
     def __getitem__(self, key):
-        return NamespacedUserKVCollection(self.target, self.user_id, key)
+        if self._namespaces is None:
+            return self.make_collection(key)
+        rows = self._namespaces.get(key, None)
+        if rows is None:
+            # Not in the database
+            rows = self._namespaces[key] = get_kv_rows_cache().setdefault(
+                self.make_collection(key).cache_key(), {})
+        return self.make_collection(key, rows)
 
     def __setitem__(self, key, value):
         raise NotImplementedError()
 
     def __delitem__(self, key):
-        ukv_cls = self.target.per_user_namespaced_kv_class
-        self.target.db.query(
-            ukv_cls).filter_by(
-                user_id=self.user_id,
-                namespace=key,
-                **{ukv_cls.target_name: self.target}).delete()
-
-
-class NsDict(MutableMapping):
-    """The dictonary of :py:class:NamespacedKVCollection, indexed by namespace, as a python dict"""
-    def __init__(self, target):
-        self.target = target
-
-    def __len__(self):
-        kv_cls = self.target.namespaced_kv_class
-        return self.target.db.query(
-            kv_cls.namespace).filter_by(
-                **{kv_cls.target_name: self.target}).distinct().count()
-
-    def __iter__(self):
-        kv_cls = self.target.namespaced_kv_class
-        ns = self.target.db.query(
-            kv_cls.namespace).filter_by(
-                **{kv_cls.target_name: self.target}).distinct()
-        return (x for (x,) in ns)
+        collection = self.make_collection(key)
+        get_kv_rows_cache().pop(collection.cache_key(), None)
+        if self._namespaces is not None:
+            self._namespaces.pop(key, None)
+        self.target.db.query(self.kv_class).filter_by(
+            namespace=key, **self.filter_args()).delete()
 
-    iterkeys = __iter__
 
-    def iteritems(self):
-        kv_cls = self.target.namespaced_kv_class
-        ns = self.target.db.query(
-            kv_cls.namespace).filter_by(
-                **{kv_cls.target_name: self.target}).distinct()
-        return {x: NamespacedKVCollection(self.target, x)
-                for (x,) in ns}
+class UserNsDict(NsDict):
+    """The dictonary of :py:class:NamespacedUserKVCollection, indexed by namespace, as a python dict"""
+    def __init__(self, target, user_id):
+        super(UserNsDict, self).__init__(target)
+        self.user_id = user_id
 
-    def __getitem__(self, key):
-        return NamespacedKVCollection(self.target, key)
+    @property
+    def kv_class(self):
+        return self.target.per_user_namespaced_kv_class
 
-    def __setitem__(self, key, value):
-        raise NotImplementedError()
+    def filter_args(self):
+        return {"user_id": self.user_id,
+                self.kv_class.target_name: self.target}
 
-    def __delitem__(self, key):
-        kv_cls = self.target.namespaced_kv_class
-        self.target.db.query(
-            kv_cls).filter_by(
-                namespace=key,
-                **{kv_cls.target_name: self.target}).delete()
+    def make_collection(self, namespace, rows=None):
+        return NamespacedUserKVCollection(
+            self.target, self.user_id, namespace, rows)
 
 
 class DiscussionPerUserNamespacedKeyValue(
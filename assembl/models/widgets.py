@@ -4,13 +4,15 @@ In theory, arbitrary widgets could be added to Assembl.
 In reality, the set of widget behaviours is constrained here.
 """
 from itertools import chain
+from collections import defaultdict
 from datetime import datetime
 
 from sqlalchemy import (
-    Column, Integer, ForeignKey, Text, String, Boolean, DateTime, inspect)
+    Column, Integer, ForeignKey, Text, String, Boolean, DateTime, Index,
+    inspect)
 from sqlalchemy.sql import text, column
 from sqlalchemy.orm import (
-    relationship, backref, aliased, join)
+    relationship, backref, aliased, join, sessionmaker)
 from sqlalchemy.ext.associationproxy import association_proxy
 import simplejson as json
 
@@ -129,14 +131,90 @@ class Widget(DiscussionBoundBase):
     def state_json(self, val):
         self.state = json.dumps(val)
 
-    def get_user_state(self, user_id):
-        state = self.db.query(WidgetUserConfig).filter_by(
-            widget=self, user_id=user_id).first()
+    def get_user_states_summary_url(self):
+        return 'local:Widget/%d/user_states_summary' % (self.id,)
+
+    def get_user_state_text(self, user_id):
+        "The user's state, as the JSON text that is stored"
+        state = self.db.query(WidgetUserConfig.state).filter(
+            WidgetUserConfig.widget_id == self.id,
+            WidgetUserConfig.user_id == user_id).first()
         if state:
-            return state.state_json
+            return state[0] or '{}'
+
+    def get_user_state(self, user_id):
+        state = self.get_user_state_text(user_id)
+        if state is not None:
+            return json.loads(state)
+
+    "How many user states are read at a time"
+    USER_STATES_BATCH_SIZE = 1000
+
+    def iter_user_state_texts(self):
+        """The JSON text of each user's state, read in batches through a
+        server-side cursor, without loading the :py:class:`WidgetUserConfig`
+        objects"""
+        query = self.db.query(WidgetUserConfig.state).filter(
+            WidgetUserConfig.widget_id == self.id).order_by(
+            WidgetUserConfig.id).execution_options(stream_results=True)
+        for (state,) in query.yield_per(self.USER_STATES_BATCH_SIZE):
+            yield state or '{}'
 
     def get_all_user_states(self):
-        return [c.state_json for c in self.user_configs]
+        return [json.loads(state) for state in self.iter_user_state_texts()]
+
+    @classmethod
+    def stream_user_states(cls, bind, widget_id):
+        """The user states of a widget as a JSON list, in chunks made of
+        the stored JSON texts, which are not parsed.
+
+        Reads through a server-side cursor (``stream_results``, as
+        ``yield_per`` alone lets psycopg2 buffer the whole result), in a
+        session of its own which lives as long as the generator; so it can
+        be used as a response's app_iter. The request's session is committed
+        and closed by pyramid_tm before the app_iter is consumed, hence
+        this plain session, outside of the zope transaction; it only reads,
+        and is closed when the iteration ends."""
+        session = sessionmaker(bind=bind)()
+        try:
+            query = session.query(WidgetUserConfig.state).filter(
+                WidgetUserConfig.widget_id == widget_id).order_by(
+                WidgetUserConfig.id).execution_options(stream_results=True)
+            separator = "["
+            batch = []
+            for (state,) in query.yield_per(cls.USER_STATES_BATCH_SIZE):
+                if isinstance(state, unicode):
+                    state = state.encode('utf-8')
+                batch.append(state or '{}')
+                if len(batch) == cls.USER_STATES_BATCH_SIZE:
+                    yield separator + ",".join(batch)
+                    separator = ","
+                    batch = []
+            if batch:
+                yield separator + ",".join(batch)
+                separator = ","
+            yield "[]" if separator == "[" else "]"
+        finally:
+            session.close()
+
+    def get_user_states_summary(self):
+        """An aggregate of the user states, so clients do not need them all:
+        how many users have a state, and how many have each key of the
+        state. Subclasses may add to it in :py:meth:`summarize_user_state`."""
+        summary = {"num_users": 0, "keys": defaultdict(int)}
+        for state in self.iter_user_state_texts():
+            state = json.loads(state)
+            summary["num_users"] += 1
+            if isinstance(state, dict):
+                for key in state:
+                    summary["keys"][key] += 1
+            self.summarize_user_state(summary, state)
+        summary["keys"] = dict(summary["keys"])
+        return summary
+
+    def summarize_user_state(self, summary, state):
+        "Add a user's state to the summary of user states"
+        pass
 
     def set_user_state(self, user_state, user_id):
         state = self.db.query(WidgetUserConfig).filter_by(
@@ -700,10 +778,40 @@ class CreativitySessionWidget(IdeaCreatingWidget):
             num_participants=self.num_participants(),
             num_ideas=len(self.generated_idea_links))
 
+    def summarize_user_state(self, summary, state):
+        # The session's vote directive stores a JSON text of
+        # [{idea_id: rate}, ...] as session_user_vote
+        votes = state.get('session_user_vote', None) \
+            if isinstance(state, dict) else None
+        if not votes:
+            return
+        if isinstance(votes, basestring):
+            try:
+                votes = json.loads(votes)
+            except ValueError:
+                return
+        if not isinstance(votes, list):
+            return
+        votes_by_idea = summary.setdefault("votes", {})
+        for vote in votes:
+            if not isinstance(vote, dict):
+                continue
+            for idea_id, rate in vote.iteritems():
+                try:
+                    rate = int(rate)
+                except (TypeError, ValueError):
+                    continue
+                idea_votes = votes_by_idea.setdefault(
+                    idea_id, {"count": 0, "total": 0})
+                idea_votes["count"] += 1
+                idea_votes["total"] += rate
+
     def num_participants(self):
         participant_ids = set()
         # participants from user_configs
-        participant_ids.update((c.user_id for c in self.user_configs))
+        participant_ids.update((c[0] for c in self.db.query(
+            WidgetUserConfig.user_id).filter(
+                WidgetUserConfig.widget_id == self.id)))
         # Participants from comments
         participant_ids.update((c[0] for c in self.db.query(
             Post.creator_id).join(IdeaContentWidgetLink).filter(
@@ -970,6 +1078,8 @@ class TokenVotingWidget(VotingWidget):
 
 class WidgetUserConfig(DiscussionBoundBase):
     __tablename__ = "widget_user_config"
+    __table_args__ = (
+        Index('ix_widget_user_config_widget_user', 'widget_id', 'user_id'),)
 
     id = Column(Integer, primary_key=True)
 
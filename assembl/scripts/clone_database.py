@@ -1,8 +1,11 @@
 """Clone all data from a database to another. Mostly useful for database migration."""
+import os
 import argparse
 import logging.config
 import traceback
 import pdb
+from threading import Thread
+from Queue import Queue
 
 from sqlalchemy import (
     Table, Column, String, insert, select, delete, create_engine, update)
@@ -82,11 +85,17 @@ def copy_table(source_session, dest_session, source_table, dest_table):
             values = next_batch
     else:
         dest_session.execute(dest_table.insert(), values)
+    reset_sequence(source_session, dest_session, source_table, dest_table)
+
+
+def reset_sequence(source_session, dest_session, source_table, dest_table):
     if str(dest_session.bind.url).startswith('postgresql'):
         idx_col = dest_table.c.get("id", None)
         if idx_col is not None and not idx_col.foreign_keys:
             (max_id,) = source_session.query(
                 'max(id) from "%s"' % (source_table.name,)).first()
+            if max_id is None:
+                return
             if dest_table.name in history_tables:
                 max_id = max(max_id, get_sequence(
                     source_session, source_table.fullname+"_idsequence"))
@@ -95,6 +104,132 @@ def copy_table(source_session, dest_session, source_table, dest_table):
                 set_sequence(dest_session, dest_table.fullname+"_id_seq", max_id)
 
 
+# Size of the reads from the pipe between COPY TO and COPY FROM
+COPY_BUFFER_SIZE = 1 << 16
+
+
+def is_postgres(session):
+    return str(session.bind.url).startswith('postgresql')
+
+
+def self_referencing_constraints(connection, table):
+    """Names of the foreign key constraints of a table to itself"""
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT conname FROM pg_constraint WHERE contype = 'f' "
+        "AND conrelid = %s::regclass AND confrelid = conrelid",
+        (table.fullname,))
+    return [name for (name,) in cursor.fetchall()]
+
+
+def set_constraints_deferrable(engine, tables, deferrable=True):
+    """Make the constraints of tables to themselves deferred or not, so
+    recursive tables can be copied in any order."""
+    connection = engine.raw_connection()
+    try:
+        preparer = engine.dialect.identifier_preparer
+        cursor = connection.cursor()
+        for table in tables:
+            for name in self_referencing_constraints(connection, table):
+                cursor.execute(
+                    "ALTER TABLE %s ALTER CONSTRAINT %s %s" % (
+                        preparer.format_table(table), preparer.quote(name),
+                        "DEFERRABLE INITIALLY DEFERRED" if deferrable
+                        else "NOT DEFERRABLE"))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def stream_table(source_engine, dest_engine, source_table, dest_table,
+                 snapshot=None):
+    """Copy a table with COPY TO STDOUT and COPY FROM STDIN, through a
+    pipe, so memory use does not depend on the size of the table.
+
+    The source is read in the exported ``snapshot``, if given, so tables
+    copied in parallel are consistent."""
+    preparer = dest_engine.dialect.identifier_preparer
+    query = select([maybe_cast(c) for c in source_table.c])
+    copy_out = "COPY (%s) TO STDOUT" % (query.compile(source_engine),)
+    copy_in = "COPY %s (%s) FROM STDIN" % (
+        preparer.format_table(dest_table),
+        ", ".join(preparer.quote(c.name) for c in dest_table.c))
+    source_connection = source_engine.raw_connection()
+    dest_connection = dest_engine.raw_connection()
+    read_fd, write_fd = os.pipe()
+    reader, writer = os.fdopen(read_fd, 'rb'), os.fdopen(write_fd, 'wb')
+    errors = []
+
+    def produce():
+        try:
+            cursor = source_connection.cursor()
+            if snapshot:
+                cursor.execute(
+                    "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+                cursor.execute("SET TRANSACTION SNAPSHOT %s", (snapshot,))
+            cursor.copy_expert(copy_out, writer)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            writer.close()
+    producer = Thread(target=produce)
+    try:
+        producer.start()
+        dest_connection.cursor().copy_expert(
+            copy_in, reader, size=COPY_BUFFER_SIZE)
+        reader.close()
+        producer.join()
+        if errors:
+            raise errors[0]
+        dest_connection.commit()
+    finally:
+        # Closing the pipe stops the producer if the COPY FROM failed
+        reader.close()
+        producer.join()
+        source_connection.close()
+        dest_connection.close()
+
+
+def stream_tables(source_engine, dest_engine, tables,
+                  source_tables_by_name, workers=4, snapshot=None):
+    """Stream tables, in parallel, each after the tables it refers to."""
+    pending = {table.name: table for table in tables}
+    dependencies = {
+        table.name: {
+            fk.column.table.name for fk in table.foreign_keys
+            if fk.column.table.name != table.name
+            and fk.column.table.name in pending}
+        for table in tables}
+    done = set()
+    running = set()
+    results = Queue()
+
+    def copy(table):
+        try:
+            stream_table(source_engine, dest_engine,
+                         source_tables_by_name[table.name], table, snapshot)
+            results.put((table.name, None))
+        except Exception as e:
+            traceback.print_exc()
+            results.put((table.name, e))
+
+    while pending or running:
+        ready = [name for name in pending if dependencies[name] <= done]
+        assert ready or running, \
+            "Circular dependency between tables: " + ", ".join(pending)
+        for name in ready[:workers - len(running)]:
+            running.add(name)
+            Thread(target=copy, args=(pending.pop(name),)).start()
+        name, error = results.get()
+        running.remove(name)
+        if error is not None:
+            # Let the other copies finish before failing
+            while running:
+                running.remove(results.get()[0])
+            raise error
+        done.add(name)
+
+
 def engine_from_settings(config, full_config=False):
     settings = get_appsettings(config, 'assembl')
     if settings['sqlalchemy.url'].startswith('virtuoso:'):
@@ -119,7 +254,12 @@ def engine_from_settings(config, full_config=False):
     return (metadata, session)
 
 
-def copy_database(source_config, dest_config):
+def copy_database(source_config, dest_config, stream=False, workers=4):
+    """Copy all tables.
+
+    By default, tables are copied in a single transaction, each through
+    memory. With ``stream``, PostgreSQL tables are copied with COPY,
+    by parallel workers, each table in its own transaction."""
     dest_metadata, dest_session = engine_from_settings(
         dest_config, True)
     dest_tables = dest_metadata.sorted_tables
@@ -129,6 +269,9 @@ def copy_database(source_config, dest_config):
         table.name: table.tometadata(source_metadata, source_metadata.schema)
         for table in dest_tables
     }
+    if stream:
+        assert is_postgres(source_session) and is_postgres(dest_session),\
+            "Streaming copy needs PostgreSQL databases"
 
     for table in reversed(dest_tables):
         if table.name in recursive_tables:
@@ -136,10 +279,30 @@ def copy_database(source_config, dest_config):
             dest_session.execute(update(table).values(**{colname: None}))
         dest_session.execute(delete(table))
 
-    for table in dest_tables:
-        copy_table(
-            source_session, dest_session,
-            source_tables_by_name[table.name], table)
+    if stream:
+        dest_session.commit()
+        # All workers read the source as of this transaction
+        source_session.execute(
+            "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        snapshot = source_session.execute(
+            "SELECT pg_export_snapshot()").scalar()
+        dest_engine = dest_session.bind
+        set_constraints_deferrable(dest_engine, dest_tables)
+        try:
+            stream_tables(
+                source_session.bind, dest_engine, dest_tables,
+                source_tables_by_name, workers, snapshot)
+        finally:
+            set_constraints_deferrable(dest_engine, dest_tables, False)
+        for table in dest_tables:
+            reset_sequence(
+                source_session, dest_session,
+                source_tables_by_name[table.name], table)
+    else:
+        for table in dest_tables:
+            copy_table(
+                source_session, dest_session,
+                source_tables_by_name[table.name], table)
     dest_session.commit()
 
 
@@ -154,12 +317,18 @@ if __name__ == '__main__':
         help="""configuration file with target database configuration.""")
     parser.add_argument("--debug", action="store_true", default=False,
                         help="enter pdb on failure")
+    parser.add_argument(
+        "--stream", action="store_true", default=False,
+        help="copy with COPY, with bounded memory (PostgreSQL only)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="number of tables streamed in parallel")
 
     args = parser.parse_args()
     assert args.source_config != args.dest_config,\
         "source and destination must be different!"
     try:
-        copy_database(args.source_config, args.dest_config)
+        copy_database(
+            args.source_config, args.dest_config, args.stream, args.workers)
     except Exception as e:
         traceback.print_exc()
         if args.debug:
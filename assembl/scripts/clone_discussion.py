@@ -19,6 +19,9 @@ from sqlalchemy.orm import (
     class_mapper, undefer, with_polymorphic, sessionmaker)
 from sqlalchemy.orm.properties import ColumnProperty
 import transaction
+from sqlalchemy import (
+    MetaData, Table, Column, Integer, String, Index, Sequence, select,
+    literal, bindparam, case, func, text)
 from sqlalchemy.sql.visitors import ClauseVisitor
 from sqlalchemy.sql.expression import and_
 
@@ -26,7 +29,7 @@ from assembl.auth import SYSTEM_ROLES, ASSEMBL_PERMISSIONS
 from assembl.lib.config import set_config, get_config
 from assembl.lib.sqla import (
     configure_engine, get_session_maker, make_session_maker, get_metadata,
-    session_maker_is_initialized)
+    session_maker_is_initialized, mark_changed)
 from assembl.lib.zmqlib import configure_zmq
 from assembl.lib.model_watcher import configure_model_watcher
 from assembl.lib.raven_client import setup_raven, capture_exception
@@ -332,10 +335,10 @@ class JoinColumnsVisitor(ClauseVisitor):
             self.missing.append(column)
 
 
-def delete_discussion(session, discussion_id):
-    from assembl.models import (
-        Discussion, DiscussionBoundBase, Preferences, LangStringEntry)
-    # delete anything related first
+def get_discussion_classes():
+    """The mapped classes by table, and the discussion-bound classes
+    which are the roots of their hierarchy."""
+    from assembl.models import DiscussionBoundBase
     classes = DiscussionBoundBase._decl_class_registry.itervalues()
     classes_by_table = {
         cls.__dict__.get('__table__', None): cls for cls in classes
@@ -345,6 +348,27 @@ def delete_discussion(session, discussion_id):
         issubclass(cls, DiscussionBoundBase) and (not isabstract(cls))
         and isabstract(cls.mro()[1]),
         classes_by_table.values()))
+    return classes_by_table, concrete_classes
+
+
+def discussion_rows_query(session, cls, discussion_id, classes_by_table,
+                          *columns):
+    """A query on the rows of a class that belong to a discussion,
+    joining as needed for the discussion conditions."""
+    query = session.query(*(columns or (cls.id,)))
+    conds = cls.get_discussion_conditions(discussion_id)
+    assert conds
+    cond = and_(*conds)
+    v = JoinColumnsVisitor(cls, query, classes_by_table)
+    v.traverse(cond)
+    return v.final_query().filter(cond)
+
+
+def delete_discussion(session, discussion_id):
+    from assembl.models import (
+        Discussion, DiscussionBoundBase, Preferences, LangStringEntry)
+    # delete anything related first
+    classes_by_table, concrete_classes = get_discussion_classes()
     concrete_classes.add(Preferences)
     concrete_classes.add(LangStringEntry)
     tables = DiscussionBoundBase.metadata.sorted_tables
@@ -597,6 +621,227 @@ def clone_discussion(
     return copy
 
 
+# Tables which are not cloned by bulk_clone_discussion: notifications
+# would be sent again, and activity aggregates and read states hold the
+# original ids in blobs. Read states are rebuilt after the copy.
+BULK_SKIP_TABLES = {
+    "notification", "discussion_activity_bucket",
+    "discussion_activity_watermark", "post_read_state"}
+
+# Tables whose rows belong to the rows that refer to them
+BULK_OWNED_BY_REFERENCE = {"langstring", "preferences"}
+
+# Tables whose rows belong to a parent row, with the parent column
+BULK_OWNED_CHILDREN = {"langstring_entry": "langstring_id"}
+
+
+class IdSpaces(object):
+    """Groups integer columns by the sequence of the ids they hold.
+
+    A primary key without foreign key, and the foreign keys which refer
+    to it, are in the space of its table's sequence. The identity table
+    of a :py:class:`assembl.lib.history_mixin.HistoryMixin` class shares
+    the id sequence of the class."""
+
+    def __init__(self, classes_by_table, tables):
+        from assembl.models import HistoryMixin
+        self.tables = {table.name: table for table in tables}
+        self.aliases = {}
+        for table, cls in classes_by_table.iteritems():
+            if table is not None and issubclass(cls, HistoryMixin):
+                self.aliases[cls.identity_table.c.id] = cls.__table__.c.id
+
+    def space_column(self, column):
+        "The primary key column that defines the space of a column"
+        if column in self.aliases:
+            return self.space_column(self.aliases[column])
+        if len(column.foreign_keys) == 1:
+            return self.space_column(next(iter(column.foreign_keys)).column)
+        if column.primary_key and len(column.table.primary_key) == 1 \
+                and isinstance(column.type, Integer):
+            return column
+        return None
+
+    def space(self, column):
+        column = self.space_column(column)
+        if column is not None:
+            return "%s.%s" % (column.table.name, column.name)
+
+    def primary_space(self, table):
+        if len(table.primary_key) == 1:
+            return self.space(next(iter(table.primary_key)))
+
+    def sequence_name(self, connection, space):
+        table_name, column_name = space.split('.')
+        column = self.tables[table_name].c[column_name]
+        if isinstance(column.default, Sequence):
+            return column.default.name
+        return connection.execute(select([func.pg_get_serial_sequence(
+            column.table.fullname, column.name)])).scalar()
+
+
+def bulk_clone_discussion(session, discussion_id, new_slug):
+    """Clone a discussion within a PostgreSQL database, with one
+    ``INSERT ... SELECT`` per table.
+
+    The ids of the rows to copy are collected per id space, then each space
+    gets a block of new ids from its sequence, so new ids are old ids plus
+    an offset. Users, roles and other objects outside of the discussion
+    are shared with the original. Returns the id of the new discussion."""
+    from assembl.models import (
+        DiscussionBoundBase, HistoryMixin, PostReadState)
+    connection = session.connection()
+    classes_by_table, concrete_classes = get_discussion_classes()
+    tables = [t for t in DiscussionBoundBase.metadata.sorted_tables
+              if t.name not in BULK_SKIP_TABLES]
+    spaces = IdSpaces(classes_by_table, tables)
+    selection = Table(
+        "clone_selection", MetaData(),
+        Column("space", String, nullable=False),
+        Column("old_id", Integer, nullable=False),
+        Index("clone_selection_idx", "space", "old_id"),
+        prefixes=["TEMPORARY"])
+    selection.create(connection)
+
+    def selected(space):
+        return select([selection.c.old_id]).where(
+            selection.c.space == space)
+
+    def select_ids(space, query):
+        connection.execute(selection.insert().from_select(
+            ["space", "old_id"], select([literal(space), query])))
+
+    # The rows of the discussion
+    for cls in concrete_classes:
+        if cls.__table__.name in BULK_SKIP_TABLES:
+            continue
+        space = spaces.primary_space(cls.__table__)
+        ids = discussion_rows_query(
+            session, cls, discussion_id, classes_by_table).subquery()
+        select_ids(space, ids.c.id)
+        if issubclass(cls, HistoryMixin):
+            base_ids = discussion_rows_query(
+                session, cls, discussion_id, classes_by_table,
+                cls.base_id).distinct().subquery()
+            select_ids(space, base_ids.c.base_id)
+    # The langstrings and preferences they use
+    for table in tables:
+        if table.name in BULK_OWNED_BY_REFERENCE:
+            continue
+        space = spaces.primary_space(table)
+        if space is None:
+            continue
+        for column in table.c:
+            column_space = spaces.space(column)
+            if column_space is None or column.primary_key:
+                continue
+            if column_space.split('.')[0] in BULK_OWNED_BY_REFERENCE:
+                select_ids(column_space, select([column]).where(and_(
+                    column != None,
+                    table.primary_key.columns.values()[0].in_(
+                        selected(space)))).distinct().alias().c[column.name])
+    # The entries of those langstrings
+    for table_name, parent_column in BULK_OWNED_CHILDREN.iteritems():
+        table = spaces.tables[table_name]
+        parent_column = table.c[parent_column]
+        key = table.primary_key.columns.values()[0]
+        select_ids(spaces.primary_space(table), select([key]).where(
+            parent_column.in_(selected(spaces.space(parent_column)))
+        ).alias().c[key.name])
+
+    # Reserve a block of ids for each space
+    offsets = {}
+    for (space, low, high) in connection.execute(select([
+            selection.c.space, func.min(selection.c.old_id),
+            func.max(selection.c.old_id)]).group_by(
+            selection.c.space)).fetchall():
+        sequence = spaces.sequence_name(connection, space)
+        start = connection.execute(select([func.nextval(sequence)])).scalar()
+        connection.execute(select([func.setval(sequence, start + high - low)]))
+        offsets[space] = start - low
+
+    def new_value(column, space):
+        return case([(column.in_(selected(space)),
+                      column + offsets[space])], else_=column)
+
+    overrides = {
+        ("discussion", "slug"): new_slug,
+        ("preferences", "name"): "discussion_" + new_slug,
+    }
+    table_order = {table.name: n for (n, table) in enumerate(tables)}
+    forward_references = []
+    for table in tables:
+        primary_space = spaces.primary_space(table)
+        conditions = []
+        if primary_space in offsets:
+            conditions.append(table.primary_key.columns.values()[0].in_(
+                selected(primary_space)))
+        elif primary_space is None:
+            # Association tables: copy rows between copied rows
+            conditions.extend([
+                column.in_(selected(spaces.space(column)))
+                for column in table.c if column.foreign_keys
+                and spaces.space(column) in offsets])
+        if not conditions:
+            continue
+        columns = []
+        values = []
+        for column in table.c:
+            space = spaces.space(column)
+            columns.append(column.name)
+            if (table.name, column.name) in overrides:
+                values.append(bindparam(
+                    column.name, overrides[(table.name, column.name)],
+                    type_=column.type))
+            elif space not in offsets:
+                values.append(column)
+            elif column.primary_key and not column.foreign_keys:
+                values.append(column + offsets[space])
+            elif table_order.get(next(iter(
+                    column.foreign_keys)).column.table.name, -1) > \
+                    table_order[table.name]:
+                # Refers to a table not copied yet; set it afterwards
+                assert column.nullable
+                forward_references.append((table, column, space))
+                values.append(literal(None, type_=column.type))
+            else:
+                values.append(new_value(column, space))
+        connection.execute(table.insert().from_select(
+            columns, select(values).where(and_(*conditions))))
+    for (table, column, space) in forward_references:
+        key = table.primary_key.columns.values()[0]
+        offset = offsets[spaces.primary_space(table)]
+        old = table.alias()
+        connection.execute(table.update().where(
+            key.in_(select([selection.c.old_id + offset]).where(
+                selection.c.space == spaces.primary_space(table)))
+        ).values({column.name: select([
+            new_value(old.c[column.name], space)]).where(
+            old.c[key.name] == key - offset).correlate(table).as_scalar()}))
+
+    # Post ancestry is a list of post ids
+    post = spaces.tables["post"]
+    content_space = spaces.space(post.c.id)
+    if content_space in offsets:
+        connection.execute(text(
+            "UPDATE post SET ancestry = (SELECT string_agg("
+            "(CAST(ancestor AS INTEGER) + :offset) || ',', '' "
+            "ORDER BY position) FROM unnest(string_to_array("
+            "rtrim(ancestry, ','), ',')) WITH ORDINALITY "
+            "AS ancestors(ancestor, position)) "
+            "WHERE ancestry <> '' AND id IN ("
+            "SELECT old_id + :offset FROM clone_selection "
+            "WHERE space = :space)"),
+            offset=offsets[content_space], space=content_space)
+    selection.drop(connection)
+    new_discussion_id = discussion_id + offsets[spaces.primary_space(
+        spaces.tables["discussion"])]
+    # Read state bitmaps hold post ids; recompute them from the copied views
+    PostReadState.rebuild(session, new_discussion_id)
+    mark_changed(session)
+    return new_discussion_id
+
+
 def engine_from_settings(config, full_config=False):
     settings = get_appsettings(config, 'assembl')
     if settings['sqlalchemy.url'].startswith('virtuoso:'):
@@ -624,7 +869,7 @@ def engine_from_settings(config, full_config=False):
 
 
 def copy_discussion(source_config, dest_config, source_slug, dest_slug,
-                    delete=False, debug=False, permissions=None):
+                    delete=False, debug=False, permissions=None, bulk=False):
     if (session_maker_is_initialized() and abspath(source_config) == get_config()["__file__"]):
         # not running from script
         dest_session = get_session_maker()()
@@ -668,8 +913,15 @@ def copy_discussion(source_config, dest_config, source_slug, dest_slug,
                 exit(0)
         from assembl.models import Role, Permission, DiscussionPermission
         with dest_session.no_autoflush:
-            copy = clone_discussion(
-                source_session, discussion.id, dest_session, dest_slug)
+            if bulk:
+                assert source_session == dest_session, \
+                    "Bulk cloning only works within a database"
+                copy = dest_session.query(Discussion).get(
+                    bulk_clone_discussion(
+                        dest_session, discussion.id, dest_slug))
+            else:
+                copy = clone_discussion(
+                    source_session, discussion.id, dest_session, dest_slug)
             for (role, permission) in permissions:
                 role = dest_session.query(Role).filter_by(name=role).one()
                 permission = dest_session.query(Permission).filter_by(
@@ -702,10 +954,13 @@ if __name__ == '__main__':
     parser.add_argument("-p", "--permissions", action="append", default=[],
                         help="Add a role+permission pair to the copy "
                         "(eg system.Authenticated+admin_discussion)")
+    parser.add_argument(
+        "-b", "--bulk", action="store_true", default=False,
+        help="clone table by table in SQL (PostgreSQL, same database only)")
     args = parser.parse_args()
     with transaction.manager:
         session = copy_discussion(
             args.source_db_configuration or args.configuration,
             args.configuration,
             args.discussion, args.new_name or args.discussion + "_copy",
-            args.delete, args.debug, args.permissions)
+            args.delete, args.debug, args.permissions, args.bulk)
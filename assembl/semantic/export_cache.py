@@ -0,0 +1,151 @@
+"""Cached JSON-LD exports of discussions, kept current incrementally.
+
+Each export is cached with the :py:mod:`assembl.lib.content_version` of
+its discussion (and of the objects outside of discussions, such as
+profiles) that it was computed at. A stale export is still served, while
+a celery task brings it up to date. When exporting from SQL, the task keeps
+the serialized node objects of each subject, and only re-exports the
+subjects that changed since; a change of participants, or a change log
+that does not go back far enough, forces a full export.
+"""
+from itertools import chain
+from time import time
+
+from dogpile.cache.api import NO_VALUE
+
+from ..lib.content_version import get_region, get_version
+
+PUBLIC_EXPORT = 'discussion_jsonld'
+PRIVATE_EXPORT = 'userprivate_jsonld'
+
+# How long a scheduled refresh prevents scheduling another one, in seconds
+REFRESH_DELAY = 300
+
+
+def export_key(discussion_id, kind):
+    return "%s:%d" % (kind, discussion_id)
+
+
+def current_versions(discussion_id):
+    return (get_version(discussion_id), get_version('*'))
+
+
+def get_export(db, discussion_id, private=False):
+    """The JSON-LD export of a discussion.
+
+    Computed synchronously the first time only; afterwards, a stale export
+    is returned as is, and refreshed in the background."""
+    kind = PRIVATE_EXPORT if private else PUBLIC_EXPORT
+    region = get_region()
+    cached = region.get(export_key(discussion_id, kind))
+    if cached is NO_VALUE:
+        return refresh_export(db, discussion_id, private)
+    version, global_version, body = cached
+    discussion_version, profiles_version = current_versions(discussion_id)
+    if (version, global_version) != (
+            discussion_version.version, profiles_version.version):
+        schedule_refresh(discussion_id, private)
+    return body
+
+
+def schedule_refresh(discussion_id, private=False):
+    kind = PRIVATE_EXPORT if private else PUBLIC_EXPORT
+    region = get_region()
+    key = export_key(discussion_id, kind) + ":refreshing"
+    scheduled = region.get(key)
+    if scheduled is not NO_VALUE and time() - scheduled < REFRESH_DELAY:
+        return
+    region.set(key, time())
+    from ..tasks.notify import refresh_discussion_export
+    refresh_discussion_export.delay(discussion_id, private)
+
+
+def refresh_export(db, discussion_id, private=False):
+    """Bring the cached export of a discussion up to date, and return it."""
+    from ..models import Discussion
+    kind = PRIVATE_EXPORT if private else PUBLIC_EXPORT
+    region = get_region()
+    key = export_key(discussion_id, kind)
+    # Read the versions before the data, so the data is at least as recent
+    discussion_version, profiles_version = current_versions(discussion_id)
+    versions = (discussion_version.version, profiles_version.version)
+    if Discussion.using_virtuoso:
+        body = virtuoso_export(discussion_id, private)
+    else:
+        nodes = sql_export_nodes(
+            db, discussion_id, private, discussion_version, profiles_version)
+        body = sql_export_body(db, discussion_id, private, nodes)
+    region.set(key, versions + (body,))
+    region.delete(key + ":refreshing")
+    return body
+
+
+def virtuoso_export(discussion_id, private):
+    from .virtuoso_mapping import AssemblQuadStorageManager
+    aqsm = AssemblQuadStorageManager()
+    if private:
+        cg = aqsm.participants_private_as_graph(discussion_id)
+        return aqsm.graph_as_jsonld(cg)
+    return aqsm.as_jsonld(discussion_id)
+
+
+def exporter_for(db, discussion_id, private):
+    from .sql_export import SqlQuadExporter
+    sections = SqlQuadExporter.private_sections if private \
+        else SqlQuadExporter.public_sections
+    return SqlQuadExporter(db, discussion_id, sections)
+
+
+def sql_export_nodes(
+        db, discussion_id, private, discussion_version, profiles_version):
+    """The node objects of the export, by section then subject.
+
+    Updates and caches the previous nodes if possible."""
+    kind = PRIVATE_EXPORT if private else PUBLIC_EXPORT
+    region = get_region()
+    key = export_key(discussion_id, kind) + ":nodes"
+    exporter = exporter_for(db, discussion_id, private)
+    participants = sorted(exporter.participant_ids)
+    changed = None
+    cached = region.get(key)
+    if cached is not NO_VALUE:
+        (version, global_version, old_participants, nodes) = cached
+        if old_participants == participants:
+            changed = discussion_version.changed_since(version)
+            profile_changes = profiles_version.changed_since(global_version)
+            if changed is not None and profile_changes is not None:
+                changed |= profile_changes
+            else:
+                changed = None
+    if changed is None:
+        nodes = {}
+        for section in exporter.sections:
+            section_nodes = nodes[section] = {}
+            for subject, node in exporter.jsonld_nodes(section):
+                section_nodes.setdefault(subject, []).append(node)
+    elif changed:
+        ids_by_typename = {}
+        for uri in changed:
+            if uri.startswith('local:') and '/' in uri:
+                typename, id = uri[6:].split('/', 1)
+                if id.isdigit():
+                    ids_by_typename.setdefault(typename, []).append(int(id))
+        for section in exporter.sections:
+            section_nodes = nodes.setdefault(section, {})
+            for uri in changed:
+                section_nodes.pop(uri, None)
+            for subject, node in exporter.jsonld_nodes(
+                    section, ids_by_typename):
+                section_nodes.setdefault(subject, []).append(node)
+    if changed is None or changed:
+        region.set(key, (
+            discussion_version.version, profiles_version.version,
+            participants, nodes))
+    return nodes
+
+
+def sql_export_body(db, discussion_id, private, nodes):
+    exporter = exporter_for(db, discussion_id, private)
+    return ''.join(exporter.jsonld_chunks(
+        (section, chain.from_iterable(nodes.get(section, {}).itervalues()))
+        for section in exporter.sections))
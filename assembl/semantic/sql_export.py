@@ -0,0 +1,247 @@
+"""Export a discussion as RDF directly from the relational data.
+
+This follows the RDF declarations of the models (``rdf_class`` and the
+``QuadMapPatternS`` in column ``info``), like the Virtuoso linked data
+views, but runs ordinary SQLAlchemy queries and yields the result
+incrementally. It needs neither Virtuoso nor an in-memory graph.
+
+The ``special_quad_patterns`` of the models are expressed in terms of
+Virtuoso IRI classes and SQL aliases, and are not exported here.
+"""
+from sqlalchemy.orm import sessionmaker
+from rdflib import URIRef, Literal
+import simplejson as json
+
+from ..lib.sqla import class_registry, get_target_class
+from . import context_url
+from .namespaces import RDF
+from .virtuoso_mapping import (
+    AssemblQuadStorageManager, DISCUSSION_DATA_SECTION, USER_SECTION,
+    PRIVATE_USER_SECTION)
+
+
+class SqlQuadExporter(object):
+    """Generates the quads of a discussion, one row at a time."""
+
+    public_sections = (DISCUSSION_DATA_SECTION, USER_SECTION)
+    private_sections = (PRIVATE_USER_SECTION,)
+
+    def __init__(self, session, discussion_id, sections=public_sections,
+                 chunk_size=1000):
+        self.session = session
+        self.discussion_id = discussion_id
+        self.sections = sections
+        self.chunk_size = chunk_size
+        self.local_uri = AssemblQuadStorageManager.local_uri()
+        self._participant_ids = None
+
+    @classmethod
+    def stream(cls, bind, discussion_id, format='jsonld', **kwargs):
+        """Export in a session of its own, which lives as long as the
+        generator; so it can be used as a response's app_iter."""
+        session = sessionmaker(bind=bind)()
+        try:
+            exporter = cls(session, discussion_id, **kwargs)
+            chunks = exporter.as_jsonld() if format == 'jsonld' \
+                else exporter.as_nquads()
+            for chunk in chunks:
+                yield chunk
+        finally:
+            session.close()
+
+    @property
+    def participant_ids(self):
+        if self._participant_ids is None:
+            from ..models import Discussion
+            discussion = self.session.query(Discussion).get(
+                self.discussion_id)
+            self._participant_ids = list(discussion.get_participants(True))
+        return self._participant_ids
+
+    def iri(self, cls, id):
+        return cls.uri_generic(id, self.local_uri)
+
+    def class_patterns(self, cls, section):
+        """The (predicate, attribute, object function) triples declared
+        directly on a class for a section."""
+        mapper = cls.__mapper__
+        class_sections = getattr(
+            cls, 'rdf_sections', (DISCUSSION_DATA_SECTION,))
+        patterns = []
+        for prop in mapper.iterate_properties:
+            if prop.parent is not mapper:
+                # Exported with the class that defines it
+                continue
+            if hasattr(prop, 'columns'):
+                column = prop.columns[0]
+                qmp = column.info.get('rdf', None)
+            elif len(getattr(prop, 'local_columns', ())) == 1 \
+                    and prop.secondary is None:
+                column = next(iter(prop.local_columns))
+                qmp = prop.info.get('rdf', None)
+            else:
+                continue
+            if qmp is None or section not in (qmp.sections or class_sections):
+                continue
+            attr = getattr(cls, mapper.get_property_by_column(column).key)
+            patterns.append((
+                qmp.predicate, attr, self.object_function(column, qmp)))
+        return patterns
+
+    def object_function(self, column, qmp):
+        obj = qmp.object
+        if isinstance(obj, (URIRef, Literal)):
+            return lambda value: obj
+        # An applied IRI class, such as AgentProfile.agent_as_account_iri
+        iri_class = getattr(obj, 'iri_class', None)
+        pattern = getattr(iri_class, 'pattern', None)
+        if pattern:
+            return lambda value: URIRef(pattern % (value,))
+        target_class = get_target_class(column) \
+            if column.foreign_keys else None
+        if target_class is not None:
+            return lambda value: URIRef(self.iri(target_class, value))
+        return Literal
+
+    def exported_classes(self, section):
+        from ..models import (
+            DiscussionBoundBase, AgentProfile, AbstractAgentAccount)
+        for cls in class_registry.itervalues():
+            if getattr(cls, '__mapper__', None) is None \
+                    or getattr(cls, 'id', None) is None:
+                continue
+            if issubclass(cls, DiscussionBoundBase):
+                if getattr(cls.get_discussion_conditions,
+                           '__isabstractmethod__', None):
+                    continue
+            elif not issubclass(cls, (AgentProfile, AbstractAgentAccount)):
+                continue
+            rdf_class = cls.__dict__.get('rdf_class', None)
+            if rdf_class is not None and section not in getattr(
+                    cls, 'rdf_sections', (DISCUSSION_DATA_SECTION,)):
+                rdf_class = None
+            patterns = self.class_patterns(cls, section)
+            if rdf_class is not None or patterns:
+                yield cls, rdf_class, patterns
+
+    def class_rows(self, cls, patterns, ids=None):
+        from ..models import (
+            DiscussionBoundBase, AgentProfile, AbstractAgentAccount)
+        if issubclass(cls, (AgentProfile, AbstractAgentAccount)) \
+                and not self.participant_ids:
+            return ()
+        query = self.session.query(cls.id, *[p[1] for p in patterns])
+        if issubclass(cls, DiscussionBoundBase):
+            query = query.filter(*cls.get_discussion_conditions(
+                self.discussion_id))
+        elif issubclass(cls, AgentProfile):
+            query = query.filter(cls.id.in_(self.participant_ids))
+        elif issubclass(cls, AbstractAgentAccount):
+            query = query.filter(cls.profile_id.in_(self.participant_ids))
+        if ids is not None:
+            query = query.filter(cls.id.in_(ids))
+        conditions = cls.base_conditions()
+        if conditions:
+            query = query.filter(*conditions)
+        return query.yield_per(self.chunk_size)
+
+    def subjects(self, section, ids_by_typename=None):
+        """For each exported row, its subject and (predicate, object)s.
+
+        If ids_by_typename is given, only rows whose id is listed under
+        the root typename of their class are exported."""
+        for cls, rdf_class, patterns in self.exported_classes(section):
+            ids = None
+            if ids_by_typename is not None:
+                ids = ids_by_typename.get(
+                    cls.external_typename_with_inheritance(), None)
+                if not ids:
+                    continue
+            for row in self.class_rows(cls, patterns, ids):
+                subject = URIRef(self.iri(cls, row[0]))
+                pairs = []
+                if rdf_class is not None:
+                    pairs.append((RDF.type, rdf_class))
+                for (predicate, attr, as_object), value in zip(
+                        patterns, row[1:]):
+                    if value is not None:
+                        pairs.append((predicate, as_object(value)))
+                if pairs:
+                    yield subject, pairs
+
+    def graph_iri(self, section):
+        return URIRef(AssemblQuadStorageManager.sections[section].graph_name)
+
+    def quads(self):
+        for section in self.sections:
+            graph = self.graph_iri(section)
+            for subject, pairs in self.subjects(section):
+                for predicate, obj in pairs:
+                    yield (subject, predicate, obj, graph)
+
+    def as_nquads(self):
+        "N-Quads, in chunks of one subject"
+        for section in self.sections:
+            graph = self.graph_iri(section).n3()
+            for subject, pairs in self.subjects(section):
+                subject = subject.n3()
+                yield "".join(
+                    "%s %s %s %s .\n" % (subject, p.n3(), o.n3(), graph)
+                    for (p, o) in pairs).encode('utf-8')
+
+    def compact_iri(self, iri):
+        if iri.startswith(self.local_uri):
+            return 'local:' + iri[len(self.local_uri):]
+        return unicode(iri)
+
+    def jsonld_object(self, obj):
+        if isinstance(obj, URIRef):
+            return {"@id": self.compact_iri(obj)}
+        if obj.language:
+            return {"@value": unicode(obj), "@language": obj.language}
+        value = obj.toPython()
+        if isinstance(value, (bool, int, long, float, basestring)):
+            return value
+        return {"@value": unicode(obj), "@type": unicode(obj.datatype)}
+
+    def jsonld_nodes(self, section, ids_by_typename=None):
+        """The (compact subject IRI, serialized node object) pairs of a
+        section, optionally restricted as in :py:meth:`subjects`."""
+        for subject, pairs in self.subjects(section, ids_by_typename):
+            subject = self.compact_iri(subject)
+            node = {"@id": subject}
+            for predicate, obj in pairs:
+                if predicate == RDF.type:
+                    node.setdefault("@type", []).append(
+                        self.compact_iri(obj))
+                else:
+                    node.setdefault(unicode(predicate), []).append(
+                        self.jsonld_object(obj))
+            yield subject, json.dumps(node)
+
+    def jsonld_chunks(self, nodes_by_section):
+        """JSON-LD for a list of (section, serialized node objects),
+        as a list of named graphs, in chunks of one node."""
+        yield '{"@context": %s, "@graph": [' % (json.dumps(
+            [context_url, {'local': self.local_uri}]),)
+        first_graph = True
+        for section, nodes in nodes_by_section:
+            graph = self.compact_iri(self.graph_iri(section))
+            yield '%s{"@id": %s, "@graph": [' % (
+                '' if first_graph else ', ', json.dumps(graph))
+            first_graph = False
+            first_node = True
+            for node in nodes:
+                yield ('' if first_node else ', ') + node
+                first_node = False
+            yield ']}'
+        yield ']}'
+
+    def as_jsonld(self):
+        """JSON-LD, as a list of named graphs, in chunks of one node.
+
+        A subject whose data comes from several tables may appear in
+        more than one node object, which JSON-LD processors merge."""
+        return self.jsonld_chunks(
+            (section, (node for (subject, node) in self.jsonld_nodes(section)))
+            for section in self.sections)
@@ -694,11 +694,23 @@ class AssemblQuadStorageManager(object):
                 cg.add((s, p, o, ctx))
         return cg
 
+    # How many subjects are fetched by a single query in add_subject_data
+    subject_batch_size = 250
+
     def add_subject_data(self, virtuoso, graph, subjects):
-        for s in subjects:
-            for p, o, g in virtuoso.query(
-                'SELECT ?p ?o ?g WHERE { graph ?g { %s ?p ?o }}' % (s.n3(),)):
-                    graph.add((s, p, o, g))
+        """Add the quads of the given subjects to the graph.
+
+        Subjects are fetched in batches, as one query per subject was
+        thousands of round trips for a large discussion."""
+        subjects = list(subjects)
+        batch_size = self.subject_batch_size
+        for start in range(0, len(subjects), batch_size):
+            batch = subjects[start:start + batch_size]
+            for s, p, o, g in virtuoso.query(
+                    'SELECT ?s ?p ?o ?g WHERE { graph ?g { ?s ?p ?o } '
+                    'FILTER (?s IN (%s)) }' % (
+                        ', '.join(subject.n3() for subject in batch),)):
+                graph.add((s, p, o, g))
 
 
     def discussion_as_graph(self, discussion_id):
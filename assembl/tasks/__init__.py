@@ -137,10 +137,7 @@ def init_from_celery(celery_app):
     configure_engine(settings, False)
     configure(registry, celery_app.main)
     from .threaded_model_watcher import ThreadDispatcher
-    threaded_watcher_class_name = settings.get(
-        '%s.threadedmodelwatcher' % (celery_app.main,),
-        "assembl.lib.model_watcher.ModelEventWatcherPrinter")
-    ThreadDispatcher.mw_class = resolver.resolve(threaded_watcher_class_name)
+    ThreadDispatcher.configure(settings, celery_app.main)
 
 
 def includeme(config):
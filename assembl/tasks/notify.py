@@ -1,9 +1,10 @@
 """Celery task for sending :py:class:`assembl.models.notification.Notification` to users."""
 import sys
-from time import sleep
-from datetime import datetime, timedelta
+from time import sleep, time
+from datetime import timedelta
 from traceback import print_exc
 import logging
+import threading
 
 import transaction
 
@@ -25,11 +26,28 @@ CELERYBEAT_SCHEDULE = {
             'exchange': 'notify'
         }
     },
+    'send-digests-every-10-minutes': {
+        'task': 'assembl.tasks.notify.send_digests',
+        'schedule': timedelta(seconds=600),
+        'options': {
+            'routing_key': 'notify',
+            'exchange': 'notify'
+        }
+    },
+    'refresh-discussion-activity-hourly': {
+        'task': 'assembl.tasks.notify.refresh_discussion_activity',
+        'schedule': timedelta(hours=1),
+        'options': {
+            'routing_key': 'notify',
+            'exchange': 'notify'
+        }
+    },
 }
 
 
 class NotifyCeleryApp(CeleryWithConfig):
     def on_configure_with_settings(self, settings):
+        global SMTP_BURST, DIGEST_WINDOW
         # setup SETTINGS_SMTP_DELAY
         for name, val in settings.iteritems():
             if name.startswith(SETTINGS_SMTP_DELAY):
@@ -40,6 +58,13 @@ class NotifyCeleryApp(CeleryWithConfig):
                     continue
                 SMTP_DOMAIN_DELAYS[name[len(SETTINGS_SMTP_DELAY):]] = val
         log.info("SMTP_DOMAIN_DELAYS: " + repr(SMTP_DOMAIN_DELAYS))
+        SMTP_BURST = int(settings.get(SETTINGS_SMTP_BURST, SMTP_BURST))
+        SMTP_DOMAIN_BUCKETS.clear()
+        smtp_pool.max_messages = int(settings.get(
+            SETTINGS_SMTP_MAX_MESSAGES, smtp_pool.max_messages))
+        if SETTINGS_DIGEST_WINDOW in settings:
+            DIGEST_WINDOW = timedelta(
+                seconds=float(settings[SETTINGS_DIGEST_WINDOW]))
 
 
 notify_celery_app = NotifyCeleryApp('celery_tasks.notify')
@@ -48,10 +73,6 @@ notify_celery_app._preconf = {
 }
 
 
-# When was a mail last sent by notifications to a given domain?
-# Propagates to superdomains.
-DOMAIN_LAST_SENT = {}
-
 # Minimum delay between emails sent to a domain.
 # For this to work, you need to have a SINGLE celery process for notification.
 SMTP_DOMAIN_DELAYS = {
@@ -63,16 +84,60 @@ SMTP_DOMAIN_DELAYS = {
 # Use seconds (float) as values.
 SETTINGS_SMTP_DELAY = "celery_tasks.notify.smtp_delay."
 
+# How many emails can be sent to a domain in a burst, before
+# the delay applies between emails.
+SMTP_BURST = 1
+SETTINGS_SMTP_BURST = "celery_tasks.notify.smtp_burst"
+
+# How many emails are sent over a SMTP session before closing it
+SETTINGS_SMTP_MAX_MESSAGES = "celery_tasks.notify.smtp_max_messages"
+
+# The token bucket of each domain of SMTP_DOMAIN_DELAYS
+SMTP_DOMAIN_BUCKETS = {}
+
+# How many notifications are sent by a single task
+NOTIFY_BATCH_SIZE = 100
+
+# How long the notifications of digest subscriptions wait for others
+# before being sent together. Use seconds (float) in the INI file.
+DIGEST_WINDOW = timedelta(hours=1)
+SETTINGS_DIGEST_WINDOW = "celery_tasks.notify.digest_window"
 
-def email_was_sent(email):
-    domain = email.split("@")[-1].lower().split('.')
-    now = datetime.utcnow()
-    for i in range(len(domain) + 1):
-        dom = '.'.join(domain[i:])
-        DOMAIN_LAST_SENT[dom] = now
 
+class TokenBucket(object):
+    """Allows bursts of `capacity` events, then one event per `interval`
+    seconds."""
 
-def wait_if_necessary(email):
+    def __init__(self, interval, capacity=1):
+        self.interval = interval
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_update = time()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token, and return how long to wait before using it."""
+        with self.lock:
+            now = time()
+            if self.interval > 0:
+                self.tokens = min(self.capacity, self.tokens + (
+                    now - self.last_update) / self.interval)
+            else:
+                self.tokens = self.capacity
+            self.last_update = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens * self.interval
+
+    def consume(self):
+        wait = self.reserve()
+        if wait:
+            sleep(wait)
+
+
+def throttle(email):
+    """Wait until the delay of the domain of this email allows sending."""
     domain = email.split("@")[-1].lower().split('.')
     # Look for most specific delay rule
     for i in range(len(domain) + 1):
@@ -83,89 +148,168 @@ def wait_if_necessary(email):
     else:
         return
     # Not looking at superdomains. make delays as generic as needed
-    last_sent = DOMAIN_LAST_SENT.get(dom, None)
-    if last_sent is None:
-        return
-    elapsed = datetime.utcnow() - last_sent
-    if elapsed < delay:
-        sleep((delay - elapsed).total_seconds())
+    bucket = SMTP_DOMAIN_BUCKETS.get(dom, None)
+    if bucket is None:
+        bucket = SMTP_DOMAIN_BUCKETS[dom] = TokenBucket(
+            delay.total_seconds(), SMTP_BURST)
+    bucket.consume()
 
 
-def process_notification(notification):
+class SMTPConnectionPool(object):
+    """Keeps SMTP sessions open between emails, so a worker process sends
+    many emails per session. A session is closed after `max_messages`
+    emails, or when it was idle for more than `max_idle` seconds."""
+
+    def __init__(self, max_messages=100, max_idle=60):
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        import smtplib
+        from assembl.lib import config
+        mail_host = config.get('mail.host')
+        mail_port = int(config.get('mail.port') or 25)
+        assert mail_host
+        connection = smtplib.SMTP(mail_host, mail_port)
+        if log.isEnabledFor(logging.DEBUG):
+            connection.set_debuglevel(1)
+        connection.messages_sent = 0
+        return connection
+
+    def get(self):
+        """An idle session if any, else a new one.
+
+        Returns whether the session was reused along with it."""
+        with self.lock:
+            while self.idle:
+                connection, last_used = self.idle.pop()
+                if time() - last_used < self.max_idle:
+                    return connection, True
+                self.close(connection)
+        return self.connect(), False
+
+    def release(self, connection):
+        if connection.messages_sent >= self.max_messages:
+            self.close(connection)
+            return
+        with self.lock:
+            self.idle.append((connection, time()))
+
+    def close(self, connection):
+        try:
+            connection.quit()
+        except Exception:
+            connection.close()
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        import smtplib
+        connection, reused = self.get()
+        try:
+            try:
+                result = connection.sendmail(from_addr, to_addrs, msg)
+            except smtplib.SMTPServerDisconnected:
+                # The server may have closed a session we kept
+                if not reused:
+                    raise
+                connection.close()
+                connection = self.connect()
+                result = connection.sendmail(from_addr, to_addrs, msg)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
+                smtplib.SMTPDataError):
+            # The server refused this email, but the session is still usable
+            connection.messages_sent += 1
+            self.release(connection)
+            raise
+        except Exception:
+            connection.close()
+            raise
+        connection.messages_sent += 1
+        self.release(connection)
+        return result
+
+
+smtp_pool = SMTPConnectionPool()
+
+
+def send_email(message):
+    """Render and send the email of a notification or a digest.
+
+    Returns the resulting delivery state."""
     from ..models.notification import (
         NotificationDeliveryStateType, UnverifiedEmailException,
         MissingEmailException)
     import smtplib
     import socket
-    from assembl.lib import config
 
-    assert notification
-    sys.stderr.write(
-        "process_notification called with notification %d, state was %s" % (
-            notification.id, notification.delivery_state))
-    if notification.delivery_state not in \
-            NotificationDeliveryStateType.getRetryableDeliveryStates():
-        sys.stderr.write(
-            "Refusing to process notification %d because its delivery state is: %s" % (
-                notification.id, notification.delivery_state))
-        return
     try:
-        email_str = notification.render_to_email()
+        email_str = message.render_to_email()
         # sys.stderr.write(email_str)
-        mail_host = config.get('mail.host')
-        mail_port = int(config.get('mail.port') or 25)
-        assert mail_host
-        recipient = notification.get_to_email_address()
-        wait_if_necessary(recipient)
+        recipient = message.get_to_email_address()
+        throttle(recipient)
 
-        smtp_connection = smtplib.SMTP(
-            mail_host,
-            mail_port,
-        )
-        smtp_connection.set_debuglevel(1)
-        smtp_retval = smtp_connection.sendmail(
-            notification.get_from_email_address(),
+        smtp_retval = smtp_pool.sendmail(
+            message.get_from_email_address(),
             recipient,
             email_str
         )
         if smtp_retval:
             sys.stderr.write("Some but not all recipients failed:")
-            for failed_recipient, errors in smtp_retval:
-                sys.stderr.write(repr(failed_recipient), repr(errors))
+            for failed_recipient, errors in smtp_retval.iteritems():
+                sys.stderr.write(repr(failed_recipient) + repr(errors))
 
-        notification.delivery_state = \
-            NotificationDeliveryStateType.DELIVERY_IN_PROGRESS
-        smtp_connection.quit()
-        email_was_sent(recipient)
+        return NotificationDeliveryStateType.DELIVERY_IN_PROGRESS
     except UnverifiedEmailException as e:
         sys.stderr.write("Not sending to unverified email: "+repr(e))
-        notification.delivery_state = \
-            NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
+        return NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
     except MissingEmailException as e:
-        notification.delivery_state = \
-            NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
         sys.stderr.write("Missing email! :"+repr(e))
-    except (smtplib.SMTPConnectError,
+        return NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
+    except (smtplib.SMTPConnectError, smtplib.SMTPServerDisconnected,
             socket.timeout, socket.error,
             smtplib.SMTPHeloError) as e:
         sys.stderr.write("Temporary failure: "+repr(e))
-        notification.delivery_state = \
-            NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
+        return NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
     except smtplib.SMTPRecipientsRefused as e:
-        notification.delivery_state = \
-            NotificationDeliveryStateType.DELIVERY_FAILURE
         sys.stderr.write("Recepients refused: "+repr(e))
+        return NotificationDeliveryStateType.DELIVERY_FAILURE
     except smtplib.SMTPSenderRefused as e:
-        notification.delivery_state = \
-            NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
         sys.stderr.write("Invalid configuration! :"+repr(e))
+        return NotificationDeliveryStateType.DELIVERY_TEMPORARY_FAILURE
 
+
+def process_notification(notification):
+    from ..models.notification import NotificationDeliveryStateType
+
+    assert notification
+    sys.stderr.write(
+        "process_notification called with notification %d, state was %s" % (
+            notification.id, notification.delivery_state))
+    if notification.delivery_state not in \
+            NotificationDeliveryStateType.getRetryableDeliveryStates():
+        sys.stderr.write(
+            "Refusing to process notification %d because its delivery state is: %s" % (
+                notification.id, notification.delivery_state))
+        return
+    notification.delivery_state = send_email(notification)
     mark_changed()
     sys.stderr.write(
         "process_notification finished processing %d, state is now %s"
         % (notification.id, notification.delivery_state))
 
 
+def process_digest(digest):
+    """Send the notifications of a digest as a single email."""
+    state = send_email(digest)
+    for notification in digest.notifications:
+        notification.delivery_state = state
+    mark_changed()
+    sys.stderr.write(
+        "process_digest sent %d notifications to user %d, state is now %s"
+        % (len(digest.notifications), digest.user.id, state))
+
+
 @notify_celery_app.task()
 def notify(id):
     """ Can be triggered by
@@ -182,18 +326,100 @@ def notify(id):
 def process_pending_notifications():
     """ Can be triggered by http://localhost:6543/data/Notification/process_now """
     from ..models.notification import (
-        Notification, NotificationDeliveryStateType)
+        Notification, NotificationDeliveryStateType,
+        NotificationSubscription, NotificationDeliveryMode)
     sys.stderr.write("process_pending_notifications called")
-    retryable_notifications = Notification.default_db.query(Notification.id).filter(
+    # Notifications of digest subscriptions are left to send_digests
+    retryable_notifications = Notification.default_db.query(Notification.id).join(
+        Notification.first_matching_subscription).filter(
         Notification.delivery_state.in_(
-        NotificationDeliveryStateType.getRetryableDeliveryStates()))
-    for (notification_id,) in retryable_notifications:
+        NotificationDeliveryStateType.getRetryableDeliveryStates()),
+        NotificationSubscription.delivery_mode ==
+        NotificationDeliveryMode.IMMEDIATE)
+    ids = [id for (id,) in retryable_notifications]
+    for i in range(0, len(ids), NOTIFY_BATCH_SIZE):
+        try:
+            process_notification_batch(ids[i:i + NOTIFY_BATCH_SIZE])
+        except:
+            capture_exception()
+
+
+def process_notification_batch(ids):
+    """Send a batch of notifications, through the pooled SMTP sessions.
+
+    The delivery state of each notification is committed as soon as its
+    email is sent, so a crash in the middle of the batch does not send
+    the same emails again. Notifications of the same post share their
+    rendered html within the batch."""
+    from ..models.notification import (
+        Notification, NotificationOnPostCreated)
+    db = Notification.default_db
+    with NotificationOnPostCreated.sharing_html_parts():
+        for id in sorted(ids):
+            try:
+                with transaction.manager:
+                    notification = db.query(Notification).get(id)
+                    if notification:
+                        process_notification(notification)
+            except:
+                capture_exception()
+
+
+@notify_celery_app.task()
+def notify_batch(ids):
+    """Send a batch of notifications, through pooled SMTP sessions."""
+    sys.stderr.write("notify_batch called with %d notifications" % len(ids))
+    process_notification_batch(ids)
+
+
+@notify_celery_app.task()
+def send_digests():
+    """Send a digest email to each user whose digest notifications
+    waited longer than DIGEST_WINDOW."""
+    from ..models.notification import Notification, NotificationDigest
+    sys.stderr.write("send_digests called")
+    db = Notification.default_db
+    for (user_id, discussion_id) in NotificationDigest.due_digests(
+            db, DIGEST_WINDOW):
         try:
             with transaction.manager:
-                process_notification(Notification.get(notification_id))
+                digest = NotificationDigest.load(db, user_id, discussion_id)
+                if digest:
+                    process_digest(digest)
         except:
             capture_exception()
 
 
+def enqueue_notifications(ids):
+    """Send notifications through :py:func:`notify_batch` tasks."""
+    for i in range(0, len(ids), NOTIFY_BATCH_SIZE):
+        notify_batch.delay(ids[i:i + NOTIFY_BATCH_SIZE])
+
+
+@notify_celery_app.task()
+def refresh_discussion_activity():
+    """Aggregate recent activity for time series analytics.
+    The notify app runs the only celerybeat, hence this task lives here."""
+    from ..models import Discussion, DiscussionActivityBucket
+    db = Discussion.default_db
+    discussion_ids = [id for (id,) in db.query(Discussion.id)]
+    for discussion_id in discussion_ids:
+        try:
+            with transaction.manager:
+                DiscussionActivityBucket.refresh(db, discussion_id)
+        except:
+            capture_exception()
+
+
+@notify_celery_app.task(ignore_result=True)
+def refresh_discussion_export(discussion_id, private=False):
+    """Bring the cached JSON-LD export of a discussion up to date."""
+    from ..models import Discussion
+    from ..semantic.export_cache import refresh_export
+    db = Discussion.default_db
+    with transaction.manager:
+        refresh_export(db, discussion_id, private)
+
+
 def includeme(config):
     config_celery_app(notify_celery_app, config.registry.settings)
@@ -5,7 +5,10 @@ import sys
 import signal
 from random import uniform
 from time import sleep
-from threading import Thread, Event, currentThread
+from threading import Thread, Event, Condition, currentThread
+from Queue import Queue as WorkQueue
+from heapq import heappush, heappop
+from itertools import count
 from traceback import print_stack
 from datetime import datetime, timedelta
 from abc import ABCMeta, abstractmethod
@@ -438,6 +441,45 @@ class SourceReader(Thread):
     def do_read(self):
         pass
 
+    def step(self):
+        """One login and read cycle, in the calling thread.
+
+        Used by the :py:class:`ReaderScheduler` instead of :py:meth:`run`.
+        The source is loaded in the session of the calling thread, and that
+        session is closed afterwards, so a database connection is only held
+        during the read. Returns when the source should be read next, or
+        None if it should wait to be woken up."""
+        self.source = None
+        self.setup()
+        try:
+            if self.status in (
+                    ReaderStatus.SHUTDOWN, ReaderStatus.IRRECOVERABLE_ERROR):
+                return None
+            if self.error_backoff_until and (
+                    self.error_backoff_until > datetime.utcnow()):
+                return self.error_backoff_until
+            try:
+                self.login()
+                self.successful_login()
+                self.read()
+            except ReaderError as e:
+                self.new_error(e)
+            except Exception as e:
+                self.new_error(e, ReaderStatus.CLIENT_ERROR, expected=False)
+            finally:
+                self.try_close()
+            if self.status == ReaderStatus.IRRECOVERABLE_ERROR:
+                return None
+            if self.is_in_error():
+                return self.error_backoff_until
+            if self.last_read - self.last_prod > self.max_idle_period:
+                # Nobody cares, I can stop reading
+                return None
+            return datetime.utcnow() + self.time_between_reads
+        finally:
+            if self.source and not inspect(self.source).detached:
+                self.source.db.close()
+
     def shutdown(self):
         # TODO: lock.
         if self.is_connected():
@@ -466,6 +508,117 @@ class PullSourceReader(SourceReader):
         pass
 
 
+class ReaderScheduler(Thread):
+    """Runs many pull readers with a bounded pool of worker threads.
+
+    Instead of a thread per reader, reads are kept in a single priority
+    queue, keyed by the time they are next due; that time accounts for the
+    time between reads and for error backoff. Due reads are handed to the
+    workers, which call :py:meth:`SourceReader.step`."""
+    daemon = True
+
+    def __init__(self, num_workers=8):
+        super(ReaderScheduler, self).__init__(name="ReaderScheduler")
+        self.readers = {}
+        # The current due time of each scheduled source;
+        # queue entries with another time are obsolete.
+        self.due = {}
+        self.queue = []
+        self.running = set()
+        self.counter = count()
+        self.condition = Condition()
+        self.work = WorkQueue()
+        self.stopped = False
+        self.workers = [
+            Thread(target=self.work_loop, name="ReaderWorker-%d" % (n,))
+            for n in range(num_workers)]
+        for worker in self.workers:
+            worker.daemon = True
+
+    def start(self):
+        super(ReaderScheduler, self).start()
+        for worker in self.workers:
+            worker.start()
+
+    def schedule(self, reader, when):
+        # Call with the condition held
+        self.due[reader.source_id] = when
+        heappush(self.queue, (when, next(self.counter), reader.source_id))
+        self.condition.notify()
+
+    def add(self, reader):
+        with self.condition:
+            self.readers[reader.source_id] = reader
+            self.schedule(reader, datetime.utcnow())
+
+    def remove(self, source_id):
+        with self.condition:
+            self.readers.pop(source_id, None)
+            self.due.pop(source_id, None)
+
+    def wake(self, source_id):
+        """Read the source soon, within the limits of
+        ``min_time_between_reads`` and of non-transient error backoff."""
+        with self.condition:
+            reader = self.readers.get(source_id, None)
+            if reader is None:
+                return False
+            now = datetime.utcnow()
+            reader.last_prod = now
+            if source_id in self.running:
+                return True
+            when = max(now, reader.last_read + reader.min_time_between_reads)
+            if reader.error_backoff_until and (
+                    reader.last_error_status != ReaderStatus.TRANSIENT_ERROR):
+                # Only transient backoff can be cancelled by wake
+                when = max(when, reader.error_backoff_until)
+            current = self.due.get(source_id, None)
+            if current is None or when < current:
+                self.schedule(reader, when)
+            return True
+
+    def run(self):
+        with self.condition:
+            while not self.stopped:
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+                when, _, source_id = self.queue[0]
+                delay = (when - datetime.utcnow()).total_seconds()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                heappop(self.queue)
+                if self.due.get(source_id, None) != when or \
+                        source_id in self.running:
+                    continue
+                del self.due[source_id]
+                self.running.add(source_id)
+                self.work.put(self.readers[source_id])
+
+    def work_loop(self):
+        while True:
+            reader = self.work.get()
+            if reader is None:
+                break
+            try:
+                next_read = reader.step()
+            except Exception:
+                capture_exception()
+                next_read = datetime.utcnow() + reader.client_error_backoff
+            with self.condition:
+                self.running.discard(reader.source_id)
+                if (next_read is not None and not self.stopped and
+                        self.readers.get(reader.source_id, None) is reader):
+                    self.schedule(reader, next_read)
+
+    def shutdown(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        for worker in self.workers:
+            self.work.put(None)
+
 
 # Kombu communication. Does not work yet.
 
@@ -497,10 +650,13 @@ def external_shutdown():
 
 class SourceDispatcher(ConsumerMixin):
 
-    def __init__(self, connection):
+    def __init__(self, connection, num_workers=8):
         super(SourceDispatcher, self).__init__()
         self.connection = connection
         self.readers = {}
+        # Pull readers share workers; push readers still get a thread
+        self.scheduler = ReaderScheduler(num_workers)
+        self.scheduler.start()
 
     def get_consumers(self, Consumer, channel):
         global _queue
@@ -526,7 +682,10 @@ class SourceDispatcher(ConsumerMixin):
         reader = self.readers.get(source_id, None)
 
         if force_restart and reader is not None:
-            reader.shutdown()
+            if isinstance(reader, PullSourceReader):
+                self.scheduler.remove(source_id)
+            else:
+                reader.shutdown()
             reader = None
 
         if not (reader and reader.is_connected()):
@@ -543,7 +702,10 @@ class SourceDispatcher(ConsumerMixin):
                 return False
             
             reader.setup_read(reimport, **kwargs)
-            reader.start()
+            if isinstance(reader, PullSourceReader):
+                self.scheduler.add(reader)
+            else:
+                reader.start()
             return True
 
         if reader is None:
@@ -551,13 +713,18 @@ class SourceDispatcher(ConsumerMixin):
 
         # We know it is connected by now.
         reader.setup_read(reimport, **kwargs)
-        reader.wake()
+        if isinstance(reader, PullSourceReader):
+            self.scheduler.wake(source_id)
+        else:
+            reader.wake()
         return True
 
     def shutdown(self):
         self.should_stop = True
+        self.scheduler.shutdown()
         for reader in self.readers.itervalues():
-            if reader is not None:
+            if reader is not None and not isinstance(
+                    reader, PullSourceReader):
                 reader.shutdown()
 
 
@@ -600,7 +767,8 @@ if __name__ == '__main__':
     url = (settings.get('celery_tasks.broker') or
            settings.get('celery_tasks.imap.broker'))
     with BrokerConnection(url) as conn:
-        sourcedispatcher = SourceDispatcher(conn)
+        sourcedispatcher = SourceDispatcher(
+            conn, int(settings.get('source_reader.workers', 8)))
         def shutdown(*args):
             sourcedispatcher.shutdown()
         signal.signal(signal.SIGTERM, shutdown)
@@ -1,22 +1,46 @@
-"""Dispatch model events to another thread, instead of through Celery.
+"""Dispatch model events to other threads, instead of through Celery.
 
 Note that the ModelEventWatcher are Mapper-level flush events, so they cannot
-create objects. This pushes the logic on another thread, so we're already
-using another thread-specific session."""
-
-from threading import Thread
-from Queue import Queue
+create objects. This pushes the logic on other threads, so we're already
+using another thread-specific session.
+
+Events are only queued once the transaction that created them commits,
+so the workers find their objects. They go through a bounded queue: when
+it is full, the committing thread waits, so an import cannot get too far
+ahead of the watcher. Consecutive events of the same kind are given together to the
+model watcher if it has a batch method for them, named after the event
+method with a ``Batch`` suffix (e.g. ``processPostCreatedBatch``). The batch
+method receives the list of ids for single-argument events, and the list
+of argument tuples otherwise."""
+
+from threading import Thread, Lock
+from Queue import Queue, Empty, Full
+from time import time
+import logging
 
 from zope import interface
+from sqlalchemy.event import listen, contains
 
 from ..lib.model_watcher import IModelEventWatcher
+from ..lib.sqla import get_session_maker
+from ..lib.raven_client import capture_exception
+
+
+log = logging.getLogger('assembl')
+
 
-class ThreadDispatcher(Thread):
-    """A thread that will receive CRUD events and hand them to another model watcher."""
+class ThreadDispatcher(object):
+    """A pool of threads that will receive CRUD events and hand them to
+    another model watcher."""
     singleton = None
-    daemon = True
     "The class of the model watcher"
     mw_class = None
+    "How many worker threads"
+    num_workers = 1
+    "How many events can wait in the queue"
+    max_queue_size = 1000
+    "How many events can be given to the model watcher in one batch call"
+    max_batch_size = 100
 
     @classmethod
     def get_instance(cls):
@@ -26,64 +50,178 @@ class ThreadDispatcher(Thread):
         return cls.singleton
 
     def __init__(self):
-        super(ThreadDispatcher, self).__init__()
-        self.queue = Queue()
+        self.queue = Queue(self.max_queue_size)
         self.dying = False
         self.mw = self.mw_class()
+        self.workers = []
+        self.metrics_lock = Lock()
+        self.events_processed = 0
+        self.batches_processed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.queue_full_count = 0
+
+    def start(self):
+        for i in range(self.num_workers):
+            worker = Thread(target=self.run, name="ThreadDispatcher-%d" % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def put(self, event):
+        """Queue an event, waiting for room if the queue is full."""
+        event = (time(),) + event
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            with self.metrics_lock:
+                self.queue_full_count += 1
+            log.warning("ThreadDispatcher queue is full, waiting")
+            self.queue.put(event)
+
+    def next_batch(self, pending):
+        """The next event, and the following events of the same kind.
+
+        Also returns the first event of another kind, if one was taken."""
+        event = pending or self.queue.get()
+        batch = [event]
+        if getattr(self.mw, event[1] + 'Batch', None) is None:
+            return batch, None
+        while len(batch) < self.max_batch_size:
+            try:
+                next_event = self.queue.get_nowait()
+            except Empty:
+                break
+            if next_event[1] != event[1]:
+                return batch, next_event
+            batch.append(next_event)
+        return batch, None
 
     def run(self):
+        pending = None
         while not self.dying:
-            print "*"*20,
-            event = self.queue.get()
-            print event
-            method_name = event[0]
-            method = getattr(self.mw, method_name)
-            method(*event[1:])
+            batch, pending = self.next_batch(pending)
+            method_name = batch[0][1]
+            log.debug("ThreadDispatcher: %d %s", len(batch), method_name)
+            try:
+                if len(batch) > 1:
+                    args = [event[2:] for event in batch]
+                    if all(len(a) == 1 for a in args):
+                        args = [a[0] for a in args]
+                    getattr(self.mw, method_name + 'Batch')(args)
+                else:
+                    getattr(self.mw, method_name)(*batch[0][2:])
+            except Exception:
+                capture_exception()
+            self.record_batch(batch)
+
+    def record_batch(self, batch):
+        now = time()
+        with self.metrics_lock:
+            self.events_processed += len(batch)
+            self.batches_processed += 1
+            for event in batch:
+                latency = now - event[0]
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+
+    def metrics(self):
+        """Queue depth and latency (in seconds) of the events, so far."""
+        with self.metrics_lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "max_queue_size": self.max_queue_size,
+                "queue_full_count": self.queue_full_count,
+                "num_workers": len(self.workers),
+                "events_processed": self.events_processed,
+                "batches_processed": self.batches_processed,
+                "average_latency": (
+                    self.total_latency / self.events_processed
+                    if self.events_processed else 0.0),
+                "max_latency": self.max_latency,
+            }
 
     @classmethod
     def start_dispatcher(cls):
         cls.get_instance()
 
+    @classmethod
+    def configure(cls, settings, prefix):
+        from . import resolver
+        cls.mw_class = resolver.resolve(settings.get(
+            prefix + '.threadedmodelwatcher',
+            "assembl.lib.model_watcher.ModelEventWatcherPrinter"))
+        cls.num_workers = int(settings.get(
+            prefix + '.threadedmodelwatcher.num_workers', cls.num_workers))
+        cls.max_queue_size = int(settings.get(
+            prefix + '.threadedmodelwatcher.max_queue_size',
+            cls.max_queue_size))
+        cls.max_batch_size = int(settings.get(
+            prefix + '.threadedmodelwatcher.max_batch_size',
+            cls.max_batch_size))
+
 
 class ThreadedModelEventWatcher(object):
     """A IModelEventWatcher that will dispatch events to its
-    :py:class:`ThreadDispatcher`"""
+    :py:class:`ThreadDispatcher`, after the current transaction commits.
+
+    Events are sent from flush listeners; queuing them right away would
+    have the workers wait for uncommitted objects, and a full queue would
+    block the flush with its transaction open."""
     interface.implements(IModelEventWatcher)
 
     def __init__(self):
-        self.queue = ThreadDispatcher.get_instance().queue
+        self.dispatcher = ThreadDispatcher.get_instance()
+        session_maker = get_session_maker()
+        if not contains(session_maker, 'after_commit', self.dispatch):
+            listen(session_maker, 'after_commit', self.dispatch)
+            listen(session_maker, 'after_rollback', self.discard)
+
+    @staticmethod
+    def dispatch(session):
+        events = session.info.pop('threaded_model_events', None)
+        if events:
+            dispatcher = ThreadDispatcher.get_instance()
+            for model_event in events:
+                dispatcher.put(model_event)
+
+    @staticmethod
+    def discard(session):
+        session.info.pop('threaded_model_events', None)
+
+    def put(self, model_event):
+        "Keep the event until the session of this thread commits."
+        session = get_session_maker()()
+        session.info.setdefault(
+            'threaded_model_events', []).append(model_event)
 
     def processPostCreated(self, id):
-        self.queue.put(('processPostCreated', id))
+        self.put(('processPostCreated', id))
 
     def processIdeaCreated(self, id):
-        self.queue.put(('processIdeaCreated', id))
+        self.put(('processIdeaCreated', id))
 
     def processIdeaModified(self, id, version):
-        self.queue.put(('processIdeaModified', id, version))
+        self.put(('processIdeaModified', id, version))
 
     def processIdeaDeleted(self, id):
-        self.queue.put(('processIdeaDeleted', id))
+        self.put(('processIdeaDeleted', id))
 
     def processExtractCreated(self, id):
-        self.queue.put(('processExtractCreated', id))
+        self.put(('processExtractCreated', id))
 
     def processExtractModified(self, id, version):
-        self.queue.put(('processExtractModified', id, version))
+        self.put(('processExtractModified', id, version))
 
     def processExtractDeleted(self, id):
-        self.queue.put(('processExtractDeleted', id))
+        self.put(('processExtractDeleted', id))
 
     def processAccountCreated(self, id):
-        self.queue.put(('processAccountCreated', id))
+        self.put(('processAccountCreated', id))
 
     def processAccountModified(self, id):
-        self.queue.put(('processAccountModified', id))
+        self.put(('processAccountModified', id))
 
 
 def includeme(config):
-    from . import resolver
-    class_name = config.get_settings().get(
-        'assembl.threadedmodelwatcher',
-        "assembl.lib.model_watcher.ModelEventWatcherPrinter")
-    ThreadDispatcher.mw_class = resolver.resolve(class_name)
+    ThreadDispatcher.configure(config.get_settings(), 'assembl')
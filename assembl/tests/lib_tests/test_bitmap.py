@@ -0,0 +1,29 @@
+from unittest import TestCase
+
+from assembl.lib.bitmap import IdBitmap
+
+
+class IdBitmapTest(TestCase):
+    def test_sparse_and_dense(self):
+        ids = range(10, 20) + range(70000, 70000 + 5000, 1) + [1 << 20]
+        bitmap = IdBitmap(ids)
+        self.assertEqual(len(bitmap), len(ids))
+        self.assertEqual(list(bitmap), sorted(ids))
+        self.assertTrue(70100 in bitmap)
+        self.assertFalse(21 in bitmap)
+        self.assertFalse(bitmap.add(15))
+        self.assertTrue(bitmap.discard(70100))
+        self.assertFalse(70100 in bitmap)
+        self.assertEqual(len(bitmap), len(ids) - 1)
+
+    def test_serialization(self):
+        bitmap = IdBitmap(range(5, 9000, 2) + range(200000, 201000))
+        self.assertEqual(IdBitmap.from_bytes(bitmap.to_bytes()), bitmap)
+        self.assertEqual(len(IdBitmap.from_bytes(None)), 0)
+
+    def test_ranges(self):
+        bitmap = IdBitmap([1, 2, 3, 7, 9, 10])
+        self.assertEqual(bitmap.as_ranges(), [[1, 3], [7, 7], [9, 10]])
+        self.assertEqual(IdBitmap.from_ranges(bitmap.as_ranges()), bitmap)
+        self.assertEqual(bitmap.count_in([2, 4, 9]), 2)
+        self.assertEqual(list(bitmap & [3, 4, 7]), [3, 7])
@@ -0,0 +1,34 @@
+import shutil
+from tempfile import mkdtemp
+from cStringIO import StringIO
+from unittest import TestCase
+
+from assembl.lib.blob_store import FileSystemBlobStore
+
+
+class FileSystemBlobStoreTest(TestCase):
+    def setUp(self):
+        self.root = mkdtemp()
+        self.store = FileSystemBlobStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_put_and_open(self):
+        data = "x" * 200000
+        key, size = self.store.put_stream(StringIO(data))
+        self.assertEqual(size, len(data))
+        self.assertEqual(len(key), 64)
+        self.assertTrue(self.store.exists(key))
+        with self.store.open(key) as f:
+            self.assertEqual(f.read(), data)
+        self.store.delete(key)
+        self.assertFalse(self.store.exists(key))
+
+    def test_deduplication(self):
+        key1, _ = self.store.put_data("same content")
+        key2, _ = self.store.put_data("same content")
+        key3, _ = self.store.put_data("other content")
+        self.assertEqual(key1, key2)
+        self.assertNotEqual(key1, key3)
+        self.assertEqual(self.store.open(key1).read(), "same content")
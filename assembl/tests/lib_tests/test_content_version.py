@@ -0,0 +1,47 @@
+from unittest import TestCase
+
+from dogpile.cache import make_region
+
+from assembl.lib import content_version
+
+
+class ContentVersionTest(TestCase):
+    def setUp(self):
+        self.old_region = content_version._region
+        content_version._region = make_region().configure(
+            'dogpile.cache.memory')
+
+    def tearDown(self):
+        content_version._region = self.old_region
+
+    def test_record_changes(self):
+        self.assertEqual(content_version.get_version(1).version, 0)
+        content_version.record_changes(1, ['local:Content/1'])
+        content_version.record_changes(1, ['local:Content/2'])
+        content_version.record_changes(2, ['local:Content/3'])
+        version = content_version.get_version(1)
+        self.assertEqual(version.version, 2)
+        self.assertEqual(version.changed_since(0), {
+            'local:Content/1', 'local:Content/2'})
+        self.assertEqual(version.changed_since(1), {'local:Content/2'})
+        self.assertEqual(version.changed_since(2), set())
+
+    def test_log_overflow(self):
+        content_version.record_changes(1, ['local:Content/0'])
+        content_version.record_changes(1, [
+            'local:Content/%d' % i
+            for i in range(content_version.MAX_LOGGED_CHANGES + 1)])
+        version = content_version.get_version(1)
+        self.assertEqual(version.log_start, 2)
+        self.assertIsNone(version.changed_since(1))
+        self.assertEqual(version.changed_since(2), set())
+
+    def test_record_all_changes(self):
+        content_version.record_changes(1, ['local:Content/1'])
+        versions = content_version.record_all_changes({
+            1: ['local:Content/2'], '*': ['local:AgentProfile/3']})
+        self.assertEqual(versions, {1: 2, '*': 1})
+        self.assertEqual(content_version.get_version(1).changed_since(1), {
+            'local:Content/2'})
+        self.assertEqual(content_version.get_version('*').changed_since(0), {
+            'local:AgentProfile/3'})
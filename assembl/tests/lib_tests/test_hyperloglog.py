@@ -0,0 +1,28 @@
+from unittest import TestCase
+
+from assembl.lib.hyperloglog import HyperLogLog
+
+
+class HyperLogLogTest(TestCase):
+    def test_small_cardinality_is_nearly_exact(self):
+        sketch = HyperLogLog(values=range(100))
+        self.assertEqual(len(sketch), 100)
+        sketch.update(range(100))
+        self.assertEqual(len(sketch), 100)
+
+    def test_large_cardinality(self):
+        sketch = HyperLogLog(values=xrange(100000))
+        self.assertAlmostEqual(len(sketch) / 100000.0, 1, delta=0.06)
+
+    def test_merge(self):
+        a = HyperLogLog(values=range(0, 3000))
+        b = HyperLogLog(values=range(2000, 5000))
+        merged = a.copy().merge(b)
+        self.assertAlmostEqual(len(merged) / 5000.0, 1, delta=0.06)
+        self.assertEqual(len(a), len(HyperLogLog(values=range(0, 3000))))
+
+    def test_serialization(self):
+        sketch = HyperLogLog(values=range(1000))
+        copy = HyperLogLog.from_bytes(sketch.to_bytes())
+        self.assertEqual(copy.registers, sketch.registers)
+        self.assertEqual(len(HyperLogLog.from_bytes(None)), 0)
@@ -0,0 +1,68 @@
+import smtplib
+from unittest import TestCase
+
+from assembl.tasks import notify
+
+
+class FakeSMTP(object):
+    def __init__(self, disconnect_after=None):
+        self.sent = []
+        self.closed = False
+        self.disconnect_after = disconnect_after
+        self.messages_sent = 0
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if self.disconnect_after is not None and \
+                len(self.sent) >= self.disconnect_after:
+            raise smtplib.SMTPServerDisconnected()
+        self.sent.append(to_addrs)
+        return {}
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSMTPConnectionPool(notify.SMTPConnectionPool):
+    def __init__(self, *args, **kwargs):
+        super(FakeSMTPConnectionPool, self).__init__(*args, **kwargs)
+        self.connections = []
+        self.disconnect_after = None
+
+    def connect(self):
+        connection = FakeSMTP(self.disconnect_after)
+        self.connections.append(connection)
+        return connection
+
+
+class NotifyDeliveryTest(TestCase):
+    def test_token_bucket(self):
+        bucket = notify.TokenBucket(10, 3)
+        self.assertEqual(
+            [bucket.reserve() for i in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.reserve(), 10, places=1)
+        self.assertAlmostEqual(bucket.reserve(), 20, places=1)
+        unlimited = notify.TokenBucket(0, 1)
+        self.assertEqual([unlimited.reserve() for i in range(3)], [0, 0, 0])
+
+    def test_pool_reuses_sessions(self):
+        pool = FakeSMTPConnectionPool(max_messages=3)
+        for i in range(5):
+            pool.sendmail('a@example.com', 'b%d@example.com' % i, 'msg')
+        self.assertEqual(len(pool.connections), 2)
+        self.assertEqual(len(pool.connections[0].sent), 3)
+        self.assertTrue(pool.connections[0].closed)
+        self.assertEqual(len(pool.connections[1].sent), 2)
+        self.assertFalse(pool.connections[1].closed)
+
+    def test_pool_reconnects(self):
+        pool = FakeSMTPConnectionPool()
+        pool.disconnect_after = 1
+        pool.sendmail('a@example.com', 'b@example.com', 'msg')
+        pool.disconnect_after = None
+        pool.sendmail('a@example.com', 'c@example.com', 'msg')
+        self.assertEqual(len(pool.connections), 2)
+        self.assertTrue(pool.connections[0].closed)
+        self.assertEqual(pool.connections[1].sent, ['c@example.com'])
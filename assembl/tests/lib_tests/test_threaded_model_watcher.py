@@ -0,0 +1,48 @@
+from unittest import TestCase
+
+from assembl.tasks.threaded_model_watcher import ThreadDispatcher
+
+
+class FakeWatcher(object):
+    def __init__(self):
+        self.calls = []
+
+    def processPostCreated(self, id):
+        self.calls.append(('processPostCreated', id))
+
+    def processPostCreatedBatch(self, ids):
+        self.calls.append(('processPostCreatedBatch', ids))
+
+    def processIdeaModified(self, id, version):
+        self.calls.append(('processIdeaModified', id, version))
+
+
+class FakeThreadDispatcher(ThreadDispatcher):
+    mw_class = FakeWatcher
+    max_batch_size = 3
+
+
+class ThreadDispatcherTest(TestCase):
+    def test_batches(self):
+        dispatcher = FakeThreadDispatcher()
+        for event in [('processPostCreated', i) for i in range(4)] + [
+                ('processIdeaModified', 1, 2), ('processIdeaModified', 1, 3),
+                ('processPostCreated', 5)]:
+            dispatcher.put(event)
+        batches = []
+        pending = None
+        while not dispatcher.queue.empty() or pending:
+            batch, pending = dispatcher.next_batch(pending)
+            batches.append([event[1:] for event in batch])
+            dispatcher.record_batch(batch)
+        self.assertEqual(batches, [
+            [('processPostCreated', 0), ('processPostCreated', 1),
+             ('processPostCreated', 2)],
+            [('processPostCreated', 3)],
+            [('processIdeaModified', 1, 2)],
+            [('processIdeaModified', 1, 3)],
+            [('processPostCreated', 5)]])
+        metrics = dispatcher.metrics()
+        self.assertEqual(metrics['queue_depth'], 0)
+        self.assertEqual(metrics['events_processed'], 7)
+        self.assertEqual(metrics['batches_processed'], 5)
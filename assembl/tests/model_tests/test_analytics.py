@@ -0,0 +1,67 @@
+from datetime import datetime
+
+
+def test_activity_time_series(
+        test_session, discussion, participant1_user, participant2_user,
+        root_post_1, reply_post_1):
+    from assembl.models import (
+        DiscussionActivityBucket, DiscussionActivityWatermark)
+    intervals = [(datetime(2000, 1, 1), datetime(2000, 1, 3)),
+                 (datetime(2000, 1, 3), datetime(2000, 1, 5))]
+    results = DiscussionActivityBucket.time_series(
+        test_session, discussion.id, intervals)
+    assert [r['count_posts'] for r in results] == [1, 1]
+    assert [r['count_cumulative_posts'] for r in results] == [1, 2]
+    assert [r['count_post_authors'] for r in results] == [1, 1]
+    assert results[1]['count_cumulative_post_authors'] == 2
+    assert results[0]['interval_id'] == 1
+    assert results[1]['interval_start'] == intervals[1][0]
+    # A second refresh does not count anything twice
+    DiscussionActivityBucket.refresh(test_session, discussion.id)
+    buckets = test_session.query(DiscussionActivityBucket).filter_by(
+        discussion_id=discussion.id).all()
+    assert sum(b.post_count for b in buckets) == 2
+    for bucket in buckets:
+        test_session.delete(bucket)
+    test_session.query(DiscussionActivityWatermark).filter_by(
+        discussion_id=discussion.id).delete()
+    test_session.flush()
+
+
+def test_activity_late_commit(
+        test_session, discussion, participant1_user, participant2_user,
+        root_post_1, reply_post_1):
+    from assembl.models import (
+        DiscussionActivityBucket, DiscussionActivityWatermark)
+    from assembl.lib.bitmap import IdBitmap
+    DiscussionActivityBucket.refresh(test_session, discussion.id)
+    watermark = test_session.query(DiscussionActivityWatermark).filter_by(
+        discussion_id=discussion.id).one()
+    assert watermark.last_post_id == 0
+    assert watermark.checkpoint_post_id == reply_post_1.id
+    # Pretend root_post_1 was committed after reply_post_1 was counted
+    watermark.counted_posts = IdBitmap([reply_post_1.id]).to_bytes()
+    for bucket in test_session.query(DiscussionActivityBucket).filter_by(
+            discussion_id=discussion.id):
+        test_session.delete(bucket)
+    bucket = DiscussionActivityBucket(
+        discussion_id=discussion.id, post_count=1,
+        bucket_start=DiscussionActivityBucket.bucket_start_for(
+            reply_post_1.creation_date))
+    test_session.add(bucket)
+    test_session.flush()
+    DiscussionActivityBucket.refresh(test_session, discussion.id)
+    buckets = test_session.query(DiscussionActivityBucket).filter_by(
+        discussion_id=discussion.id).all()
+    assert sum(b.post_count for b in buckets) == 2
+    # The checkpoint settles once old enough
+    watermark.advance(
+        IdBitmap.from_bytes(watermark.counted_posts),
+        IdBitmap.from_bytes(watermark.counted_views),
+        watermark.checkpoint_date + watermark.settle_delay)
+    assert watermark.last_post_id == reply_post_1.id
+    assert not IdBitmap.from_bytes(watermark.counted_posts)
+    for bucket in buckets:
+        test_session.delete(bucket)
+    test_session.delete(watermark)
+    test_session.flush()
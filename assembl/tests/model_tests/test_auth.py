@@ -17,3 +17,21 @@ def test_subscribe_to_discussion(
     participant2_user.unsubscribe(discussion)
     test_session.flush()
     assert discussion in participant2_user.participant_in_discussion, "The user should no longer be subscribed to the discussion"
+
+
+def test_roles_version_recorded_on_commit(test_session, monkeypatch):
+    from dogpile.cache import make_region
+    from assembl.lib import content_version
+    from assembl.models import Role
+    from assembl.models.auth import ROLES_VERSION_KEY
+    monkeypatch.setattr(content_version, '_region', make_region().configure(
+        'dogpile.cache.memory'))
+    role = Role(name=u'r:roles_version_test')
+    test_session.add(role)
+    test_session.flush()
+    # Not before the commit, as the change could be rolled back
+    assert content_version.get_version(ROLES_VERSION_KEY).version == 0
+    test_session.delete(role)
+    test_session.flush()
+    test_session.commit()
+    assert content_version.get_version(ROLES_VERSION_KEY).version == 1
@@ -0,0 +1,169 @@
+from itertools import chain
+
+
+def test_participants_materialized(
+        test_session, discussion, participant1_user, participant2_user,
+        root_post_1, reply_post_1):
+    from assembl.models import DiscussionParticipant, ViewPost
+    participations = {
+        p.profile_id: p for p in test_session.query(
+            DiscussionParticipant).filter_by(discussion_id=discussion.id)}
+    assert participations[participant1_user.id].has_role
+    assert participations[participant1_user.id].has_posted
+    assert participations[participant2_user.id].has_posted
+    assert not participations[participant2_user.id].has_read
+    participant_ids = set(discussion.get_participants(True))
+    assert participant1_user.id in participant_ids
+    assert participant2_user.id in participant_ids
+
+    view = ViewPost(post=root_post_1, actor=participant2_user)
+    test_session.add(view)
+    test_session.flush()
+    test_session.expire(participations[participant2_user.id])
+    assert participations[participant2_user.id].has_read
+    assert discussion.count_post_viewers() == 1
+    test_session.delete(view)
+    test_session.flush()
+
+
+
+def test_read_state_marks_in_one_flush(
+        test_session, discussion, participant2_user, root_post_1,
+        reply_post_1):
+    from assembl.models import PostReadState, ViewPost
+    views = [ViewPost(post=post, actor=participant2_user)
+             for post in (root_post_1, reply_post_1)]
+    test_session.add_all(views)
+    test_session.flush()
+    read_posts = PostReadState.get_bitmap(
+        test_session, discussion.id, participant2_user.id)
+    assert set(read_posts) == {root_post_1.id, reply_post_1.id}
+    for view in views:
+        test_session.delete(view)
+    test_session.flush()
+
+def test_activity_version(
+        test_session, discussion, participant2_user, root_post_1):
+    from assembl.models import ViewPost
+    version, last_modified = discussion.activity_version()
+    assert discussion.activity_version()[0] == version
+    view = ViewPost(post=root_post_1, actor=participant2_user)
+    test_session.add(view)
+    test_session.flush()
+    assert discussion.activity_version()[0] != version
+    test_session.delete(view)
+    test_session.flush()
+
+
+def test_sql_export(test_session, discussion, participant1_user, root_post_1):
+    import simplejson as json
+    from assembl.semantic.sql_export import SqlQuadExporter
+    exporter = SqlQuadExporter(test_session, discussion.id)
+    subjects = {s for (s, p, o, g) in exporter.quads()}
+    assert discussion.uri(exporter.local_uri) in subjects
+    assert root_post_1.uri(exporter.local_uri) in subjects
+    assert participant1_user.uri(exporter.local_uri) in subjects
+    jsonld = json.loads(''.join(exporter.as_jsonld()))
+    node_ids = {node['@id'] for graph in jsonld['@graph']
+                for node in graph['@graph']}
+    assert root_post_1.uri() in node_ids
+
+
+def test_export_cache_incremental(
+        test_session, discussion, participant1_user, root_post_1,
+        reply_post_1, monkeypatch):
+    from dogpile.cache import make_region
+    from assembl.lib import content_version
+    from assembl.semantic import export_cache
+    from assembl.semantic.sql_export import SqlQuadExporter
+    monkeypatch.setattr(content_version, '_region', make_region().configure(
+        'dogpile.cache.memory'))
+    exported = []
+    jsonld_nodes = SqlQuadExporter.jsonld_nodes
+
+    def recording_jsonld_nodes(self, section, ids_by_typename=None):
+        exported.append(ids_by_typename)
+        return jsonld_nodes(self, section, ids_by_typename)
+    monkeypatch.setattr(SqlQuadExporter, 'jsonld_nodes', recording_jsonld_nodes)
+
+    def export():
+        del exported[:]
+        return export_cache.sql_export_nodes(
+            test_session, discussion.id, False,
+            *export_cache.current_versions(discussion.id))
+    nodes = export()
+    assert exported and all(ids is None for ids in exported)
+    post_uri, reply_uri = root_post_1.uri(), reply_post_1.uri()
+    section = next(s for s in nodes if post_uri in nodes[s])
+    reply_nodes = list(nodes[section][reply_uri])
+
+    # Nothing changed: served from cache
+    assert export() == nodes
+    assert not exported
+
+    # Only the changed post is exported again
+    content_version.record_changes(discussion.id, [post_uri])
+    new_nodes = export()
+    assert exported
+    for ids_by_typename in exported:
+        assert sorted(chain.from_iterable(ids_by_typename.itervalues())) \
+            == [root_post_1.id]
+    assert post_uri in new_nodes[section]
+    assert new_nodes[section][reply_uri] == reply_nodes
+
+
+def test_bulk_clone_discussion(
+        test_session, discussion, participant2_user, root_post_1,
+        reply_post_1, subidea_1):
+    from assembl.models import (
+        Discussion, Idea, IdeaLink, Post, PostReadState, ViewPost)
+    from assembl.scripts.clone_discussion import (
+        bulk_clone_discussion, delete_discussion)
+    if discussion.using_virtuoso:
+        return
+    view = ViewPost(post=root_post_1, actor=participant2_user)
+    test_session.add(view)
+    test_session.flush()
+
+    def rows(cls, discussion_id):
+        return test_session.query(cls).filter_by(
+            discussion_id=discussion_id).order_by(cls.id).all()
+
+    def links(discussion_id):
+        return test_session.query(IdeaLink).join(
+            Idea, IdeaLink.source_id == Idea.id).filter(
+            Idea.discussion_id == discussion_id).order_by(IdeaLink.id).all()
+
+    clone_id = bulk_clone_discussion(test_session, discussion.id, "clone")
+    try:
+        clone = test_session.query(Discussion).get(clone_id)
+        assert clone.slug == "clone"
+        # New ids are old ids plus an offset per id space, so order matches
+        posts, clone_posts = rows(Post, discussion.id), rows(Post, clone_id)
+        assert len(clone_posts) == len(posts)
+        post_ids = {p.id: c.id for (p, c) in zip(posts, clone_posts)}
+        assert not set(post_ids) & set(post_ids.values())
+        for (post, clone_post) in zip(posts, clone_posts):
+            assert clone_post.message_id == post.message_id
+            assert clone_post.parent_id == post_ids.get(post.parent_id)
+            assert clone_post.ancestor_ids() == [
+                post_ids[id] for id in post.ancestor_ids()]
+        ideas, clone_ideas = rows(Idea, discussion.id), rows(Idea, clone_id)
+        assert len(clone_ideas) == len(ideas)
+        idea_ids = {i.id: c.id for (i, c) in zip(ideas, clone_ideas)}
+        source_links, clone_links = links(discussion.id), links(clone_id)
+        assert len(clone_links) == len(source_links)
+        for (link, clone_link) in zip(source_links, clone_links):
+            assert clone_link.source_id == idea_ids[link.source_id]
+            assert clone_link.target_id == idea_ids[link.target_id]
+        assert clone.root_idea.id == idea_ids[discussion.root_idea.id]
+        assert set(PostReadState.get_bitmap(
+            test_session, clone_id, participant2_user.id)) == {
+            post_ids[root_post_1.id]}
+        assert set(PostReadState.get_bitmap(
+            test_session, discussion.id, participant2_user.id)) == {
+            root_post_1.id}
+    finally:
+        delete_discussion(test_session, clone_id)
+        test_session.delete(view)
+        test_session.flush()
@@ -0,0 +1,101 @@
+from assembl.models.edgesense_drupal import compute_ancestries
+
+
+def test_compute_ancestries():
+    ancestries = compute_ancestries({
+        1: None, 2: 1, 3: 2, 4: 1, 5: 99, 6: 7, 7: 6})
+    assert ancestries == {1: '', 2: '1,', 3: '1,2,', 4: '1,'}
+
+
+class FakeEdgeSenseFetcher(object):
+    def __init__(self, nodes, comments, users):
+        self.nodes = nodes
+        self.comments = comments
+        self.users = users
+
+    def get_nodes(self, **kwargs):
+        return self.nodes
+
+    def get_comments(self, **kwargs):
+        return self.comments
+
+    def get_users(self, **kwargs):
+        return self.users
+
+
+class RecordingModelWatcher(object):
+    def __init__(self):
+        self.created_post_ids = []
+
+    def processPostCreated(self, id):
+        self.created_post_ids.append(id)
+
+    def processIdeaModified(self, id, version):
+        pass
+
+
+def test_edgesense_bulk_import(test_session, discussion, monkeypatch):
+    from assembl.models import (
+        DiscussionParticipant, AgentProfile, SourceSpecificPost, generic, idea)
+    from assembl.models.edgesense_drupal import (
+        EdgeSenseDrupalSource, EdgeSenseParser, SourceSpecificAccount)
+    source = EdgeSenseDrupalSource.create(
+        "http://example.com/nodes", "http://example.com/users",
+        "http://example.com/comments", u"EdgeSense", discussion,
+        "http://example.com")
+    test_session.add(source)
+    test_session.flush()
+    fetcher = FakeEdgeSenseFetcher(
+        [{'node': {'nid': '1', 'uid': '10', 'created': '1400000000',
+                   'Body': u'A node'}}],
+        [{'comment': {'cid': '2', 'nid': '1', 'pid': '0', 'uid': '11',
+                      'created': '1400000100', 'Comment': u'A comment'}},
+         {'comment': {'cid': '3', 'nid': '1', 'pid': '2', 'uid': '10',
+                      'created': '1400000200', 'Comment': u'A reply'}}],
+        [{'user': {'uid': '10', 'name': u'Alice'}},
+         {'user': {'uid': '11', 'name': u'Bob'}}])
+    watcher = RecordingModelWatcher()
+    monkeypatch.setattr(generic, 'get_model_watcher', lambda: watcher)
+    monkeypatch.setattr(idea, 'get_model_watcher', lambda: watcher)
+    EdgeSenseParser(source, fetcher).bulk_import()
+    posts = {p.source_post_id: p for p in test_session.query(
+        SourceSpecificPost).filter_by(source_id=source.id)}
+    assert set(posts) == {'nid_1', '2', '3'}
+    node, comment, reply = posts['nid_1'], posts['2'], posts['3']
+    assert comment.parent_id == node.id
+    assert reply.parent_id == comment.id
+    assert reply.ancestry == "%d,%d," % (node.id, comment.id)
+    assert sorted(watcher.created_post_ids) == sorted(
+        p.id for p in posts.itervalues())
+    accounts = test_session.query(SourceSpecificAccount).filter_by(
+        source_id=source.id).all()
+    profile_ids = {a.profile_id for a in accounts}
+    assert {node.creator_id, comment.creator_id} == profile_ids
+    participants = test_session.query(DiscussionParticipant).filter(
+        DiscussionParticipant.discussion_id == discussion.id,
+        DiscussionParticipant.profile_id.in_(profile_ids)).all()
+    assert len(participants) == 2
+    assert all(p.has_posted for p in participants)
+
+    # A reimport updates the bodies without duplicating posts
+    fetcher.nodes[0]['node']['Body'] = u'An edited node'
+    EdgeSenseParser(source, fetcher).bulk_import(reimport=True)
+    # Existing posts are not created again
+    assert len(watcher.created_post_ids) == 3
+    test_session.expire_all()
+    assert test_session.query(SourceSpecificPost).filter_by(
+        source_id=source.id).count() == 3
+    assert node.body.first_original().value == u'An edited node'
+
+    for post in (reply, comment, node):
+        test_session.delete(post)
+        test_session.flush()
+    for participant in participants:
+        test_session.delete(participant)
+    for account in accounts:
+        test_session.delete(account)
+    test_session.flush()
+    for profile_id in profile_ids:
+        test_session.delete(AgentProfile.get(profile_id))
+    test_session.delete(source)
+    test_session.flush()
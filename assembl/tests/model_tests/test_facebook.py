@@ -0,0 +1,71 @@
+from urllib import urlencode
+from urlparse import urlparse, parse_qs
+
+import simplejson as json
+
+from assembl.models.facebook_integration import (
+    FacebookParser, BATCH_SIZE)
+
+
+class FakeGraphAPI(object):
+    """Serves comments of objects from a dict, in pages of two,
+    through batch requests only"""
+
+    def __init__(self, comments):
+        self.comments = comments
+        self.batches = []
+
+    def api_caller(self):
+        return self
+
+    def page(self, object_id, after=0):
+        data = self.comments.get(object_id, [])[after:after + 2]
+        page = {'data': data}
+        if after + 2 < len(self.comments.get(object_id, [])):
+            page['paging'] = {'next': 'https://graph.facebook.com/v2.2/%s/'
+                              'comments?%s' % (object_id, urlencode({
+                                  'limit': 2, 'after': after + 2,
+                                  'access_token': 'secret'}))}
+        return page
+
+    def request(self, path, args=None, post_args=None):
+        batch = json.loads(post_args['batch'])
+        assert len(batch) <= BATCH_SIZE
+        self.batches.append(batch)
+        responses = []
+        for request in batch:
+            url = urlparse(request['relative_url'])
+            qs = parse_qs(url.query)
+            assert 'access_token' not in qs
+            object_id = url.path.split('/')[0]
+            responses.append({'code': 200, 'body': json.dumps(
+                self.page(object_id, int(qs['after'][0])))})
+        return responses
+
+
+def test_complete_comments():
+    comments = {
+        'p1': [{'id': 'c%d' % i} for i in range(5)],
+        'c0': [{'id': 's%d' % i} for i in range(3)],
+    }
+    api = FakeGraphAPI(comments)
+    parser = FacebookParser(api)
+    post = {'id': 'p1', 'comments': api.page('p1')}
+    post['comments']['data'][0]['comments'] = api.page('c0')
+    parser.complete_comments([post])
+    assert [c['id'] for c in parser.get_comments_expanded(post)] == [
+        'c0', 'c1', 'c2', 'c3', 'c4']
+    first_comment = parser.get_comments_expanded(post)[0]
+    assert [c['id'] for c in parser.get_comments_expanded(
+        first_comment)] == ['s0', 's1', 's2']
+    # Two rounds for the post's comments, one for the sub-comments
+    assert len(api.batches) == 3
+
+
+def test_batch_get_chunks():
+    api = FakeGraphAPI({'p%d' % i: [{'id': 'c'}] for i in range(120)})
+    parser = FacebookParser(api)
+    urls = ['p%d/comments?after=0' % i for i in range(120)]
+    pages = parser.batch_get(urls)
+    assert len(api.batches) == 3
+    assert [page['data'] for page in pages] == [[{'id': 'c'}]] * 120
@@ -0,0 +1,139 @@
+import pytest
+
+from assembl.models import feed_parsing
+from assembl.tasks.source_reader import ReaderStatus
+
+
+ATOM_FEED = u"""<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Test feed</title>
+  <id>http://feed.example.com/</id>
+  <updated>2016-05-01T12:00:00Z</updated>
+  %s
+</feed>"""
+
+ATOM_ENTRY = u"""<entry>
+    <id>http://feed.example.com/entry/%(n)d</id>
+    <title>Entry %(n)d</title>
+    <updated>2016-05-0%(n)dT12:00:00Z</updated>
+    <author>
+      <name>Author %(n)d</name>
+      <uri>http://feed.example.com/author/%(n)d</uri>
+    </author>
+    <content type="html">&lt;p&gt;Body %(n)d&lt;/p&gt;</content>
+  </entry>"""
+
+
+def atom_feed(*numbers):
+    return (ATOM_FEED % u"".join(
+        ATOM_ENTRY % {'n': n} for n in reversed(numbers))).encode('utf-8')
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, content='', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeHttp(object):
+    """Serves the next response to requests.get, recording request headers"""
+
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+
+    def get(self, uri, headers=None, **kwargs):
+        self.requests.append(headers or {})
+        return self.responses.pop(0)
+
+
+@pytest.fixture(scope="function")
+def feed_source(request, test_session, discussion):
+    from assembl.models import FeedPostSource, FeedPost, WebLinkAccount
+    source = FeedPostSource.create_from(
+        discussion, u"http://feed.example.com/atom.xml", u"Test feed",
+        feed_parsing.ParsedData)
+    test_session.add(source)
+    test_session.flush()
+
+    def fin():
+        posts = test_session.query(FeedPost).filter_by(
+            source_id=source.id).all()
+        accounts = test_session.query(WebLinkAccount).filter(
+            WebLinkAccount.user_link.like(
+                u"http://feed.example.com/%")).all()
+        for post in posts:
+            test_session.delete(post)
+        for account in accounts:
+            test_session.delete(account.profile)
+            test_session.delete(account)
+        test_session.delete(source)
+        test_session.flush()
+    request.addfinalizer(fin)
+    return source
+
+
+def read_feed(source, http, monkeypatch):
+    monkeypatch.setattr(feed_parsing.requests, 'get', http.get)
+    reader = source.make_reader()
+    reader.source = source
+    reader.status = ReaderStatus.READING
+    monkeypatch.setattr(reader, 'handle_new_content', lambda content: None)
+    reader._add_entries()
+    return reader.source
+
+
+def imported_ids(test_session, source):
+    from assembl.models import FeedPost
+    return sorted(id for (id,) in test_session.query(
+        FeedPost.source_post_id).filter_by(source_id=source.id))
+
+
+def test_feed_first_read(test_session, feed_source, monkeypatch):
+    http = FakeHttp()
+    http.responses.append(FakeResponse(200, atom_feed(1, 2), {
+        'ETag': '"v1"', 'Last-Modified': 'Sun, 01 May 2016 12:00:00 GMT'}))
+    source = read_feed(feed_source, http, monkeypatch)
+    assert 'If-None-Match' not in http.requests[0]
+    assert imported_ids(test_session, source) == [
+        'http://feed.example.com/entry/1', 'http://feed.example.com/entry/2']
+    assert source.http_etag == '"v1"'
+    assert source.http_last_modified == 'Sun, 01 May 2016 12:00:00 GMT'
+
+
+def test_feed_not_modified(test_session, feed_source, monkeypatch):
+    feed_source.http_etag = '"v1"'
+    feed_source.http_last_modified = 'Sun, 01 May 2016 12:00:00 GMT'
+    http = FakeHttp()
+    http.responses.append(FakeResponse(304))
+    source = read_feed(feed_source, http, monkeypatch)
+    assert http.requests == [{
+        'If-None-Match': '"v1"',
+        'If-Modified-Since': 'Sun, 01 May 2016 12:00:00 GMT'}]
+    assert imported_ids(test_session, source) == []
+    assert source.http_etag == '"v1"'
+
+
+def test_feed_reimport_only_new_entries(
+        test_session, feed_source, monkeypatch):
+    http = FakeHttp()
+    http.responses.append(FakeResponse(200, atom_feed(1, 2), {
+        'ETag': '"v1"'}))
+    source = read_feed(feed_source, http, monkeypatch)
+    first_ids = imported_ids(test_session, source)
+    http.responses.append(FakeResponse(200, atom_feed(1, 2, 3), {
+        'ETag': '"v2"', 'Last-Modified': 'Tue, 03 May 2016 12:00:00 GMT'}))
+    source = read_feed(source, http, monkeypatch)
+    assert http.requests[1] == {'If-None-Match': '"v1"'}
+    assert imported_ids(test_session, source) == sorted(
+        first_ids + ['http://feed.example.com/entry/3'])
+    assert source.http_etag == '"v2"'
+    assert source.http_last_modified == 'Tue, 03 May 2016 12:00:00 GMT'
@@ -0,0 +1,44 @@
+def test_idea_closure(
+        test_session, root_idea, subidea_1, subidea_1_1, subidea_1_1_1,
+        subidea_1_2):
+    assert set(subidea_1_1_1.get_all_ancestors(id_only=True)) == {
+        root_idea.id, subidea_1.id, subidea_1_1.id}
+    assert set(subidea_1.get_all_descendants(id_only=True)) == {
+        subidea_1.id, subidea_1_1.id, subidea_1_1_1.id, subidea_1_2.id}
+
+    # Move subidea_1_1 under subidea_1_2
+    link = subidea_1_1.source_links[0]
+    link.source = subidea_1_2
+    test_session.flush()
+    assert set(subidea_1_1_1.get_all_ancestors(id_only=True)) == {
+        root_idea.id, subidea_1.id, subidea_1_2.id, subidea_1_1.id}
+    assert set(subidea_1_2.get_all_descendants(id_only=True)) == {
+        subidea_1_2.id, subidea_1_1.id, subidea_1_1_1.id}
+
+    # Remove the link
+    link.is_tombstone = True
+    test_session.flush()
+    assert subidea_1_1_1.get_all_ancestors(id_only=True) == [subidea_1_1.id]
+    link.tombstone_date = None
+    test_session.flush()
+    assert set(subidea_1_1_1.get_all_ancestors(id_only=True)) == {
+        root_idea.id, subidea_1.id, subidea_1_2.id, subidea_1_1.id}
+
+
+def test_idea_closure_rebuild_all(
+        test_session, discussion, discussion2, root_idea, subidea_1,
+        subidea_1_1):
+    from assembl.models import Idea, IdeaLink, IdeaClosure
+    idea2 = Idea(short_title=u"Second discussion idea", discussion=discussion2)
+    link2 = IdeaLink(source=discussion2.root_idea, target=idea2)
+    test_session.add_all((idea2, link2))
+    test_session.flush()
+    test_session.query(IdeaClosure).delete()
+    IdeaClosure.rebuild(test_session)
+    assert set(subidea_1_1.get_all_ancestors(id_only=True)) == {
+        root_idea.id, subidea_1.id}
+    assert idea2.get_all_ancestors(id_only=True) == [
+        discussion2.root_idea.id]
+    test_session.delete(link2)
+    test_session.delete(idea2)
+    test_session.flush()
@@ -573,3 +573,64 @@ def test_user_language_preference_en_from_fr_fr_from_en_fr_entry(
     best = langstring_body.best_lang(user_prefs=lang_prefs, allow_errors=True)
 
     assert best.locale.id == en_from_fr_locale.id
+
+
+def test_locale_registry_incremental_refresh(test_session):
+    from assembl.models.langstrings import Locale, LocaleRegistry
+    registry = LocaleRegistry().refresh(test_session)
+    und_id = Locale.get_id_of(Locale.UNDEFINED)
+    assert registry.by_code[Locale.UNDEFINED] == und_id
+    assert Locale.UNDEFINED in registry.subsets[Locale.UNDEFINED]
+    # Created in this transaction: found by lookups in the transaction
+    locale = Locale.get_or_create("de_CH", test_session)
+    try:
+        assert Locale.code_for_id(locale.id) == "de_CH"
+        assert "de_CH" in Locale.locale_collection_subsets["de"]
+        # Only new locales are fetched by another registry
+        last_id = registry.last_id
+        registry.refresh(test_session)
+        assert registry.by_id[locale.id] == "de_CH"
+        assert registry.last_id == max(last_id, locale.id)
+        assert registry.by_code[Locale.UNDEFINED] == und_id
+    finally:
+        test_session.delete(locale)
+        test_session.flush()
+        Locale.reset_cache()
+    assert "de_CH" not in Locale.locale_collection
+
+
+def test_locale_registry_forgets_rolled_back_locales(test_session):
+    from assembl.models.langstrings import Locale, forget_locale_changes
+    locale = Locale.get_or_create("de_AT", test_session)
+    try:
+        assert (locale.id, "de_AT") in test_session.info['locales_created']
+        assert Locale.code_for_id(locale.id) == "de_AT"
+        forget_locale_changes(test_session)
+        assert locale.id not in Locale.registry.by_id
+        assert "de_AT" not in Locale.registry.by_code
+    finally:
+        test_session.delete(locale)
+        test_session.flush()
+        Locale.reset_cache()
+
+
+def test_locale_registry_forgets_deleted_locales_on_commit(test_session):
+    from assembl.models.langstrings import (
+        Locale, apply_locale_changes, forget_locale_changes)
+    locale = Locale.get_or_create("de_LU", test_session)
+    apply_locale_changes(test_session)
+    locale_id = locale.id
+    try:
+        test_session.delete(locale)
+        test_session.flush()
+        # The deletion may still be rolled back
+        assert locale_id in test_session.info['locales_deleted']
+        assert Locale.registry.by_id.get(locale_id) == "de_LU"
+        forget_locale_changes(test_session)
+        assert 'locales_deleted' not in test_session.info
+        assert Locale.registry.by_id.get(locale_id) == "de_LU"
+        test_session.info['locales_deleted'] = [locale_id]
+        apply_locale_changes(test_session)
+        assert locale_id not in Locale.registry.by_id
+    finally:
+        Locale.reset_cache()
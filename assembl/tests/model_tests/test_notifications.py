@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 #py.test assembl/models/test_notifications.py -s
+from datetime import timedelta
+
 import pytest
 from sqlalchemy import func
 from assembl.models import (
@@ -14,11 +16,13 @@ from assembl.models import (
     NotificationSubscriptionFollowAllMessages,
     NotificationSubscriptionFollowOwnMessageDirectReplies,
     NotificationCreationOrigin,
-    NotificationSubscriptionStatus
+    NotificationSubscriptionStatus,
+    NotificationDeliveryMode,
+    NotificationDigest,
 )
 
 from assembl.models.notification import (
-    ModelEventWatcherNotificationSubscriptionDispatcher)
+    ModelEventWatcherNotificationSubscriptionDispatcher, CrudVerbs)
 
 
 def test_subscribe_notification(test_session, discussion, participant1_user,
@@ -211,5 +215,179 @@ def test_notification_multiple_subscriptions_create_single_notification(
     notification_count = test_session.query(Notification).count()
     assert notification_count == initial_notification_count + 1
 
+
+def test_find_applicable_ids_matches_would_create(
+        test_session, discussion, participant1_user, participant2_user,
+        root_post_1, reply_post_1, reply_post_2, synthesis_post_1, test_app):
+    test_session.flush()
+    subscriptions = [cls(
+        discussion=discussion,
+        user=user,
+        creation_origin=NotificationCreationOrigin.USER_REQUESTED)
+        for cls in (NotificationSubscriptionFollowSyntheses,
+                    NotificationSubscriptionFollowAllMessages,
+                    NotificationSubscriptionFollowOwnMessageDirectReplies)
+        for user in (participant1_user, participant2_user)]
+    test_session.add_all(subscriptions)
+    test_session.flush()
+    for post in (root_post_1, reply_post_1, reply_post_2, synthesis_post_1):
+        expected = {
+            (s.id, s.user_id) for s in subscriptions
+            if s.wouldCreateNotification(
+                discussion.id, CrudVerbs.CREATE, post)}
+        found = set()
+        for cls in (NotificationSubscriptionFollowSyntheses,
+                    NotificationSubscriptionFollowAllMessages,
+                    NotificationSubscriptionFollowOwnMessageDirectReplies):
+            found.update(cls.findApplicableIds(
+                discussion.id, CrudVerbs.CREATE, post))
+        assert found == expected
+
 # def test_subscribe_notification_access_control
 # TODO: Check that other subscriptions are passed to process method
+
+
+def test_notification_rendering_caches_by_locale(test_app):
+    localizer = Notification.get_locale_localizer('fr')
+    assert Notification.get_locale_localizer('fr') is localizer
+    jinja_env = Notification.get_locale_jinja_env('fr')
+    assert Notification.get_locale_jinja_env('fr') is jinja_env
+    assert Notification.get_locale_jinja_env('en') is not jinja_env
+
+
+def test_notification_html_shared_within_batch(
+        test_session, discussion, participant1_user, reply_post_2,
+        test_app, root_post_1, monkeypatch):
+    from assembl.models import NotificationOnPostCreated
+    test_session.flush()
+    subscription = NotificationSubscriptionFollowAllMessages(
+        discussion=discussion,
+        user=participant1_user,
+        creation_origin=NotificationCreationOrigin.USER_REQUESTED,
+    )
+    test_session.add(subscription)
+    test_session.flush()
+    dispatcher = ModelEventWatcherNotificationSubscriptionDispatcher()
+    dispatcher.processPostCreated(reply_post_2.id)
+    notification = test_session.query(NotificationOnPostCreated).filter_by(
+        post_id=reply_post_2.id,
+        first_matching_subscription=subscription).one()
+    renders = []
+
+    def make_email_html_part(self):
+        renders.append(self.post_id)
+        return u"<p>render %d</p>" % len(renders)
+    monkeypatch.setattr(
+        NotificationOnPostCreated, 'make_email_html_part',
+        make_email_html_part)
+    with NotificationOnPostCreated.sharing_html_parts():
+        assert notification.render_to_email_html_part() == u"<p>render 1</p>"
+        with NotificationOnPostCreated.sharing_html_parts():
+            assert notification.render_to_email_html_part() == \
+                u"<p>render 1</p>"
+    # Later batches and retries see edits and moderation of the post
+    assert notification.render_to_email_html_part() == u"<p>render 2</p>"
+    with NotificationOnPostCreated.sharing_html_parts():
+        assert notification.render_to_email_html_part() == u"<p>render 3</p>"
+    assert renders == [reply_post_2.id] * 3
+
+def test_notification_digest(test_session, discussion, participant1_user,
+                             participant2_user, root_post_1, reply_post_1,
+                             test_app, monkeypatch):
+    import email
+    from email.header import decode_header
+    from assembl.tasks import notify
+    from assembl.models import NotificationDeliveryStateType
+    test_session.flush()
+    subscription = NotificationSubscriptionFollowAllMessages(
+        discussion=discussion,
+        user=participant1_user,
+        creation_origin=NotificationCreationOrigin.USER_REQUESTED,
+        delivery_mode=NotificationDeliveryMode.DIGEST,
+    )
+    test_session.add(subscription)
+    test_session.flush()
+    dispatcher = ModelEventWatcherNotificationSubscriptionDispatcher()
+    dispatcher.processPostCreated(root_post_1.id)
+    dispatcher.processPostCreated(reply_post_1.id)
+    assert (participant1_user.id, discussion.id) in \
+        NotificationDigest.due_digests(test_session, timedelta(0))
+    assert (participant1_user.id, discussion.id) not in \
+        NotificationDigest.due_digests(test_session, timedelta(days=1))
+    digest = NotificationDigest.load(
+        test_session, participant1_user.id, discussion.id)
+    assert {n.post_id for n in digest.notifications} == {
+        root_post_1.id, reply_post_1.id}
+
+    # One email for all the notifications
+    html = digest.render_to_email_html_part()
+    assert participant1_user.name in html
+    assert participant2_user.name in html
+    sent = []
+    monkeypatch.setattr(notify, 'throttle', lambda recipient: None)
+    monkeypatch.setattr(
+        notify.smtp_pool, 'sendmail',
+        lambda from_addr, to_addrs, msg: sent.append((to_addrs, msg)) or {})
+    notify.process_digest(digest)
+    assert len(sent) == 1
+    (recipient, message) = sent[0]
+    assert recipient == "abloon@gmail.com"
+    message = email.message_from_string(message)
+    assert message['To'] == recipient
+    subject = u"".join(
+        part.decode(charset or 'ascii') for (part, charset)
+        in decode_header(message['Subject']))
+    assert subject.startswith(u"[" + discussion.topic + u"]")
+    for notification in digest.notifications:
+        assert notification.delivery_state == \
+            NotificationDeliveryStateType.DELIVERY_IN_PROGRESS
+    test_session.flush()
+    assert NotificationDigest.load(
+        test_session, participant1_user.id, discussion.id) is None
+
+
+def test_notification_batch_skips_missing_posts(
+        test_session, discussion, participant1_user, reply_post_2,
+        test_app, root_post_1):
+    test_session.flush()
+    subscription = NotificationSubscriptionFollowAllMessages(
+        discussion=discussion,
+        user=participant1_user,
+        creation_origin=NotificationCreationOrigin.USER_REQUESTED,
+    )
+    test_session.add(subscription)
+
+    initial_notification_count = test_session.query(Notification).count()
+    dispatcher = ModelEventWatcherNotificationSubscriptionDispatcher()
+    missing_id = reply_post_2.id + 100000
+    dispatcher.processPostCreatedBatch([reply_post_2.id, missing_id])
+    notification_count = test_session.query(Notification).count()
+    assert notification_count == initial_notification_count + 1, "A missing post should not abort the batch"
+
+
+def test_notification_batch_retries_failed_batch_singly(
+        test_session, discussion, participant1_user, reply_post_2,
+        test_app, root_post_1, monkeypatch):
+    test_session.commit()  # a failed batch rolls back its transaction
+    subscription = NotificationSubscriptionFollowAllMessages(
+        discussion=discussion,
+        user=participant1_user,
+        creation_origin=NotificationCreationOrigin.USER_REQUESTED,
+    )
+    test_session.add(subscription)
+    test_session.commit()
+
+    dispatcher = ModelEventWatcherNotificationSubscriptionDispatcher()
+    createNotifications = dispatcher.createNotifications
+    failing_id = root_post_1.id
+
+    def failing_createNotifications(verb, objectInstance):
+        if objectInstance.id == failing_id:
+            raise RuntimeError("Cannot notify")
+        return createNotifications(verb, objectInstance)
+    monkeypatch.setattr(
+        dispatcher, 'createNotifications', failing_createNotifications)
+    initial_notification_count = test_session.query(Notification).count()
+    dispatcher.processPostCreatedBatch([failing_id, reply_post_2.id])
+    notification_count = test_session.query(Notification).count()
+    assert notification_count == initial_notification_count + 1, "A failing post should not abort the batch"
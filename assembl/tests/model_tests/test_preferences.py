@@ -0,0 +1,54 @@
+import pytest
+
+from assembl.models import Preferences
+
+
+def test_preferences_snapshot_cascade():
+    base = Preferences(name=u'snapshot_base')
+    base['social_sharing'] = False
+    prefs = Preferences(name=u'snapshot_child', cascade_preferences=base)
+    prefs['simple_view_panel_order'] = 'NIM'
+    snapshot = prefs.snapshot
+    assert snapshot['social_sharing'] is False
+    assert snapshot['simple_view_panel_order'] == 'NIM'
+    assert snapshot['cookies_banner'] is True
+    assert snapshot['name'] == u'snapshot_child'
+    assert dict(snapshot) == dict(prefs)
+    # Memoized while the cascade does not change
+    assert prefs.snapshot is snapshot
+    base['social_sharing'] = True
+    assert prefs.snapshot is not snapshot
+    assert prefs['social_sharing'] is True
+
+
+def test_preferences_snapshot_preference_data():
+    prefs = Preferences(name=u'snapshot_data')
+    prefs['preference_data'] = {
+        'social_sharing': {'default': False}}
+    assert prefs['social_sharing'] is False
+    assert prefs.get_preference_data()['social_sharing']['name'] == \
+        Preferences.preference_data['social_sharing']['name']
+
+
+def test_preferences_snapshot_freezes_containers():
+    from copy import deepcopy
+    prefs = Preferences(name=u'snapshot_frozen')
+    data = prefs.snapshot['preference_data']
+    with pytest.raises(TypeError):
+        data.append(None)
+    with pytest.raises(TypeError):
+        data[0]['name'] = u'changed'
+    with pytest.raises(TypeError):
+        prefs.get_preference_data()['social_sharing']['default'] = True
+    # Copies can be modified
+    data = deepcopy(data)
+    data[0]['name'] = u'changed'
+    assert prefs['preference_data'][0]['name'] != u'changed'
+
+
+def test_preferences_snapshot_json():
+    import simplejson as json
+    prefs = Preferences(name=u'snapshot_json')
+    snapshot = prefs.snapshot
+    assert json.loads(snapshot.json) == json.loads(json.dumps(dict(prefs)))
+    assert snapshot.json is snapshot.json
@@ -0,0 +1,36 @@
+import pytest
+
+from assembl.models.user_key_values import (
+    KVCollection, NamespacedUserKVCollection, UserNsDict)
+
+
+def test_user_kv_collection_write_through(
+        test_session, discussion, participant1_user):
+    user_id = participant1_user.id
+    collection = NamespacedUserKVCollection(discussion, user_id, 'test_ns')
+    try:
+        collection.set_many({'a': 1, 'b': [1, 2]})
+        assert collection.get_many(['a', 'c']) == {'a': 1}
+        assert len(collection) == 2
+        test_session.flush()
+        # All the namespaces of the user are loaded in one query
+        ns_dict = UserNsDict(discussion, user_id)
+        assert list(ns_dict) == ['test_ns']
+        assert dict(ns_dict['test_ns']) == {'a': 1, 'b': [1, 2]}
+        ns_dict['test_ns']['a'] = 2
+        del ns_dict['test_ns']['b']
+        assert dict(ns_dict['test_ns']) == {'a': 2}
+        test_session.flush()
+        reloaded = NamespacedUserKVCollection(discussion, user_id, 'test_ns')
+        assert dict(reloaded) == {'a': 2}
+    finally:
+        del UserNsDict(discussion, user_id)['test_ns']
+        test_session.flush()
+
+
+def test_kv_collection_requires_kv_class(discussion):
+    class IncompleteKVCollection(KVCollection):
+        pass
+    assert 'kv_class' in IncompleteKVCollection.__abstractmethods__
+    with pytest.raises(TypeError):
+        IncompleteKVCollection(discussion, 'test_ns')
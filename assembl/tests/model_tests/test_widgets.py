@@ -9,3 +9,22 @@ def test_delete_widget(
     test_session.flush()
     test_session.delete(creativity_session_widget)
     test_session.flush()
+
+
+def test_widget_user_states_summary(
+        test_session, creativity_session_widget, participant1_user,
+        admin_user):
+    widget = creativity_session_widget
+    widget.set_user_state({
+        'session_user_vote': '[{"12": 3}, {"13": 1}]'}, participant1_user.id)
+    widget.set_user_state({
+        'session_user_vote': '[{"12": 2}]', 'seen': True}, admin_user.id)
+    test_session.flush()
+    assert widget.get_user_state(participant1_user.id) == {
+        'session_user_vote': '[{"12": 3}, {"13": 1}]'}
+    assert len(widget.get_all_user_states()) == 2
+    summary = widget.get_user_states_summary()
+    assert summary['num_users'] == 2
+    assert summary['keys'] == {'session_user_vote': 2, 'seen': 1}
+    assert summary['votes'] == {
+        '12': {'count': 2, 'total': 5}, '13': {'count': 1, 'total': 1}}
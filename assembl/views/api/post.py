@@ -358,13 +358,7 @@ def get_posts(request):
     is_unread = request.GET.get('is_unread')
     translations = None
     if user_id != Everyone:
-        # This is horrible, but the join creates complex subqueries that
-        # virtuoso cannot decode properly.
-        read_posts = {v.post_id for v in discussion.db.query(
-            ViewPost).filter(
-                ViewPost.tombstone_condition(),
-                ViewPost.actor_id == user_id,
-                *ViewPost.get_discussion_conditions(discussion_id))}
+        read_posts = discussion.read_post_bitmap(user_id)
         liked_posts = {l.post_id: l.id for l in discussion.db.query(
             LikedPost).filter(
                 LikedPost.tombstone_condition(),
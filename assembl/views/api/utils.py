@@ -29,7 +29,8 @@ def mime_type(request):
             document_id = r.groups(0)[0]
             from sqlalchemy.sql.functions import func
             mimetype, create_date, size = File.default_db.query(
-                File.mime_type, File.creation_date, func.length(File.data)
+                File.mime_type, File.creation_date,
+                func.coalesce(File.file_size, func.length(File.data))
                 ).filter_by(id=int(document_id)).first()
             return Response(
                 body=None, content_type=str(mimetype),
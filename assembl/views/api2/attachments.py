@@ -1,9 +1,14 @@
+import os
+
 from pyramid.view import view_config
-from pyramid.response import Response
-from pyramid.httpexceptions import HTTPServerError, HTTPBadRequest
+from pyramid.response import Response, FileResponse, FileIter
+from pyramid.httpexceptions import (
+    HTTPServerError, HTTPBadRequest, HTTPNotModified)
 from pyramid.security import authenticated_userid, Everyone
 
 from assembl.auth import P_READ, P_ADD_POST
+from assembl.lib import config
+from assembl.lib.blob_store import get_blob_store
 from assembl.models import File, Document, Discussion
 from assembl.auth.util import get_permissions
 from assembl.views.traversal import InstanceContext, CollectionContext
@@ -43,7 +48,40 @@ def get_file(request):
     ctx = request.context
     document = ctx._instance
     f = File.get(document.id)
-    return Response(body=f.data, content_type=str(f.mime_type))
+    content_type = str(f.mime_type)
+    sendfile = False
+    if not f.file_sha256:
+        # Uploaded before the blob store
+        response = Response(body=f.data, content_type=content_type)
+        response.md5_etag()
+    else:
+        if f.file_sha256 in request.if_none_match:
+            return HTTPNotModified(etag=f.file_sha256)
+        path = f.local_file_path
+        sendfile_header = config.get('blob_store.x_sendfile_header', None)
+        if path and sendfile_header:
+            # Let the front web server send the file
+            prefix = config.get('blob_store.x_sendfile_prefix', None)
+            if prefix:
+                path = prefix + os.path.relpath(path, get_blob_store().root)
+            response = Response(content_type=content_type)
+            response.headers[sendfile_header] = path
+            sendfile = True
+        elif path:
+            response = FileResponse(path, request, content_type=content_type)
+        else:
+            response = Response(
+                app_iter=FileIter(f.open_file_data()),
+                content_type=content_type, content_length=f.file_size)
+        response.etag = f.file_sha256
+    if not response.last_modified:
+        response.last_modified = f.creation_date
+    response.cache_control.private = True
+    if not sendfile:
+        # Handles If-None-Match, If-Modified-Since and Range.
+        # With sendfile the body is empty, and the front server does it.
+        response.conditional_response = True
+    return response
 
 # Maybe have a permission for uploading content??
 
@@ -70,8 +108,6 @@ def upload_file(request):
 
     mime = request.POST['mime_type']
     file_name = request.POST['name']
-    with request.POST['file'].file as f:
-        data = f.read()
 
     # Check if the file has previously existed, if so, change the name by appending "(n)"
     # to it's name
@@ -79,8 +115,9 @@ def upload_file(request):
     try:
         blob = File(discussion=discussion,
                     mime_type=mime,
-                    title=file_name,
-                    data=data)
+                    title=file_name)
+        with request.POST['file'].file as f:
+            blob.add_file_data(f)
         db.add(blob)
         db.flush()
     except:
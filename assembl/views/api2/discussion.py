@@ -1,24 +1,21 @@
 import re
 import base64
+import hashlib
 from cStringIO import StringIO
 from os import urandom
 from os.path import join, dirname
 from collections import defaultdict
+from itertools import chain
 import random
 from datetime import timedelta
 
 from sqlalchemy import (
-    Column,
-    Integer,
     UnicodeText,
-    DateTime,
     Text,
     String,
     Boolean,
     event,
     ForeignKey,
-    func,
-    distinct
 )
 
 
@@ -27,7 +24,7 @@ from pyramid.response import Response
 from pyramid.view import view_config
 from pyramid.httpexceptions import (
     HTTPOk, HTTPBadRequest, HTTPUnauthorized, HTTPNotAcceptable, HTTPFound,
-    HTTPServerError)
+    HTTPServerError, HTTPNotModified)
 from pyramid_dogpile_cache import get_region
 from pyramid.security import authenticated_userid, Everyone
 from pyramid.renderers import JSONP_VALID_CALLBACK
@@ -48,7 +45,6 @@ from assembl.models import (Discussion, Permission)
 from assembl.models.auth import create_default_permissions
 from ..traversal import InstanceContext, ClassContext
 from . import (JSON_HEADER, FORM_HEADER, CreationResponse)
-from sqlalchemy.orm.util import aliased
 from ..api.discussion import etalab_discussions, API_ETALAB_DISCUSSIONS_PREFIX
 
 
@@ -74,25 +70,49 @@ dogpile_fname = join(
     dirname(dirname(dirname(dirname(__file__)))),
     get_config().get('dogpile_cache.arguments.filename'))
 
-discussion_jsonld_cache = get_region(
-    'discussion_jsonld', **{"arguments.filename": dogpile_fname})
-userprivate_jsonld_cache = get_region(
-    'userprivate_jsonld', **{"arguments.filename": dogpile_fname})
+discussion_statistics_cache = get_region(
+    'discussion_statistics', **{"arguments.filename": dogpile_fname})
 
 
-@discussion_jsonld_cache.cache_on_arguments()
 def discussion_jsonld(discussion_id):
-    from assembl.semantic.virtuoso_mapping import AssemblQuadStorageManager
-    aqsm = AssemblQuadStorageManager()
-    return aqsm.as_jsonld(discussion_id)
+    from assembl.semantic.export_cache import get_export
+    return get_export(Discussion.default_db, discussion_id)
 
 
-@userprivate_jsonld_cache.cache_on_arguments()
 def userprivate_jsonld(discussion_id):
-    from assembl.semantic.virtuoso_mapping import AssemblQuadStorageManager
-    aqsm = AssemblQuadStorageManager()
-    cg = aqsm.participants_private_as_graph(discussion_id)
-    return aqsm.graph_as_jsonld(cg)
+    from assembl.semantic.export_cache import get_export
+    return get_export(Discussion.default_db, discussion_id, private=True)
+
+
+def streaming_export_response(
+        request, discussion_id, salt, format='jsonld', private=False):
+    """Export the discussion from SQL as it is sent, in a chunked response.
+
+    Not cached, but memory use does not grow with the discussion."""
+    from assembl.semantic.sql_export import SqlQuadExporter
+    from assembl.semantic.virtuoso_mapping import (
+        AssemblQuadStorageManager, AESObfuscator)
+    sections = SqlQuadExporter.private_sections if private \
+        else SqlQuadExporter.public_sections
+    chunks = SqlQuadExporter.stream(
+        Discussion.default_db.get_bind(), discussion_id, format,
+        sections=sections)
+    if salt:
+        obfuscator = AESObfuscator(salt)
+        chunks = (AssemblQuadStorageManager.obfuscate(
+            chunk, obfuscator.encrypt) for chunk in chunks)
+    if format == 'nquads':
+        content_type = "application/n-quads"
+    elif "callback" in request.GET:
+        callback_fn = request.GET['callback']
+        if not JSONP_VALID_CALLBACK.match(callback_fn):
+            raise HTTPBadRequest("invalid callback name")
+        chunks = chain(
+            ["/**/%s(" % (callback_fn.encode('ascii'),)], chunks, [");"])
+        content_type = "application/json-p"
+    else:
+        content_type = "application/ld+json"
+    return Response(app_iter=chunks, content_type=content_type)
 
 
 def read_user_token(request):
@@ -194,6 +214,27 @@ def get_token(request):
     return data
 
 
+@view_config(context=InstanceContext, name="read_posts",
+             ctx_instance_class=Discussion, request_method='GET',
+             permission=P_READ, renderer="json")
+def get_read_posts(request):
+    """The posts read by the current user, in compact form.
+
+    By default, as inclusive ranges of post database ids;
+    with format=bitmap, as the base64-encoded serialized bitmap."""
+    user_id = authenticated_userid(request)
+    if not user_id:
+        raise HTTPUnauthorized()
+    discussion = request.context._instance
+    bitmap = discussion.read_post_bitmap(user_id)
+    result = {"count": len(bitmap)}
+    if request.GET.get('format', None) == 'bitmap':
+        result["bitmap"] = base64.b64encode(bitmap.to_bytes())
+    else:
+        result["ranges"] = bitmap.as_ranges()
+    return result
+
+
 @view_config(context=InstanceContext, name="jsonld",
              ctx_instance_class=Discussion, request_method='GET',
              accept="application/ld+json")
@@ -208,6 +249,8 @@ def discussion_instance_view_jsonld(request):
     if not salt and P_ADMIN_DISC not in permissions:
         salt = base64.urlsafe_b64encode(urandom(6))
 
+    if asbool(request.GET.get('stream', False)):
+        return streaming_export_response(request, discussion.id, salt)
     jdata = discussion_jsonld(discussion.id)
     if salt:
         from assembl.semantic.virtuoso_mapping import (
@@ -223,6 +266,19 @@ def discussion_instance_view_jsonld(request):
     return Response(body=jdata, content_type=content_type)
 
 
+@view_config(context=InstanceContext, name="nquads",
+             ctx_instance_class=Discussion, request_method='GET')
+def discussion_instance_view_nquads(request):
+    discussion = request.context._instance
+    user_id, permissions, salt = read_user_token(request)
+    if not (P_READ in permissions or P_READ_PUBLIC_CIF in permissions):
+        raise HTTPUnauthorized()
+    if not salt and P_ADMIN_DISC not in permissions:
+        salt = base64.urlsafe_b64encode(urandom(6))
+    return streaming_export_response(
+        request, discussion.id, salt, 'nquads')
+
+
 @view_config(context=InstanceContext, name="private_jsonld",
              ctx_instance_class=Discussion, request_method='GET',
              accept="application/ld+json")
@@ -237,6 +293,9 @@ def user_private_view_jsonld(request):
     if not salt and P_ADMIN_DISC not in permissions:
         salt = base64.urlsafe_b64encode(urandom(6))
 
+    if asbool(request.GET.get('stream', False)):
+        return streaming_export_response(
+            request, discussion_id, salt, private=True)
     jdata = userprivate_jsonld(discussion_id)
     if salt:
         from assembl.semantic.virtuoso_mapping import (
@@ -261,7 +320,6 @@ def get_time_series_analytics(request):
     end = request.GET.get("end", None)
     interval = request.GET.get("interval", None)
     discussion = request.context._instance
-    user_id = authenticated_userid(request) or Everyone
     try:
         if start:
             start = parse_datetime(start)
@@ -275,173 +333,25 @@ def get_time_series_analytics(request):
         raise HTTPBadRequest("You cannot define an interval and no start")
     if interval and not end:
         end = datetime.now()
-    results = []
+    if not interval:
+        raise HTTPBadRequest("Please specify an interval")
+    intervals = []
+    interval_start = start
+    while interval_start < end:
+        interval_end = min(interval_start + interval, end)
+        intervals.append((interval_start, interval_end))
+        interval_start = interval_start + interval
+    if not intervals:
+        raise HTTPBadRequest("The interval end must be after its start")
+
+    from assembl.models import DiscussionActivityBucket
+    results = DiscussionActivityBucket.time_series(
+        discussion.db, discussion.id, intervals)
 
-    from sqlalchemy import Table, MetaData, and_, case, cast, Float
-    from sqlalchemy.exc import ProgrammingError
-    import pprint
-    import transaction
-    with transaction.manager:
-        metadata = MetaData(discussion.db.get_bind())  # make sure we are using the same connexion
-
-        intervals_table = Table('temp_table_intervals_' + str(user_id), metadata,
-            Column('interval_id', Integer, primary_key=True),
-            Column('interval_start', DateTime, nullable=False),
-            Column('interval_end', DateTime, nullable=False),
-            prefixes=None if discussion.using_virtuoso else ['TEMPORARY']
-        )
-        try:
-            intervals_table.drop()  # In case there is a leftover from a previous crash
-        except ProgrammingError:
-            pass
-        intervals_table.create()
-        interval_start = start
-        intervals = []
-        if interval:
-            while interval_start < end:
-                interval_end = min(interval_start + interval, end)
-                intervals.append({'interval_start': interval_start, 'interval_end': interval_end})
-                interval_start = interval_start + interval
-            #pprint.pprint(intervals)
-            discussion.db.execute(intervals_table.insert(), intervals)
-        else:
-            raise HTTPBadRequest("Please specify an interval")
-
-        from assembl.models import Post, AgentProfile, AgentStatusInDiscussion, ViewPost
-
-        # The posters
-        post_subquery = discussion.db.query(intervals_table.c.interval_id,
-            func.count(distinct(Post.id)).label('count_posts'),
-            func.count(distinct(Post.creator_id)).label('count_post_authors'),
-            # func.DB.DBA.BAG_AGG(Post.creator_id).label('post_authors'),
-            # func.DB.DBA.BAG_AGG(Post.id).label('post_ids'),
-            )
-        post_subquery = post_subquery.outerjoin(Post, and_(Post.creation_date >= intervals_table.c.interval_start, Post.creation_date < intervals_table.c.interval_end, Post.discussion_id == discussion.id))
-        post_subquery = post_subquery.group_by(intervals_table.c.interval_id)
-        post_subquery = post_subquery.subquery()
-
-        # The cumulative posters
-        cumulative_posts_aliased = aliased(Post)
-        cumulative_posts_subquery = discussion.db.query(intervals_table.c.interval_id,
-            func.count(distinct(cumulative_posts_aliased.id)).label('count_cumulative_posts'),
-            func.count(distinct(cumulative_posts_aliased.creator_id)).label('count_cumulative_post_authors')
-            # func.DB.DBA.BAG_AGG(cumulative_posts_aliased.id).label('cumulative_post_ids')
-            )
-        cumulative_posts_subquery = cumulative_posts_subquery.outerjoin(cumulative_posts_aliased, and_(cumulative_posts_aliased.creation_date < intervals_table.c.interval_end, cumulative_posts_aliased.discussion_id == discussion.id))
-        cumulative_posts_subquery = cumulative_posts_subquery.group_by(intervals_table.c.interval_id)
-        cumulative_posts_subquery = cumulative_posts_subquery.subquery()
-
-        # The post viewers
-        postViewers = aliased(ViewPost)
-        viewedPosts = aliased(Post)
-        post_viewers_subquery = discussion.db.query(intervals_table.c.interval_id,
-            func.count(distinct(postViewers.actor_id)).label('UNRELIABLE_count_post_viewers')
-            )
-        post_viewers_subquery = post_viewers_subquery.outerjoin(postViewers, and_(postViewers.creation_date >= intervals_table.c.interval_start, postViewers.creation_date < intervals_table.c.interval_end)).\
-                        join(viewedPosts, and_(postViewers.post_id == viewedPosts.id, viewedPosts.discussion_id == discussion.id))
-        post_viewers_subquery = post_viewers_subquery.group_by(intervals_table.c.interval_id)
-        post_viewers_subquery = post_viewers_subquery.subquery()
-
-        # The visitors
-        firstTimeVisitorAgent = aliased(AgentStatusInDiscussion)
-        visitors_subquery = discussion.db.query(intervals_table.c.interval_id,
-            func.count(firstTimeVisitorAgent.id).label('count_first_time_logged_in_visitors'),
-            # func.DB.DBA.BAG_AGG(firstTimeVisitorAgent.id).label('first_time_visitors')
-            )
-        visitors_subquery = visitors_subquery.outerjoin(firstTimeVisitorAgent, and_(firstTimeVisitorAgent.first_visit >= intervals_table.c.interval_start, firstTimeVisitorAgent.first_visit < intervals_table.c.interval_end, firstTimeVisitorAgent.discussion_id == discussion.id))
-        visitors_subquery = visitors_subquery.group_by(intervals_table.c.interval_id)
-        visitors_subquery = visitors_subquery.subquery()
-
-        # The cumulative visitors
-        cumulativeVisitorAgent = aliased(AgentStatusInDiscussion)
-        cumulative_visitors_query = discussion.db.query(intervals_table.c.interval_id,
-            func.count(distinct(cumulativeVisitorAgent.id)).label('count_cumulative_logged_in_visitors'),
-            # func.DB.DBA.BAG_AGG(cumulativeVisitorAgent.id).label('first_time_visitors')
-            )
-        cumulative_visitors_query = cumulative_visitors_query.outerjoin(cumulativeVisitorAgent, and_(cumulativeVisitorAgent.first_visit < intervals_table.c.interval_end, cumulativeVisitorAgent.discussion_id == discussion.id))
-        cumulative_visitors_query = cumulative_visitors_query.group_by(intervals_table.c.interval_id)
-        cumulative_visitors_subquery = cumulative_visitors_query.subquery()
-        # query = cumulative_visitors_query
-
-        # The members (can go up and down...)  Assumes that first_subscribed is available
-        commented_out = """ first_subscribed isn't yet filled in by assembl
-        memberAgentStatus = aliased(AgentStatusInDiscussion)
-        members_subquery = discussion.db.query(intervals_table.c.interval_id,
-            func.count(memberAgentStatus.id).label('count_approximate_members')
-            )
-        members_subquery = members_subquery.outerjoin(memberAgentStatus, ((memberAgentStatus.last_unsubscribed >= intervals_table.c.interval_end) | (memberAgentStatus.last_unsubscribed.is_(None))) & ((memberAgentStatus.first_subscribed < intervals_table.c.interval_end) | (memberAgentStatus.first_subscribed.is_(None))) & (memberAgentStatus.discussion_id==discussion.id))
-        members_subquery = members_subquery.group_by(intervals_table.c.interval_id)
-        query = members_subquery
-        members_subquery = members_subquery.subquery()
-        """
-
-        subscribersAgentStatus = aliased(AgentStatusInDiscussion)
-        subscribers_query = discussion.db.query(intervals_table.c.interval_id,
-                                                func.sum(
-                                                    case([
-                                                          (subscribersAgentStatus.last_visit == None, 0),
-                                                          (and_(subscribersAgentStatus.last_visit < intervals_table.c.interval_end, subscribersAgentStatus.last_visit >= intervals_table.c.interval_start), 1)
-                                                          ], else_=0)
-                                                         ).label('retention_count_last_visit_in_period'),
-                                                func.sum(
-                                                    case([
-                                                          (subscribersAgentStatus.first_visit == None, 0),
-                                                          (and_(subscribersAgentStatus.first_visit < intervals_table.c.interval_end, subscribersAgentStatus.first_visit >= intervals_table.c.interval_start), 1)
-                                                          ], else_=0)
-                                                         ).label('recruitment_count_first_visit_in_period'),
-                                                func.sum(
-                                                    case([
-                                                          (subscribersAgentStatus.first_subscribed == None, 0),
-                                                          (and_(subscribersAgentStatus.first_subscribed < intervals_table.c.interval_end, subscribersAgentStatus.first_subscribed >= intervals_table.c.interval_start), 1)
-                                                          ], else_=0)
-                                                         ).label('UNRELIABLE_recruitment_count_first_subscribed_in_period'),
-                                                func.sum(
-                                                    case([
-                                                          (subscribersAgentStatus.last_unsubscribed == None, 0),
-                                                          (and_(subscribersAgentStatus.last_unsubscribed < intervals_table.c.interval_end, subscribersAgentStatus.last_unsubscribed >= intervals_table.c.interval_start), 1)
-                                                          ], else_=0)
-                                                         ).label('UNRELIABLE_retention_count_first_subscribed_in_period'),
-                                            )
-        subscribers_query = subscribers_query.outerjoin(subscribersAgentStatus, subscribersAgentStatus.discussion_id==discussion.id)
-        subscribers_query = subscribers_query.group_by(intervals_table.c.interval_id)
-        subscribers_subquery = subscribers_query.subquery()
-        #query = subscribers_query
-
-        combined_query = discussion.db.query(intervals_table,
-                                             post_subquery,
-                                             cumulative_posts_subquery,
-                                             post_viewers_subquery,
-                                             visitors_subquery,
-                                             cumulative_visitors_subquery,
-                                             case([
-                                                   (cumulative_posts_subquery.c.count_cumulative_post_authors == 0, None),
-                                                   (cumulative_posts_subquery.c.count_cumulative_post_authors != 0, (cast(post_subquery.c.count_post_authors, Float) / cast(cumulative_posts_subquery.c.count_cumulative_post_authors, Float)))
-                                                   ]).label('fraction_cumulative_authors_who_posted_in_period'),
-                                             case([
-                                                   (cumulative_visitors_subquery.c.count_cumulative_logged_in_visitors == 0, None),
-                                                   (cumulative_visitors_subquery.c.count_cumulative_logged_in_visitors != 0, (cast(post_subquery.c.count_post_authors, Float) / cast(cumulative_visitors_subquery.c.count_cumulative_logged_in_visitors, Float)))
-                                                   ]).label('fraction_cumulative_logged_in_visitors_who_posted_in_period'),
-                                             subscribers_subquery,
-                                             )
-        combined_query = combined_query.join(post_subquery, post_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(post_viewers_subquery, post_viewers_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(visitors_subquery, visitors_subquery.c.interval_id == intervals_table.c.interval_id)
-        combined_query = combined_query.join(cumulative_visitors_subquery, cumulative_visitors_subquery.c.interval_id == intervals_table.c.interval_id)
-        # combined_query = combined_query.join(members_subquery, members_subquery.c.interval_id==intervals_table.c.interval_id)
-        combined_query = combined_query.join(subscribers_subquery, subscribers_subquery.c.interval_id==intervals_table.c.interval_id)
-        combined_query = combined_query.join(cumulative_posts_subquery, cumulative_posts_subquery.c.interval_id == intervals_table.c.interval_id)
-
-        query = combined_query
-        query = query.order_by(intervals_table.c.interval_id)
-        results = query.all()
-
-        # pprint.pprint(results)
-        # end of transaction
-
-    intervals_table.drop()
     if not (request.GET.get('format', None) == 'csv' or
             request.accept == 'text/csv'):
-            # json default
+        # json default: one object per interval, keyed by the csv field
+        # names below. Note that intervals used to be serialized as arrays.
         from assembl.lib.json import DateJSONEncoder
         return Response(json.dumps(results, cls=DateJSONEncoder),
                         content_type='application/json')
@@ -465,18 +375,70 @@ def get_time_series_analytics(request):
         "UNRELIABLE_count_post_viewers",
     ]
     # otherwise assume csv
-    return csv_response(fieldnames, [r._asdict() for r in results])
+    return csv_response(fieldnames, results)
 
 
-def csv_response(fieldnames, results):
+def csv_body(fieldnames, results):
     from csv import DictWriter
     output = StringIO()
     csv = DictWriter(output, fieldnames=fieldnames, dialect='excel', delimiter=';')
     csv.writeheader()
     for r in results:
         csv.writerow(r)
-    output.seek(0)
-    return Response(body_file=output, content_type='text/csv')
+    return output.getvalue()
+
+
+def csv_response(fieldnames, results):
+    return Response(body=csv_body(fieldnames, results),
+                    content_type='text/csv')
+
+
+def wants_csv(request):
+    return (request.GET.get('format', None) == 'csv'
+            or request.accept == 'text/csv')
+
+
+def open_range_end(last_modified):
+    """The end of a statistics range given without one: just after the
+    latest activity, rather than now, so the result only changes with the
+    activity version."""
+    from datetime import datetime
+    if last_modified is None:
+        return datetime.utcnow()
+    return last_modified + timedelta(microseconds=1)
+
+
+def cached_statistics_response(request, compute, content_versions=()):
+    """Serve a discussion statistics view from cache, with ETag and
+    Last-Modified headers.
+
+    ``compute(as_csv, last_modified)`` returns a (body, content_type) pair,
+    where ``last_modified`` is the date of the latest activity. It is cached
+    by discussion, view, query and format, until the discussion's
+    :py:meth:`~assembl.models.discussion.Discussion.activity_version`
+    changes, or the version of one of the given
+    :py:mod:`assembl.lib.content_version` keys."""
+    from assembl.lib.content_version import get_version
+    as_csv = wants_csv(request)
+    discussion = request.context._instance
+    version, last_modified = discussion.activity_version()
+    version = [version] + [
+        get_version(key).version for key in content_versions]
+    etag = hashlib.md5(repr((
+        request.view_name, discussion.id, sorted(request.GET.items()),
+        as_csv, version))).hexdigest()
+    if etag in request.if_none_match:
+        return HTTPNotModified(etag=etag)
+    body, content_type = discussion_statistics_cache.get_or_create(
+        etag, lambda: compute(as_csv, last_modified))
+    response = Response(body=body, content_type=content_type)
+    response.etag = etag
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    # Lets webob answer If-Modified-Since with a 304
+    response.conditional_response = True
+    return response
 
 
 @view_config(context=InstanceContext, name="contribution_count",
@@ -484,7 +446,6 @@ def csv_response(fieldnames, results):
              permission=P_DISC_STATS)
 def get_contribution_count(request):
     import isodate
-    from datetime import datetime
     start = request.GET.get("start", None)
     end = request.GET.get("end", None)
     interval = request.GET.get("interval", None)
@@ -500,8 +461,16 @@ def get_contribution_count(request):
         raise HTTPBadRequest(e)
     if interval and not start:
         raise HTTPBadRequest("You cannot define an interval and no start")
-    if interval and not end:
-        end = datetime.now()
+
+    def compute(as_csv, last_modified):
+        return contribution_count(
+            discussion, start, end or open_range_end(last_modified),
+            interval, as_csv)
+    return cached_statistics_response(request, compute)
+
+
+def contribution_count(discussion, start, end, interval, as_csv):
+    from datetime import datetime
     results = []
     if interval:
         while start < end:
@@ -524,13 +493,12 @@ def get_contribution_count(request):
             end = datetime.now()
         r["end"] = end.isoformat()
         results.append(r)
-    if not (request.GET.get('format', None) == 'csv'
-            or request.accept == 'text/csv'):
+    if not as_csv:
         # json default
         for v in results:
             v['count'] = {agent.display_name(): count
                           for (agent, count) in v['count']}
-        return Response(json.dumps(results), content_type='application/json')
+        return json.dumps(results), 'application/json'
     # otherwise assume csv
     from csv import writer
     total_count = defaultdict(int)
@@ -557,8 +525,7 @@ def get_contribution_count(request):
             agent.get_preferred_email())
         csv.writerow([agent_name.encode('utf-8')] + [
             x['count'].get(agent_id, '') for x in results] + [total_count])
-    output.seek(0)
-    return Response(body_file=output, content_type='text/csv')
+    return output.getvalue(), 'text/csv'
 
 
 @view_config(context=InstanceContext, name="visit_count",
@@ -566,7 +533,6 @@ def get_contribution_count(request):
              permission=P_DISC_STATS)
 def get_visit_count(request):
     import isodate
-    from datetime import datetime
     start = request.GET.get("start", None)
     end = request.GET.get("end", None)
     interval = request.GET.get("interval", None)
@@ -582,8 +548,16 @@ def get_visit_count(request):
         raise HTTPBadRequest(e)
     if interval and not start:
         raise HTTPBadRequest("You cannot define an interval and no start")
-    if interval and not end:
-        end = datetime.now()
+
+    def compute(as_csv, last_modified):
+        return visit_count(
+            discussion, start, end or open_range_end(last_modified),
+            interval, as_csv)
+    return cached_statistics_response(request, compute)
+
+
+def visit_count(discussion, start, end, interval, as_csv):
+    from datetime import datetime
     results = []
     if interval:
         while start < end:
@@ -610,13 +584,12 @@ def get_visit_count(request):
             end = datetime.now()
         r["end"] = end.isoformat()
         results.append(r)
-    if not (request.GET.get('format', None) == 'csv'
-            or request.accept == 'text/csv'):
+    if not as_csv:
         # json default
-        return Response(json.dumps(results), content_type='application/json')
+        return json.dumps(results), 'application/json'
     # otherwise assume csv
     fieldnames=['start', 'end', 'first_visitors', 'readers']
-    return csv_response(fieldnames, results)
+    return csv_body(fieldnames, results), 'text/csv'
 
 
 @view_config(context=InstanceContext, name="visitors",
@@ -626,16 +599,20 @@ def get_visitors(request):
     discussion = request.context._instance
     use_first = asbool(request.GET.get("first", False))
     attribute = "first_visit" if use_first else "last_visit"
-    visitors = [
-        (getattr(st, attribute), st.agent_profile.name,
-            st.agent_profile.get_preferred_email())
-        for st in discussion.agent_status_in_discussion
-        if getattr(st, attribute, None)]
-    visitors.sort()
-    visitors.reverse()
-    body = "\n".join(("%s: %s <%s>" % (x[0].isoformat(), x[1], x[2])
-                      for x in visitors))
-    return Response(body=body, content_type='text/text')
+
+    def compute(as_csv, last_modified):
+        visitors = [
+            (getattr(st, attribute), st.agent_profile.name,
+                st.agent_profile.get_preferred_email())
+            for st in discussion.agent_status_in_discussion
+            if getattr(st, attribute, None)]
+        visitors.sort()
+        visitors.reverse()
+        body = "\n".join(("%s: %s <%s>" % (x[0].isoformat(), x[1], x[2])
+                          for x in visitors))
+        return body, 'text/text'
+    # Names and emails change the version of objects outside discussions
+    return cached_statistics_response(request, compute, ("*",))
 
 
 pygraphviz_formats = {
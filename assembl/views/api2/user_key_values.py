@@ -35,11 +35,11 @@ def patch_u_dict(request):
     if not isinstance(request.json, dict):
         raise HTTPBadRequest()
     try:
+        user_ns_b_kvdict.set_many({
+            k: v for (k, v) in request.json.iteritems() if v is not None})
         for k, v in request.json.iteritems():
             if v is None:
                 del user_ns_b_kvdict[k]
-            else:
-                user_ns_b_kvdict[k] = v
     except KeyError:
         raise HTTPNotFound()
     except (AssertionError, ValueError) as e:
@@ -54,11 +54,11 @@ def put_u_dict(request):
     if not isinstance(request.json, dict):
         raise HTTPBadRequest()
     try:
+        user_ns_b_kvdict.set_many({
+            k: v for (k, v) in request.json.iteritems() if v is not None})
         for k, v in request.json.iteritems():
             if v is None:
                 del user_ns_b_kvdict[k]
-            else:
-                user_ns_b_kvdict[k] = v
         for k in user_ns_b_kvdict:
             if k not in request.json:
                 del user_ns_b_kvdict[k]
@@ -146,11 +146,11 @@ def patch_dict(request):
     if not isinstance(request.json, dict):
         raise HTTPBadRequest()
     try:
+        ns_b_kvdict.set_many({
+            k: v for (k, v) in request.json.iteritems() if v is not None})
         for k, v in request.json.iteritems():
             if v is None:
                 del ns_b_kvdict[k]
-            else:
-                ns_b_kvdict[k] = v
     except KeyError:
         raise HTTPNotFound()
     except (AssertionError, ValueError) as e:
@@ -165,11 +165,11 @@ def put_dict(request):
     if not isinstance(request.json, dict):
         raise HTTPBadRequest()
     try:
+        ns_b_kvdict.set_many({
+            k: v for (k, v) in request.json.iteritems() if v is not None})
         for k, v in request.json.iteritems():
             if v is None:
                 del ns_b_kvdict[k]
-            else:
-                ns_b_kvdict[k] = v
         for k in ns_b_kvdict:
             if k not in request.json:
                 del ns_b_kvdict[k]
@@ -1,6 +1,7 @@
 from simplejson import loads
 
 from pyramid.view import view_config
+from pyramid.response import Response
 from pyramid.security import authenticated_userid, Everyone
 from pyramid.httpexceptions import (
     HTTPOk, HTTPNoContent, HTTPNotFound, HTTPUnauthorized)
@@ -80,7 +81,13 @@ def widget_userstate_get(request):
     user_id = authenticated_userid(request)
     if not user_id:
         raise HTTPUnauthorized()
-    return request.context._instance.get_user_state(user_id)
+    state = request.context._instance.get_user_state_text(user_id)
+    if state is None:
+        return None
+    # Send the stored JSON as is
+    if isinstance(state, unicode):
+        state = state.encode('utf-8')
+    return Response(state, content_type='application/json')
 
 
 @view_config(context=InstanceContext, request_method='PATCH',
@@ -223,7 +230,22 @@ def get_idea_sibling_criteria(request):
     request_method="GET", permission=P_READ,
     renderer="json", name="user_states")
 def get_all_users_states(request):
-    return request.context._instance.get_all_user_states()
+    """All the user states of the widget, streamed as they are stored.
+
+    Memory use does not grow with the number of users."""
+    widget = request.context._instance
+    return Response(
+        app_iter=Widget.stream_user_states(
+            widget.db.get_bind(), widget.id),
+        content_type='application/json')
+
+
+@view_config(
+    context=InstanceContext, ctx_instance_class=Widget,
+    request_method="GET", permission=P_READ,
+    renderer="json", name="user_states_summary")
+def get_users_states_summary(request):
+    return request.context._instance.get_user_states_summary()
 
 
 @view_config(context=InstanceContext, renderer='json', request_method='GET',
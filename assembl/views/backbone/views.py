@@ -14,7 +14,8 @@ from sqlalchemy.orm.exc import NoResultFound
 from ...lib.utils import path_qs
 from ...lib.frontend_urls import FrontendUrls
 from ...auth import P_READ, P_ADD_EXTRACT
-from ...auth.util import user_has_permission
+from ...auth.util import get_permissions
+from ...lib.content_version import get_version
 from ...models import (
     Discussion,
     User,
@@ -23,6 +24,7 @@ from ...models import (
     Idea,
     Locale,
 )
+from ...models.auth import ROLES_VERSION_KEY
 from .. import (
     HTTPTemporaryRedirect, get_default_context as base_default_context,
     get_locale_from_request)
@@ -63,13 +65,54 @@ def get_styleguide_components():
     return views
 
 
+# Shared home page payloads, by (discussion id, locale code)
+_bootstrap_payloads = {}
+
+
+def shared_bootstrap_payload(discussion, target_locale):
+    """The part of the home page context that depends only on the discussion
+    and the target locale, as JSON strings.
+
+    Memoized while the discussion preferences snapshot is the same object
+    (which it stays until they change) and the roles content version is
+    unchanged."""
+    preferences = discussion.preferences.snapshot
+    roles_version = get_version(ROLES_VERSION_KEY).version
+    key = (discussion.id, target_locale.code)
+    cached = _bootstrap_payloads.get(key, None)
+    if cached is not None and cached[0] is preferences \
+            and cached[1] == roles_version:
+        return cached[2]
+
+    translation_service_data = {}
+    try:
+        service = discussion.translation_service()
+        if service:
+            translation_service_data = service.serviceData()
+    except:
+        pass
+    role_names = [x for (x) in discussion.db.query(Role.name).all()]
+    payload = {
+        'translation_service_data_json': json.dumps(
+            translation_service_data),
+        'translation_locale_names_json': json.dumps(
+            DummyGoogleTranslationService.target_locale_labels_cls(
+                target_locale)),
+        'preferences_json': preferences.json,
+        'role_names': json.dumps(role_names),
+    }
+    _bootstrap_payloads[key] = (preferences, roles_version, payload)
+    return payload
+
+
 @view_config(route_name='home', request_method='GET', http_cache=60)
 def home_view(request):
     """The main view on a discussion"""
     user_id = authenticated_userid(request) or Everyone
     context = get_default_context(request)
     discussion = context["discussion"]
-    canRead = user_has_permission(discussion.id, user_id, P_READ)
+    permissions = get_permissions(user_id, discussion.id)
+    canRead = P_READ in permissions
     if not canRead and user_id == Everyone:
         # User isn't logged-in and discussion isn't public:
         # redirect to login page
@@ -131,35 +174,21 @@ def home_view(request):
                 'home', discussion_slug=discussion.slug))
         context['idea'] = idea
 
-    canAddExtract = user_has_permission(discussion.id, user_id, P_ADD_EXTRACT)
-    context['canAddExtract'] = canAddExtract
+    context['canAddExtract'] = P_ADD_EXTRACT in permissions
     context['canDisplayTabs'] = True
-    preferences = discussion.preferences
     session = discussion.db
     if user_id != Everyone:
         from assembl.models import UserPreferenceCollection
         user = User.get(user_id)
-        preferences = UserPreferenceCollection(user_id, discussion)
         target_locale = get_locale_from_request(request, session, user)
     else:
         target_locale = get_locale_from_request(request, session)
 
-    translation_service_data = {}
-    try:
-        service = discussion.translation_service()
-        if service:
-            translation_service_data = service.serviceData()
-    except:
-        pass
-    context['translation_service_data_json'] = json.dumps(
-        translation_service_data)
-    locale_labels = json.dumps(
-        DummyGoogleTranslationService.target_locale_labels_cls(target_locale))
-    context['translation_locale_names_json'] = locale_labels
-
-    context['preferences_json'] = json.dumps(dict(preferences))
-    role_names = [x for (x) in session.query(Role.name).all()]
-    context['role_names'] = json.dumps(role_names)
+    context.update(shared_bootstrap_payload(discussion, target_locale))
+    if user_id != Everyone:
+        # User values override the shared discussion preferences
+        preferences = UserPreferenceCollection(user_id, discussion)
+        context['preferences_json'] = json.dumps(preferences.get_many())
 
     response = render_to_response('../../templates/index.jinja2', context,
                                   request=request)
@@ -187,7 +216,7 @@ def frontend_test_view(request):
         DummyGoogleTranslationService.target_locale_labels_cls(target_locale))
     context['translation_locale_names_json'] = locale_labels
     context['translation_service_data_json'] = '{}'
-    context['preferences_json'] = json.dumps(dict(discussion.preferences))
+    context['preferences_json'] = discussion.preferences.snapshot.json
     return context
 
 